@@ -0,0 +1,312 @@
+# Name: async_acquisition_pipeline.py
+# Description: Asyncio double buffered acquisition pipeline, the transfer of a
+#              capture from the scope overlaps the equalization of the
+#              capture before it, so that the trigger to corrected display rate
+#              is limited by the slower of the two stages, and not by their sum.
+#              The captures are received directly into a preallocated ring of
+#              buffers (with "loop.sock_recv_into()"), that are seen as NumPy
+#              arrays with "np.frombuffer()", without any copy.
+#              A worker equalizes the oldest received buffer in an executor,
+#              a thread pool by default, while the event loop keeps receiving
+#              the next captures.
+#              The queue depths, the dropped captures and the time of each
+#              stage are exposed by "stats()".
+#
+# Flow of the ring buffers:
+#   free queue -> receive the capture -> ready queue -> equalize -> free queue
+#
+# Note 1: When the equalization is slower then the link and there is no free
+#         buffer, the oldest capture that is waiting in the ready queue is
+#         dropped and its buffer is reused, so that the display shows the
+#         newest captures. With "flag_drop_when_full = False" the
+#         acquisition waits for a free buffer instead.
+#
+# Note 2: NumPy releases the GIL in the FFTs, so the thread pool executor
+#         really overlaps with the transfer. A process pool executor can also
+#         be given, but then each capture is pickled to the worker.
+#
+# Note 3: The equalized output is passed to "onResult(captureIndex, output)"
+#         in the event loop, before the buffer goes back to the free queue, so
+#         the callback must copy the output if it keeps it and the output is
+#         a view of the ring buffer.
+#
+# License:        MIT Open Source License
+#
+
+import asyncio
+import collections
+import concurrent.futures
+import socket
+import time
+import numpy as np
+
+from attenuation_profile import AttenuationProfile
+from equalizer_plan_cache import EqualizerPlanCache, equalizeWithPlan
+from scpi_link import parseBlockHeader, defaultSCPIPort, socketBufferSize
+from waveform_io import parseWaveDescriptor, skipBlockPrefix, codesToVolts, codesDtype
+
+################
+# Configurations
+################
+
+pathTables = ".//output_out//"
+CSVFile_defaultTable = "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv"
+
+defaultNumBuffers = 3
+
+#########
+# Classes
+#########
+
+class AsyncSCPIClient:
+    # Non blocking version of "scpi_link.SCPISocketClient", for the event loop.
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._pending = bytearray()
+        self.bytesReceived = 0
+
+    @classmethod
+    async def connect(cls, host, port = defaultSCPIPort):
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, socketBufferSize)
+        await loop.sock_connect(sock, (host, port))
+        return cls(sock)
+
+    async def write(self, command):
+        await asyncio.get_running_loop().sock_sendall(self.sock,
+                                                      command.encode("ascii") + b"\n")
+
+    async def _receiveMore(self):
+        data = await asyncio.get_running_loop().sock_recv(self.sock, 65536)
+        if not data:
+            raise ConnectionError("The SCPI connection was closed.")
+        self._pending += data
+        self.bytesReceived += len(data)
+
+    async def readLine(self):
+        while True:
+            index = self._pending.find(b"\n")
+            if index >= 0:
+                line = bytes(self._pending[:index])
+                del self._pending[:index + 1]
+                return line.decode("ascii").strip()
+            await self._receiveMore()
+
+    async def query(self, command):
+        await self.write(command)
+        return await self.readLine()
+
+    async def readBlock(self, out = None):
+        # Reads one definite length block into "out", see "SCPISocketClient.readBlock()".
+        loop = asyncio.get_running_loop()
+        while True:
+            header = parseBlockHeader(self._pending)
+            if header is not None:
+                break
+            await self._receiveMore()
+        headerSize, numBytes = header
+        del self._pending[:headerSize]
+        if out is None:
+            out = bytearray(numBytes)
+        view = memoryview(out).cast("B")
+        if view.nbytes < numBytes:
+            raise ValueError("The output buffer is smaller then the block.")
+        view = view[:numBytes]
+        numPending = min(len(self._pending), numBytes)
+        view[:numPending] = self._pending[:numPending]
+        del self._pending[:numPending]
+        position = numPending
+        while position < numBytes:
+            received = await loop.sock_recv_into(self.sock, view[position:])
+            if received == 0:
+                raise ConnectionError("The SCPI connection was closed.")
+            position += received
+        self.bytesReceived += numBytes - numPending
+        while not self._pending:
+            await self._receiveMore()
+        if self._pending[:1] == b"\n":
+            del self._pending[:1]
+        return view
+
+    async def queryBlock(self, command, out = None):
+        await self.write(command)
+        return await self.readBlock(out)
+
+    def close(self):
+        self.sock.close()
+
+class AsyncAcquisitionPipeline:
+
+    def __init__(self, client, metadata, equalizeFn, numBuffers = defaultNumBuffers,
+                 executor = None, flag_drop_when_full = True, onResult = None):
+        # Param: metadata of the captures, from the ":WAV:PRE?" query.
+        #        equalizeFn(codes) returns the corrected capture, it runs in the executor.
+        #        onResult(captureIndex, output) is called for each result, see Note 3.
+        if numBuffers < 2:
+            raise ValueError("The ring needs at least 2 buffers.")
+        self.client     = client
+        self.metadata   = metadata
+        self.equalizeFn = equalizeFn
+        self.onResult   = onResult
+        self.flag_drop_when_full = flag_drop_when_full
+        self.flag_own_executor = executor is None
+        self.executor = (concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                         if executor is None else executor)
+        numBytes = metadata.numSamples * metadata.sampleWidth
+        self._ringBytes = [bytearray(numBytes) for _ in range(numBuffers)]
+        self.ring = [np.frombuffer(ringBytes, dtype=codesDtype(metadata))
+                     for ringBytes in self._ringBytes]
+        self.numBuffers = numBuffers
+        self._resetStats()
+
+    def _resetStats(self):
+        self.numCaptured  = 0
+        self.numProcessed = 0
+        self.numDropped   = 0
+        self.transferTime = 0.0
+        self.processTime  = 0.0
+        self.elapsedTime  = 0.0
+        self.maxReadyDepth = 0
+        self._freeSlots  = collections.deque(range(self.numBuffers))
+        self._readySlots = collections.deque()
+        self._changed = None
+
+    def stats(self):
+        return {"numBuffers": self.numBuffers,
+                "freeDepth": len(self._freeSlots), "readyDepth": len(self._readySlots),
+                "maxReadyDepth": self.maxReadyDepth,
+                "captured": self.numCaptured, "processed": self.numProcessed,
+                "dropped": self.numDropped,
+                "transferSeconds": self.transferTime, "processSeconds": self.processTime,
+                "capturesPerSecond": (self.numProcessed / self.elapsedTime
+                                      if self.elapsedTime > 0.0 else 0.0)}
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _takeFreeSlot(self):
+        # Free slot for the next capture, or the slot of a dropped capture, see Note 1.
+        while True:
+            if self._freeSlots:
+                return self._freeSlots.popleft()
+            if self.flag_drop_when_full and self._readySlots:
+                self.numDropped += 1
+                return self._readySlots.popleft()[1]
+            await self._changed.wait()
+
+    async def _acquireLoop(self, numCaptures):
+        for captureIndex in range(numCaptures):
+            slot = await self._takeFreeSlot()
+            startTime = time.perf_counter()
+            await self.client.queryBlock(":WAV:DATA?", self._ringBytes[slot])
+            self.transferTime += time.perf_counter() - startTime
+            self.numCaptured += 1
+            self._readySlots.append((captureIndex, slot))
+            self.maxReadyDepth = max(self.maxReadyDepth, len(self._readySlots))
+            self._notify()
+
+    async def _processLoop(self, acquireTask):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._readySlots:
+                if acquireTask.done():
+                    return
+                await self._changed.wait()
+                continue
+            captureIndex, slot = self._readySlots.popleft()
+            startTime = time.perf_counter()
+            output = await loop.run_in_executor(self.executor, self.equalizeFn, self.ring[slot])
+            self.processTime += time.perf_counter() - startTime
+            self.numProcessed += 1
+            if self.onResult is not None:
+                self.onResult(captureIndex, output)
+            self._freeSlots.append(slot)
+            self._notify()
+
+    async def run(self, numCaptures):
+        # Acquires and equalizes "numCaptures" captures, returns the stats.
+        self._resetStats()
+        self._changed = asyncio.Event()
+        startTime = time.perf_counter()
+        acquireTask = asyncio.ensure_future(self._acquireLoop(numCaptures))
+        acquireTask.add_done_callback(lambda task: self._notify())
+        try:
+            await self._processLoop(acquireTask)
+        finally:
+            if not acquireTask.done():
+                acquireTask.cancel()
+        await acquireTask
+        self.elapsedTime = time.perf_counter() - startTime
+        return self.stats()
+
+    def close(self):
+        if self.flag_own_executor:
+            self.executor.shutdown()
+
+###########
+# Functions
+###########
+
+async def queryMetadata(client):
+    preambleBytes = bytes(await client.queryBlock(":WAV:PRE?"))
+    return parseWaveDescriptor(preambleBytes[skipBlockPrefix(preambleBytes):])
+
+def makeEqualizeFunction(profile, metadata, sampleRate = None, planCache = None, **kwargs):
+    # Returns a function of the codes that converts them to Volts and
+    # equalizes them with a cached plan.
+    if sampleRate is None:
+        sampleRate = 1.0 / metadata.sampleInterval
+    if planCache is None:
+        planCache = EqualizerPlanCache()
+
+    def equalize(codes):
+        plan = planCache.getPlan(profile, sampleRate, codes.size, **kwargs)
+        return equalizeWithPlan(codesToVolts(codes, metadata), plan)
+    return equalize
+
+async def runSequential(client, metadata, equalizeFn, numCaptures):
+    # The transfer and the equalization one after the other, for comparison.
+    buffer = bytearray(metadata.numSamples * metadata.sampleWidth)
+    codes = np.frombuffer(buffer, dtype=codesDtype(metadata))
+    startTime = time.perf_counter()
+    for _ in range(numCaptures):
+        await client.queryBlock(":WAV:DATA?", buffer)
+        equalizeFn(codes)
+    return numCaptures / (time.perf_counter() - startTime)
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    from simulated_scpi_scope import SimulatedScope, SimulatedScopeServer
+
+    async def main(host, port, profile):
+        client = await AsyncSCPIClient.connect(host, port)
+        try:
+            print("...", await client.query("*IDN?"))
+            metadata = await queryMetadata(client)
+            equalizeFn = makeEqualizeFunction(profile, metadata)
+            equalizeFn(np.zeros(metadata.numSamples, dtype=codesDtype(metadata)))
+            sequentialRate = await runSequential(client, metadata, equalizeFn, numCaptures)
+            pipeline = AsyncAcquisitionPipeline(client, metadata, equalizeFn)
+            stats = await pipeline.run(numCaptures)
+            pipeline.close()
+            print("...sequential captures/s: %.2f" % sequentialRate,
+                  " pipelined captures/s: %.2f" % stats["capturesPerSecond"])
+            print("...", stats)
+        finally:
+            client.close()
+
+    print("\nStarting...")
+    profile = AttenuationProfile.fromCSVFile(pathTables, CSVFile_defaultTable)
+    numCaptures = 20
+    scope = SimulatedScope(profile, numPoints=1_000_000, noiseVolts=0.002)
+    with SimulatedScopeServer(scope, linkBandwidth=20e6, linkLatency=0.001) as server:
+        asyncio.run(main(server.host, server.port, profile))
+    print("...end\n")
@@ -0,0 +1,201 @@
+# Name: attenuation_profile.py
+# Description: Immutable compiled attenuation profile of a scope, with
+#              vectorized frequency lookup.
+#              The profile is built only once from the "mapToFreq_and_dB()"
+#              output or from one of the "dbVAttenuationTable_*" CSV files.
+#              It holds contiguous float64 arrays of frequency (MHz), of
+#              attenuation (dBV) and optionally of the phase-shift (degrees),
+#              with the synthetic 0 Hz and -100 dBV end points already applied.
+#              "profile.db(freqs)" and "profile.volt_factor(freqs)" accept a
+#              scalar or an array with millions of frequencies and make one
+#              single vectorized interpolation.
+#
+# Note 1: The synthetic end points are the same ones that were used by
+#         "calcFixedStepInterpolAttenuationTable()":
+#           -One point at 0 MHz with 0.0 dBV, in the beginning.
+#           -One point 1 MHz past the last real value with -100 dBV.
+#           -One point at 1 GHz with -100 dBV.
+#         They are only added when the table doesn't already cover that
+#         range, so that the already interpolated tables (0 Hz to 1 GHz) are
+#         loaded as they are.
+#
+# Note 2: The phase-shift is the phase of the scope response in degrees,
+#         a signal delay is a negative phase.
+#
+# License:        MIT Open Source License
+#
+
+import csv
+import hashlib
+import numpy as np
+
+###########
+# Constants
+###########
+
+START_FREQ_MHz     = 0.0
+START_dBV          = 0.0
+END_FREQ_DELTA_MHz = 1.0
+END_FREQ_MHz       = 1000.0
+END_dBV            = -100.0
+
+PHASE_COLUMN_NAME = "Phase degrees"
+
+#########
+# Classes
+#########
+
+class AttenuationProfile:
+
+    __slots__ = ("freqMHz", "dBV", "phaseDeg", "_fingerprint")
+
+    def __init__(self, freqMHz, dBV, phaseDeg = None, flag_add_end_points = False):
+        # Param: freqMHz must be in increasing order.
+        # Note: Read only float64 arrays (ex: memory-mapped columns) are not
+        #       copied, the others are copied so that the profile can't change.
+        freqMHz = toReadOnlyFloat64(freqMHz)
+        dBV     = toReadOnlyFloat64(dBV)
+        if phaseDeg is not None:
+            phaseDeg = toReadOnlyFloat64(phaseDeg)
+        if freqMHz.ndim != 1 or freqMHz.shape != dBV.shape:
+            raise ValueError("freqMHz and dBV must be 1D arrays with the same length.")
+        if phaseDeg is not None and phaseDeg.shape != freqMHz.shape:
+            raise ValueError("phaseDeg must have the same length of freqMHz.")
+        if freqMHz.size == 0:
+            raise ValueError("An attenuation profile needs at least one point.")
+        if np.any(np.diff(freqMHz) < 0.0):
+            raise ValueError("freqMHz must be in increasing order.")
+        if flag_add_end_points == True:
+            freqMHz, dBV, phaseDeg = addSyntheticEndPoints(freqMHz, dBV, phaseDeg)
+        freqMHz = np.ascontiguousarray(freqMHz)
+        dBV     = np.ascontiguousarray(dBV)
+        if phaseDeg is not None:
+            phaseDeg = np.ascontiguousarray(phaseDeg)
+        for array in (freqMHz, dBV, phaseDeg):
+            if array is not None:
+                array.flags.writeable = False
+        object.__setattr__(self, "freqMHz", freqMHz)
+        object.__setattr__(self, "dBV", dBV)
+        object.__setattr__(self, "phaseDeg", phaseDeg)
+        object.__setattr__(self, "_fingerprint", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("AttenuationProfile is immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("AttenuationProfile is immutable.")
+
+    def __reduce__(self):
+        # Pickle support (ex: to send the profile to the worker processes).
+        return (AttenuationProfile, (self.freqMHz, self.dBV, self.phaseDeg))
+
+    def __len__(self):
+        return self.freqMHz.size
+
+    def __repr__(self):
+        return ("AttenuationProfile(points=%d, freq=%.4f..%.4f MHz, phase=%s)" %
+                (len(self), self.freqMHz[0], self.freqMHz[-1], self.hasPhase()))
+
+    @classmethod
+    def fromMappedPointsPairLst(cls, mappedPointsPairLst):
+        # Builds the profile from the "mapToFreq_and_dB()" output,
+        # rows of [freq, dBV, voltScaleFactor, x, y].
+        table = np.array([point[:2] for point in mappedPointsPairLst], dtype=np.float64)
+        return cls(table[:, 0], table[:, 1], flag_add_end_points = True)
+
+    @classmethod
+    def fromCSVFile(cls, inputPath, fileName):
+        # Builds the profile from a "dbVAttenuationTable_*" CSV file, the first
+        # two columns are "Frequency MHz" and "Attenuation dBV". If there is a
+        # column named "Phase degrees" it's also loaded.
+        with open(inputPath + fileName, mode='r', newline='') as csvFile:
+            headerRow = next(csv.reader(csvFile, delimiter=',', quotechar='"'))
+            table = np.loadtxt(csvFile, delimiter=',', dtype=np.float64, ndmin=2)
+        phaseDeg = None
+        if PHASE_COLUMN_NAME in headerRow:
+            phaseDeg = table[:, headerRow.index(PHASE_COLUMN_NAME)]
+        return cls(table[:, 0], table[:, 1], phaseDeg, flag_add_end_points = True)
+
+    def hasPhase(self):
+        return self.phaseDeg is not None
+
+    def db(self, freqs):
+        # Interpolated attenuation in dBV for the frequencies in MHz.
+        # Returns a float for a scalar frequency and an array for an array.
+        result = np.interp(freqs, self.freqMHz, self.dBV)
+        return float(result) if np.ndim(result) == 0 else result
+
+    def volt_factor(self, freqs):
+        # Interpolated Volts scale factor for the frequencies in MHz.
+        return calculateVoltfactorArray(self.db(freqs))
+
+    def phase_deg(self, freqs):
+        # Interpolated phase-shift in degrees for the frequencies in MHz, it's
+        # zero when the profile has no phase information.
+        if self.phaseDeg is None:
+            result = np.zeros(np.shape(freqs), dtype=np.float64)
+        else:
+            result = np.interp(freqs, self.freqMHz, self.phaseDeg)
+        return float(result) if np.ndim(result) == 0 else result
+
+    def fixedStepFreqs(self, freqStep, freqRange):
+        # Param: freqRange is a tuple "(startFreq, endFreq)".
+        # The same frequencies of the original per frequency loop.
+        startFreq, endFreq = freqRange
+        numIntervals = int((endFreq - startFreq + freqStep) / freqStep)
+        return startFreq + freqStep * np.arange(numIntervals, dtype=np.float64)
+
+    def fixedStepTable(self, freqStep, freqRange):
+        # Returns the (freq, dBV, voltScaleFactor) arrays of the fixed step
+        # interpolated table, calculated in one single call.
+        freqs = self.fixedStepFreqs(freqStep, freqRange)
+        dBV = self.db(freqs)
+        return (freqs, dBV, calculateVoltfactorArray(dBV))
+
+    def fingerprint(self):
+        # Content hash of the profile, used as a key in caches.
+        if self._fingerprint is None:
+            sha = hashlib.sha1()
+            for array in (self.freqMHz, self.dBV, self.phaseDeg):
+                if array is not None:
+                    sha.update(array.tobytes())
+                sha.update(b"|")
+            object.__setattr__(self, "_fingerprint", sha.hexdigest())
+        return self._fingerprint
+
+###########
+# Functions
+###########
+
+def toReadOnlyFloat64(values):
+    array = np.asarray(values, dtype=np.float64)
+    array = array.view() if not array.flags.writeable else array.copy()
+    array.flags.writeable = False
+    return array
+
+def calculateVoltfactorArray(dBV):
+    # Vectorized version of "calculateVoltfactor()", Volts = 10 ^ ( dBV/20 ).
+    result = np.power(10.0, np.asarray(dBV, dtype=np.float64) / 20.0)
+    return float(result) if np.ndim(result) == 0 else result
+
+def addSyntheticEndPoints(freqMHz, dBV, phaseDeg = None):
+    # Extend the range from 0Hz up to 1000MHz, so that interpolation work well.
+    # See Note 1.
+    headFreq, head_dBV = [], []
+    tailFreq, tail_dBV = [], []
+    if freqMHz[0] > START_FREQ_MHz:
+        headFreq, head_dBV = [START_FREQ_MHz], [START_dBV]
+    if freqMHz[-1] < END_FREQ_MHz:
+        tailFreq = [freqMHz[-1] + END_FREQ_DELTA_MHz]
+        tail_dBV = [END_dBV]
+        if tailFreq[0] < END_FREQ_MHz:
+            tailFreq.append(END_FREQ_MHz)
+            tail_dBV.append(END_dBV)
+    freqMHz = np.concatenate((headFreq, freqMHz, tailFreq))
+    dBV     = np.concatenate((head_dBV, dBV, tail_dBV))
+    if phaseDeg is not None:
+        # The phase is 0 at 0 Hz and kept constant in the synthetic tail points.
+        phaseDeg = np.concatenate(([0.0] * len(headFreq), phaseDeg,
+                                   np.repeat(phaseDeg[-1:], len(tailFreq))))
+    return (freqMHz, dBV, phaseDeg)
+
@@ -0,0 +1,273 @@
+# Name: attenuation_smoothing.py
+# Description: Smoothing of the extracted attenuation curves.
+#              The curves that "mapToFreq_and_dB()" extracts from the scope
+#              image are quantized to the pixels, they have half pixel steps
+#              that become ripple in the inverse filter of the equalizer.
+#              It has, all vectorized over NumPy arrays:
+#                -Running average, O(n) with a cumulative sum.
+#                -Savitzky-Golay, local polynomial fit, that keeps the shape
+#                 of the peaks better then the running average.
+#                -Monotone preserving smoothing, for the curves that only go
+#                 down (or up), the result never has ripple.
+#                -"StreamingSmoother", the running average and the
+#                 Savitzky-Golay for sweep points that arrive in chunks, with
+#                 the same result of the batch functions.
+#
+# Note 1: The window sizes are in points and must be odd, the result of the
+#         point i is centered in it. Near the ends the running average uses a
+#         smaller centered window (so the end points are kept) and the
+#         Savitzky-Golay evaluates the polynomial fitted to the first (or
+#         last) window, the same as "scipy.signal.savgol_filter(mode='interp')".
+#
+# Note 2: The monotone smoothing is the midline of the largest monotone curve
+#         below the points and of the smallest monotone curve above them,
+#         that is monotone, followed by a running average, that keeps it
+#         monotone. It needs all the points, so there is no streaming version.
+#
+# Note 3: The smoothing works over the point index, the points should be
+#         almost equally spaced in frequency, like the extracted points (one
+#         for each pixel column) or the fixed step tables.
+#
+# License:        MIT Open Source License
+#
+
+import functools
+import time
+import numpy as np
+
+from attenuation_profile import AttenuationProfile
+
+################
+# Configurations
+################
+
+pathTables = ".//output_out//"
+CSVFile_originalFreq = "dbVAttenuationTable_OriginalFreq_0_to_1_GHz.csv"
+
+defaultWindowSize = 9
+defaultPolyOrder  = 2
+
+###########
+# Constants
+###########
+
+RUNNING_AVERAGE = "RUNNING_AVERAGE"
+SAVITZKY_GOLAY  = "SAVITZKY_GOLAY"
+MONOTONE        = "MONOTONE"
+
+###########
+# Functions
+###########
+
+def checkWindowSize(windowSize):
+    if windowSize < 1 or windowSize % 2 == 0:
+        raise ValueError("The window size must be an odd positive number.")
+
+def runningAverage(values, windowSize = defaultWindowSize):
+    # Centered running average, see Note 1.
+    checkWindowSize(windowSize)
+    values = np.asarray(values, dtype=np.float64)
+    numPoints = values.size
+    halfWindow = min(windowSize // 2, (numPoints - 1) // 2)
+    if halfWindow <= 0:
+        return values.copy()
+    cumSum = np.concatenate(([0.0], np.cumsum(values)))
+    result = np.empty(numPoints, dtype=np.float64)
+    width = 2 * halfWindow + 1
+    result[halfWindow:numPoints - halfWindow] = (cumSum[width:] - cumSum[:-width]) / width
+    # Ends, centered windows of 1, 3, 5, ... points.
+    edgeWidths = 2 * np.arange(halfWindow) + 1
+    result[:halfWindow] = cumSum[edgeWidths] / edgeWidths
+    result[numPoints - halfWindow:] = ((cumSum[-1] - cumSum[numPoints - edgeWidths]) /
+                                       edgeWidths)[::-1]
+    return result
+
+@functools.lru_cache(maxsize=32)
+def savitzkyGolayMatrices(windowSize, polyOrder):
+    # Returns (center coefficients, projection matrix). The projection matrix
+    # maps the points of a window to the fitted polynomial at the same points.
+    if polyOrder >= windowSize:
+        raise ValueError("The polynomial order must be smaller then the window size.")
+    positions = np.arange(windowSize, dtype=np.float64) - windowSize // 2
+    vandermonde = np.vander(positions, polyOrder + 1, increasing=True)
+    projection = vandermonde @ np.linalg.pinv(vandermonde)
+    coefficients = projection[windowSize // 2].copy()
+    for array in (coefficients, projection):
+        array.flags.writeable = False
+    return (coefficients, projection)
+
+def savitzkyGolay(values, windowSize = defaultWindowSize, polyOrder = defaultPolyOrder):
+    # Savitzky-Golay smoothing, see Note 1.
+    checkWindowSize(windowSize)
+    values = np.asarray(values, dtype=np.float64)
+    numPoints = values.size
+    if numPoints < windowSize:
+        # Not enough points for one window, one polynomial fit over all of them.
+        if numPoints <= polyOrder:
+            return values.copy()
+        positions = np.arange(numPoints, dtype=np.float64)
+        return np.polyval(np.polyfit(positions, values, polyOrder), positions)
+    coefficients, projection = savitzkyGolayMatrices(windowSize, polyOrder)
+    halfWindow = windowSize // 2
+    result = np.empty(numPoints, dtype=np.float64)
+    # The coefficients are symmetric, the convolution doesn't need to flip them.
+    result[halfWindow:numPoints - halfWindow] = np.convolve(values, coefficients, mode='valid')
+    result[:halfWindow] = (projection @ values[:windowSize])[:halfWindow]
+    result[numPoints - halfWindow:] = (projection @ values[-windowSize:])[windowSize - halfWindow:]
+    return result
+
+def monotoneSmooth(values, windowSize = defaultWindowSize, flag_increasing = None):
+    # Monotone preserving smoothing, see Note 2.
+    # Param: flag_increasing None chooses the direction from the end points.
+    values = np.asarray(values, dtype=np.float64)
+    if values.size == 0:
+        return values.copy()
+    if flag_increasing is None:
+        flag_increasing = values[-1] >= values[0]
+    if flag_increasing:
+        lower = np.minimum.accumulate(values[::-1])[::-1]
+        upper = np.maximum.accumulate(values)
+    else:
+        lower = np.minimum.accumulate(values)
+        upper = np.maximum.accumulate(values[::-1])[::-1]
+    return runningAverage(0.5 * (lower + upper), windowSize)
+
+def smoothValues(values, method = SAVITZKY_GOLAY, windowSize = defaultWindowSize,
+                 polyOrder = defaultPolyOrder):
+    if method == RUNNING_AVERAGE:
+        return runningAverage(values, windowSize)
+    elif method == SAVITZKY_GOLAY:
+        return savitzkyGolay(values, windowSize, polyOrder)
+    elif method == MONOTONE:
+        return monotoneSmooth(values, windowSize)
+    raise ValueError("Unknown smoothing method: " + str(method))
+
+def smoothProfile(profile, method = SAVITZKY_GOLAY, windowSize = defaultWindowSize,
+                  polyOrder = defaultPolyOrder, freqRangeMHz = None):
+    # Returns a new profile with the dBV smoothed, the phase is kept.
+    # Param: freqRangeMHz "(startFreq, endFreq)", only the points in this range
+    #        are smoothed, ex: to keep the synthetic end points of the profiles
+    #        loaded from the CSV files out of the smoothing.
+    dBV = np.array(profile.dBV)
+    if freqRangeMHz is None:
+        inRange = slice(0, dBV.size)
+    else:
+        inRange = slice(np.searchsorted(profile.freqMHz, freqRangeMHz[0], side='left'),
+                        np.searchsorted(profile.freqMHz, freqRangeMHz[1], side='right'))
+    dBV[inRange] = smoothValues(dBV[inRange], method, windowSize, polyOrder)
+    return AttenuationProfile(profile.freqMHz, dBV, profile.phaseDeg)
+
+#########
+# Classes
+#########
+
+class StreamingSmoother:
+    # Running average or Savitzky-Golay of points that arrive in chunks.
+    # Each "push()" returns the smoothed points that are already final, that
+    # is, half window behind the last point received, "flush()" returns the
+    # rest. The concatenation of the results is the same of the batch functions.
+
+    def __init__(self, method = SAVITZKY_GOLAY, windowSize = defaultWindowSize,
+                 polyOrder = defaultPolyOrder):
+        checkWindowSize(windowSize)
+        if method not in (RUNNING_AVERAGE, SAVITZKY_GOLAY):
+            raise ValueError("Streaming smoothing is only available for %s and %s." %
+                             (RUNNING_AVERAGE, SAVITZKY_GOLAY))
+        self.method     = method
+        self.windowSize = windowSize
+        self.polyOrder  = polyOrder
+        if method == SAVITZKY_GOLAY:
+            self._kernel = savitzkyGolayMatrices(windowSize, polyOrder)[0]
+        else:
+            self._kernel = np.full(windowSize, 1.0 / windowSize)
+        self._reset()
+
+    def _reset(self):
+        self._tail = np.empty(0, dtype=np.float64)
+        self._lastWindow = self._tail
+        self.numReceived = 0
+        self.numEmitted  = 0
+
+    def _batch(self, values):
+        return smoothValues(values, self.method, self.windowSize, self.polyOrder)
+
+    def push(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        buffer = np.concatenate((self._tail, values))
+        self.numReceived += values.size
+        halfWindow = self.windowSize // 2
+        outputLst = []
+        if self.numEmitted == 0:
+            if self.numReceived < self.windowSize:
+                self._tail = buffer
+                return np.empty(0, dtype=np.float64)
+            # The first points use the batch edge, see Note 1.
+            outputLst.append(self._batch(buffer[:self.windowSize])[:halfWindow])
+            self.numEmitted = halfWindow
+        elif buffer.size < self.windowSize:
+            # An empty or short chunk, there is no new complete window yet.
+            self._tail = buffer
+            return np.empty(0, dtype=np.float64)
+        outputLst.append(np.convolve(buffer, self._kernel, mode='valid'))
+        self.numEmitted += outputLst[-1].size
+        self._tail = buffer[buffer.size - (self.windowSize - 1):]
+        self._lastWindow = buffer[buffer.size - self.windowSize:]
+        return np.concatenate(outputLst)
+
+    def flush(self):
+        # Returns the last half window of points and resets the smoother.
+        halfWindow = self.windowSize // 2
+        if self.numEmitted == 0:
+            output = self._batch(self._tail)
+        else:
+            output = self._batch(self._lastWindow)[self.windowSize - halfWindow:]
+        self._reset()
+        return output
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    print("\nStarting...")
+    table = np.loadtxt(pathTables + CSVFile_originalFreq, delimiter=',', skiprows=1, ndmin=2)
+    dBV = table[:, 1]
+
+    def ripple(values):
+        # RMS of the second difference, the half pixel steps.
+        return np.sqrt(np.mean(np.diff(values, 2) ** 2))
+
+    print("...extracted points:", dBV.size, " ripple dB: %.5f" % ripple(dBV))
+    for method in (RUNNING_AVERAGE, SAVITZKY_GOLAY, MONOTONE):
+        smoothed = smoothValues(dBV, method)
+        print("...%-16s ripple dB: %.5f  max change dB: %.4f" %
+              (method, ripple(smoothed), np.max(np.abs(smoothed - dBV))))
+
+    # Speed with a dense sweep, batch and streaming in chunks.
+    numPoints = 200_000
+    freqs = np.linspace(0.0, 1000.0, numPoints)
+    sweep = -20.0 * np.log10(1.0 + (freqs / 700.0) ** 4) / 2.0
+    sweep = np.round(sweep * 30.0) / 30.0
+    for method in (RUNNING_AVERAGE, SAVITZKY_GOLAY, MONOTONE):
+        startTime = time.perf_counter()
+        batch = smoothValues(sweep, method, windowSize=31)
+        elapsedTime = time.perf_counter() - startTime
+        print("...%-16s %d points in %.2f ms" % (method, numPoints, elapsedTime * 1e3))
+    smoother = StreamingSmoother(SAVITZKY_GOLAY, windowSize=31)
+    startTime = time.perf_counter()
+    streamed = np.concatenate([smoother.push(chunk) for chunk in np.array_split(sweep, 200)]
+                              + [smoother.flush()])
+    elapsedTime = time.perf_counter() - startTime
+    print("...streaming %d points in %.2f ms, max difference to batch: %.2e" %
+          (streamed.size, elapsedTime * 1e3,
+           np.max(np.abs(streamed - savitzkyGolay(sweep, 31)))))
+    # Chunks with empty and short ones, the same of the batch result.
+    for method, batchFunction in ((RUNNING_AVERAGE, runningAverage),
+                                  (SAVITZKY_GOLAY, savitzkyGolay)):
+        smoother = StreamingSmoother(method, windowSize=31)
+        chunks = [sweep[:50], [], sweep[50:51], sweep[51:60], [], sweep[60:1000], sweep[1000:]]
+        streamed = np.concatenate([smoother.push(chunk) for chunk in chunks] + [smoother.flush()])
+        print("...%-16s streaming with empty and short chunks, same of batch: %s" %
+              (method, streamed.size == sweep.size and
+               np.allclose(streamed, batchFunction(sweep, 31), atol=1e-9)))
+    print("...end\n")
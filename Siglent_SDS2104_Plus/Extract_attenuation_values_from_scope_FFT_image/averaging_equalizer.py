@@ -0,0 +1,246 @@
+# Name: averaging_equalizer.py
+# Description: Averaging accumulator that equalizes only once for a batch of
+#              triggered acquisitions of a repetitive signal.
+#              The equalization is linear, the equalized average is the same as
+#              the average of the equalized acquisitions, so the acquisitions
+#              are only summed into a running buffer, and the inverse response
+#              and the inverse FFT are applied when a result is asked. The cost
+#              of each trigger is then one addition of the record, not an FFT,
+#              and the throughput follows the acquisition rate.
+#              There are two domains:
+#                -DOMAIN_TIME, the time records, with the triggers aligned to
+#                 the sample, are summed. One rfft and one irfft per result.
+#                -DOMAIN_FREQUENCY, the spectra are summed, each acquisition
+#                 has one rfft, but the trigger offset of each acquisition
+#                 (the sub-sample trigger interpolation of the scope) can be
+#                 aligned by a phase ramp. One irfft per result.
+#              And two averaging modes:
+#                -AVERAGE_BLOCK, the average of each block of "numAverages"
+#                 acquisitions, the next acquisition starts a new block.
+#                -AVERAGE_EXPONENTIAL, the running average of the scope
+#                 "Average" acquisition mode, the weight of the new acquisition
+#                 is 1/n up to "numAverages" acquisitions and then 1/numAverages.
+#
+# Note 1: "addCodes()" sums the ADC codes directly, the conversion to Volts is
+#         also linear and it's applied only to the result.
+#
+# Note 2: A trigger offset of t seconds is removed by multiplying the spectrum
+#         by exp(+j * 2 * pi * f * t), a fractional delay without interpolation.
+#
+# Note 3: The result is cached until the next acquisition, asking it again
+#         costs nothing. In AVERAGE_BLOCK mode the result is the one of the last
+#         complete block, or of the current partial block if there isn't one.
+#
+# License:        MIT Open Source License
+#
+
+import time
+import numpy as np
+
+from attenuation_profile import AttenuationProfile
+from equalizer_plan_cache import EqualizerPlanCache, equalizeWithPlan
+from equalizer_response import defaultSampleRate, defaultMaxGain_dB
+from pipeline_instrumentation import timedStage, incrementCounter
+
+################
+# Configurations
+################
+
+pathTables = ".//output_out//"
+CSVFile_defaultTable = "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv"
+
+defaultNumAverages = 64
+
+###########
+# Constants
+###########
+
+DOMAIN_TIME      = "DOMAIN_TIME"
+DOMAIN_FREQUENCY = "DOMAIN_FREQUENCY"
+
+AVERAGE_BLOCK       = "AVERAGE_BLOCK"
+AVERAGE_EXPONENTIAL = "AVERAGE_EXPONENTIAL"
+
+#########
+# Classes
+#########
+
+class AveragingEqualizer:
+
+    def __init__(self, profile, numSamples, sampleRate = defaultSampleRate,
+                 numAverages = defaultNumAverages, averageMode = AVERAGE_EXPONENTIAL,
+                 domain = DOMAIN_TIME, maxGain_dB = defaultMaxGain_dB, passbandEdgeMHz = None,
+                 planCache = None):
+        if domain not in (DOMAIN_TIME, DOMAIN_FREQUENCY):
+            raise ValueError("Unknown averaging domain: " + str(domain))
+        if averageMode not in (AVERAGE_BLOCK, AVERAGE_EXPONENTIAL):
+            raise ValueError("Unknown averaging mode: " + str(averageMode))
+        if numAverages < 1:
+            raise ValueError("The number of averages must be at least 1.")
+        self.profile     = profile
+        self.numSamples  = numSamples
+        self.sampleRate  = sampleRate
+        self.numAverages = numAverages
+        self.averageMode = averageMode
+        self.domain      = domain
+        self.planCache = EqualizerPlanCache() if planCache is None else planCache
+        self.plan = self.planCache.getPlan(profile, sampleRate, numSamples, maxGain_dB,
+                                           passbandEdgeMHz)
+        dtype = np.float64 if domain == DOMAIN_TIME else np.complex128
+        size  = numSamples if domain == DOMAIN_TIME else numSamples // 2 + 1
+        self._average = np.zeros(size, dtype=dtype)
+        self._work    = np.empty(size, dtype=dtype)
+        self._completedBlock = None
+        self._binFreqsHz = None
+        self.numFFTs = 0
+        self.reset()
+
+    def reset(self):
+        self._average[...] = 0.0
+        self._completedBlock = None
+        self._count = 0
+        self._codesMetadata = None
+        self._flag_codes = None
+        self._result = None
+        self.numAcquisitions = 0
+        self.numResults = 0
+
+    def _accumulate(self, values):
+        # Running mean, in place, with the weight of the averaging mode.
+        if self.averageMode == AVERAGE_BLOCK and self._count == self.numAverages:
+            self._completedBlock = self._average.copy()
+            self._count = 0
+        self._count += 1
+        if self.averageMode == AVERAGE_EXPONENTIAL:
+            weight = 1.0 / min(self._count, self.numAverages)
+        else:
+            weight = 1.0 / self._count
+        # average += weight * (values - average), without temporaries.
+        np.subtract(values, self._average, out=self._work)
+        self._work *= weight
+        self._average += self._work
+        self.numAcquisitions += 1
+        self._result = None
+
+    def _checkInputKind(self, flag_codes):
+        if self._flag_codes is not None and self._flag_codes != flag_codes:
+            raise ValueError("The codes and the Volts can't be mixed in the same average.")
+        self._flag_codes = flag_codes
+
+    def addRecord(self, volts, triggerOffset = 0.0):
+        # Adds an acquisition in Volts.
+        # Param: triggerOffset in seconds, only in DOMAIN_FREQUENCY, see Note 2.
+        self._checkInputKind(False)
+        self._add(volts, triggerOffset)
+
+    def addCodes(self, codes, metadata, triggerOffset = 0.0):
+        # Adds an acquisition in ADC codes, see Note 1.
+        if self._codesMetadata is not None and \
+           (metadata.verticalGain, metadata.verticalOffset, metadata.codePerDiv) != \
+           (self._codesMetadata.verticalGain, self._codesMetadata.verticalOffset,
+            self._codesMetadata.codePerDiv):
+            raise ValueError("The vertical scale changed, the average must be reset.")
+        self._checkInputKind(True)
+        self._codesMetadata = metadata
+        self._add(codes, triggerOffset)
+
+    def _add(self, values, triggerOffset):
+        if len(values) != self.numSamples:
+            raise ValueError("The acquisition has %d samples, not %d." %
+                             (len(values), self.numSamples))
+        if self.domain == DOMAIN_TIME:
+            if triggerOffset != 0.0:
+                raise ValueError("The trigger offset needs DOMAIN_FREQUENCY.")
+            self._accumulate(values)
+            return
+        spectrum = np.fft.rfft(values)
+        self.numFFTs += 1
+        if triggerOffset != 0.0:
+            if self._binFreqsHz is None:
+                self._binFreqsHz = np.fft.rfftfreq(self.numSamples, 1.0 / self.sampleRate)
+            spectrum *= np.exp(2j * np.pi * self._binFreqsHz * triggerOffset)
+        self._accumulate(spectrum)
+
+    def isBlockComplete(self):
+        return self._completedBlock is not None or (self.averageMode == AVERAGE_BLOCK and
+                                                   self._count == self.numAverages)
+
+    @timedStage("averaging_equalizer_result")
+    def result(self):
+        # The equalized average in Volts, see Note 3.
+        if self.numAcquisitions == 0:
+            raise ValueError("There are no acquisitions.")
+        if self._result is not None:
+            return self._result
+        average = self._average
+        if self.averageMode == AVERAGE_BLOCK and self._count < self.numAverages and \
+           self._completedBlock is not None:
+            average = self._completedBlock
+        if self.domain == DOMAIN_TIME:
+            output = equalizeWithPlan(average, self.plan)
+            self.numFFTs += 2
+        else:
+            output = np.fft.irfft(average * self.plan, self.numSamples)
+            self.numFFTs += 1
+        if self._flag_codes:
+            # The codes to Volts conversion is linear, see Note 1.
+            metadata = self._codesMetadata
+            output *= metadata.verticalGain / metadata.codePerDiv
+            output -= metadata.verticalOffset
+        incrementCounter("averaging_equalizer_results")
+        self.numResults += 1
+        self._result = output
+        return output
+
+    def stats(self):
+        return {"acquisitions": self.numAcquisitions, "results": self.numResults,
+                "ffts": self.numFFTs, "countInAverage": self._count,
+                "averageMode": self.averageMode, "domain": self.domain}
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    from simulated_scpi_scope import SimulatedScope
+    from waveform_io import codesToVolts
+    print("\nStarting...")
+    profile = AttenuationProfile.fromCSVFile(pathTables, CSVFile_defaultTable)
+    numSamples = 1_000_000
+    numAcquisitions = 64
+    scope = SimulatedScope(profile, numPoints=numSamples, noiseVolts=0.02)
+    metadata = scope.metadata()
+    acquisitions = []
+    for _ in range(numAcquisitions):
+        scope.acquire()
+        acquisitions.append(scope.codes().copy())
+    clean = scope.capturedRecord()
+    planCache = EqualizerPlanCache()
+    plan = planCache.getPlan(profile, scope.sampleRate, numSamples)
+    target = equalizeWithPlan(clean, plan)
+
+    # Equalize each acquisition and average the results.
+    startTime = time.perf_counter()
+    perTrigger = np.zeros(numSamples)
+    for codes in acquisitions:
+        perTrigger += equalizeWithPlan(codesToVolts(codes, metadata), plan)
+    perTrigger /= numAcquisitions
+    elapsedTime = time.perf_counter() - startTime
+    print("...equalize each trigger: %6.1f acquisitions/s  RMS error to clean mV: %.3f" %
+          (numAcquisitions / elapsedTime, np.sqrt(np.mean((perTrigger - target) ** 2)) * 1e3))
+
+    for domain in (DOMAIN_TIME, DOMAIN_FREQUENCY):
+        for averageMode in (AVERAGE_BLOCK, AVERAGE_EXPONENTIAL):
+            averager = AveragingEqualizer(profile, numSamples, scope.sampleRate, numAcquisitions,
+                                          averageMode, domain, planCache=planCache)
+            startTime = time.perf_counter()
+            for codes in acquisitions:
+                averager.addCodes(codes, metadata)
+            output = averager.result()
+            elapsedTime = time.perf_counter() - startTime
+            print("...%-16s %-19s %6.1f acquisitions/s  RMS error to clean mV: %.3f  "
+                  "difference to per trigger: %.2e  FFTs: %d" %
+                  (domain, averageMode, numAcquisitions / elapsedTime,
+                   np.sqrt(np.mean((output - target) ** 2)) * 1e3,
+                   np.max(np.abs(output - perTrigger)), averager.numFFTs))
+    print("...end\n")
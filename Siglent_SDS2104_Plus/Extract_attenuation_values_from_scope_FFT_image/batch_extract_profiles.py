@@ -0,0 +1,219 @@
+# Name: batch_extract_profiles.py
+# Description: Batch command that converts a directory of scope FFT screenshots
+#              into attenuation profiles, to run unattended over the dozens of
+#              probe / cable combinations that are characterized.
+#              Instead of editing the module globals of
+#              "extract_attenuation_values_from_scope_fft_image.py", the search
+#              zones, the trace color and the grid calibration are read from a
+#              per scope JSON (or YAML, if PyYAML is installed) config file.
+#              The extraction, the mapping to frequency and dBV and the table
+#              generation run for each image in a process pool, and one profile
+#              is written for each image.
+#
+# Usage:
+#   python batch_extract_profiles.py <images_dir> [--config scope.json]
+#          [--output <output_dir>] [--pattern "*.png"] [--workers N]
+#
+# Config file keys (all optional, the defaults are the values of the
+# SDS2354X Plus image in the extractor module, see the example config file
+# "batch_config_SDS2354Xplus_2GSa_8bit_1GHz.json"):
+#   "traceColor":      "B014E8"
+#   "colorTolerance":  0
+#   "zones":           [[34, 110, 82, 157], [83, 110, 872, 530]]
+#   "graphMinX":       18      (the 0 Hz X position, the first point extension
+#                               stops one pixel to the right of it)
+#   "graphMaxY":       530     (the bottom line of the graph, debug markers)
+#   "gridY":           [[104, -12.0], ..., [585, -28.0]]  (pos Y, dBV)
+#   "gridX":           [[18, 0.0], ..., [872, 1000.0]]    (pos X, MHz)
+#   "extendStartingPoints": true
+#   "fixedSteps":      [10.0, 1.0]      (MHz)
+#   "freqRange":       [0.0, 1000.0]    (MHz)
+#
+# Output, for each image "<name>.png":
+#   <output_dir>/<name>/dbVAttenuationTable_OriginalFreq.csv
+#   <output_dir>/<name>/dbVAttenuationTable_interpol_<step>M_step.csv
+#   <output_dir>/<name>/<name>.ofrp   (binary profile, "binary_profile_format.py")
+#
+# Note: The mapping rules are the same ones of "startingPointsExtender()" and
+#       "mapToFreq_and_dB()", with the config values in the place of the
+#       module globals. The 0 dBV reference is the point of the list at the
+#       index "zones[0][0] - graphMinX + 1".
+#
+# License:        MIT Open Source License
+#
+
+import argparse
+import concurrent.futures
+import fnmatch
+import json
+import os
+import time
+import numpy as np
+from PIL import Image
+
+import extract_attenuation_values_from_scope_fft_image as extractor
+from attenuation_profile import AttenuationProfile
+from pipeline_instrumentation import timedStage
+from binary_profile_format import writeBinaryProfileFile, binaryProfileExtension
+from vectorized_trace_extractor import loadImageArray, extractTracePixelPos, hexColorToRGB
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+###########
+# Constants
+###########
+
+CSVFile_OriginalFreq = "dbVAttenuationTable_OriginalFreq.csv"
+CSVFile_FixedStep    = "dbVAttenuationTable_interpol_%sM_step.csv"
+
+###########
+# Functions
+###########
+
+def defaultScopeConfig():
+    # The config of the image of the extractor module.
+    return {"traceColor": "%02X%02X%02X" % (extractor.signalColorR, extractor.signalColorG,
+                                            extractor.signalColorB),
+            "colorTolerance": extractor.signalColorTolerance,
+            "zones": [list(zone) for zone in extractor.zoneLst],
+            "graphMinX": extractor.minX_GraphLimit,
+            "graphMaxY": extractor.maxY_GraphLimit,
+            "gridY": [[posY, dBV] for posY, dBV, _ in extractor.posY_dBV_table],
+            "gridX": [[posX, freq] for posX, freq, _ in extractor.posX_freq_table],
+            "extendStartingPoints": True,
+            "fixedSteps": [10.0, 1.0],
+            "freqRange": [0.0, 1000.0]}
+
+def loadScopeConfig(fileName):
+    # Loads a JSON or YAML config file, merged over the default config.
+    config = defaultScopeConfig()
+    if fileName is None:
+        return config
+    with open(fileName, mode='r') as configFile:
+        if fileName.lower().endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise RuntimeError("PyYAML is needed to read YAML config files: " + fileName)
+            userConfig = yaml.safe_load(configFile)
+        else:
+            userConfig = json.load(configFile)
+    unknownKeys = set(userConfig) - set(config)
+    if unknownKeys:
+        raise ValueError("Unknown config keys: " + ", ".join(sorted(unknownKeys)))
+    config.update(userConfig)
+    return config
+
+@timedStage()
+def extendStartingPoints(pointsPairLst, graphMinX):
+    # Same as "startingPointsExtender()".
+    endValueX, valueY = pointsPairLst[0]
+    extension = [[x, valueY] for x in range(graphMinX + 2, endValueX + 1)]
+    return extension + pointsPairLst
+
+@timedStage()
+def mapPointsToFreq_and_dB(pointsPairLst, config):
+    # Same as "mapToFreq_and_dB()", vectorized and with the config grid.
+    points = np.array(pointsPairLst, dtype=np.float64)
+    posX, posY = points[:, 0], points[:, 1]
+    (firstGridX, firstFreq), (lastGridX, lastFreq) = config["gridX"][0], config["gridX"][-1]
+    (firstGridY, first_dBV), (lastGridY, last_dBV) = config["gridY"][0], config["gridY"][-1]
+    pos_Y_zero_dBV_ref = pointsPairLst[config["zones"][0][0] - config["graphMinX"] + 1][1]
+    freq = firstFreq + ((posX - firstGridX) / float(lastGridX - firstGridX)) * (lastFreq - firstFreq)
+    dBV = ((posY - pos_Y_zero_dBV_ref) / float(lastGridY - firstGridY)) * (last_dBV - first_dBV)
+    # The Volts scale factor is calculated with "calculateVoltfactor()", so
+    # that the values are exactly the same of the extractor module.
+    return [[f, d, extractor.calculateVoltfactor(d), int(x), y] for f, d, x, y in
+            zip(freq.tolist(), dBV.tolist(), posX.tolist(), posY.tolist())]
+
+def formatStep(freqStep):
+    return ("%g" % freqStep).replace(".", "p")
+
+def extractImageProfile(imageFileName, config, pathOut):
+    # Extracts one image and writes its tables and profile.
+    # Returns a summary dictionary.
+    startTime = time.perf_counter()
+    with Image.open(imageFileName) as imgIn:
+        imgArrayIn = loadImageArray(imgIn)
+    pointsPairLst = extractTracePixelPos(imgArrayIn, config["zones"],
+                                         hexColorToRGB(config["traceColor"]),
+                                         config["colorTolerance"])
+    if len(pointsPairLst) == 0:
+        raise ValueError("No trace pixels found in the zones of: " + imageFileName)
+    if config["extendStartingPoints"] == True:
+        pointsPairLst = extendStartingPoints(pointsPairLst, config["graphMinX"])
+    mappedPointsPairLst = mapPointsToFreq_and_dB(pointsPairLst, config)
+    profile = AttenuationProfile.fromMappedPointsPairLst(mappedPointsPairLst)
+
+    name = os.path.splitext(os.path.basename(imageFileName))[0]
+    pathImageOut = os.path.join(pathOut, name) + os.sep
+    os.makedirs(pathImageOut, exist_ok=True)
+    extractor.writeToCSVFile(mappedPointsPairLst, pathImageOut, CSVFile_OriginalFreq,
+                             extractor.LONG_TABLE_MODE)
+    for freqStep in config["fixedSteps"]:
+        freqs, dBV, voltsFactor = profile.fixedStepTable(freqStep, tuple(config["freqRange"]))
+        fixedStepTable = zip(freqs.tolist(), dBV.tolist(), voltsFactor.tolist())
+        extractor.writeToCSVFile(fixedStepTable, pathImageOut,
+                                 CSVFile_FixedStep % formatStep(freqStep),
+                                 extractor.SHORT_TABLE_MODE)
+    writeBinaryProfileFile(profile, pathImageOut, name + binaryProfileExtension)
+    return {"image": imageFileName, "points": len(mappedPointsPairLst),
+            "dBV_at_last_point": mappedPointsPairLst[-1][1],
+            "seconds": time.perf_counter() - startTime}
+
+def _extractImageJob(job):
+    # Process pool worker, the errors are returned so that one bad image
+    # doesn't stop the batch.
+    imageFileName, config, pathOut = job
+    try:
+        return extractImageProfile(imageFileName, config, pathOut)
+    except Exception as exc:
+        return {"image": imageFileName, "error": repr(exc)}
+
+def findImages(pathImages, pattern):
+    return [os.path.join(pathImages, fileName) for fileName in sorted(os.listdir(pathImages))
+            if fnmatch.fnmatch(fileName, pattern)]
+
+def runBatch(imageFileLst, config, pathOut, numWorkers = None):
+    # Returns the list of summaries, in the order of the images.
+    jobs = [(imageFileName, config, pathOut) for imageFileName in imageFileLst]
+    if numWorkers == 1 or len(jobs) <= 1:
+        return [_extractImageJob(job) for job in jobs]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=numWorkers) as executor:
+        return list(executor.map(_extractImageJob, jobs))
+
+def parseArguments(argv = None):
+    parser = argparse.ArgumentParser(description="Batch extraction of attenuation profiles "
+                                                 "from scope FFT screenshots.")
+    parser.add_argument("pathImages", help="directory with the FFT screenshots")
+    parser.add_argument("--config", default=None, help="per scope JSON or YAML config file")
+    parser.add_argument("--output", default=extractor.pathOut + "batch", help="output directory")
+    parser.add_argument("--pattern", default="*.png", help="image file name pattern")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    return parser.parse_args(argv)
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    args = parseArguments()
+    print("\nStarting...")
+    config = loadScopeConfig(args.config)
+    imageFileLst = findImages(args.pathImages, args.pattern)
+    startTime = time.perf_counter()
+    summaryLst = runBatch(imageFileLst, config, args.output, args.workers)
+    numErrors = 0
+    for summary in summaryLst:
+        if "error" in summary:
+            numErrors += 1
+            print("...ERROR", summary["image"], summary["error"])
+        else:
+            print("...", summary["image"], " points:", summary["points"],
+                  " time: %.3f s" % summary["seconds"])
+    print("...%d images, %d errors, %.3f s" % (len(summaryLst), numErrors,
+                                               time.perf_counter() - startTime))
+    print("...end\n")
+    raise SystemExit(1 if numErrors > 0 else 0)
+
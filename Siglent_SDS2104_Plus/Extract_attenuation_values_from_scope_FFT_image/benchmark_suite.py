@@ -0,0 +1,229 @@
+# Name: benchmark_suite.py
+# Description: Benchmark suite of the extraction, interpolation, table
+#              generation and equalization code, to catch performance
+#              regressions before they reach the bench PCs.
+#              It times:
+#                -"processZone()" and "extractSignalPixelPos()" over the image
+#                 "SDS2354Xplus_2GSa_8bit_1GHz.png".
+#                -"getInterpolated_dB_for_freq()".
+#                -"calcFixedStepInterpolAttenuationTable()" with 10 MHz, 1 MHz
+#                 and 1 kHz steps.
+#                -The FFT equalization of synthetic records from 1 kpts to
+#                 100 Mpts, full record with a plan and streaming overlap-save.
+#              The results are written to a JSON file with the time, the
+#              throughput (pixels/s, frequencies/s, samples/s) and the peak
+#              memory of each benchmark. The compare mode checks the results
+#              against a saved baseline JSON.
+#
+# Usage:
+#   python benchmark_suite.py [--output bench.json] [--compare baseline.json]
+#          [--threshold 0.25] [--memory-threshold 0.25] [--max-samples 100000000]
+#          [--repeat 5]
+#
+# Note 1: The time is the best of "repeat" runs, the peak memory is measured
+#         by "tracemalloc" in one extra run (NumPy reports its allocations to
+#         tracemalloc).
+#
+# Note 2: In the compare mode the exit code is 1 when any benchmark is slower
+#         then the baseline by more then the threshold (0.25 is 25 %), or when
+#         its peak memory is larger by more then the memory threshold and by
+#         more then "minMemoryIncreaseBytes" (the peak of the small benchmarks
+#         is some kB and changes with the allocator).
+#
+# License:        MIT Open Source License
+#
+
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from PIL import Image
+
+import extract_attenuation_values_from_scope_fft_image as extractor
+from attenuation_profile import AttenuationProfile
+from equalizer_plan_cache import buildPlan, equalizeWithPlan
+from equalizer_response import defaultSampleRate
+from streaming_equalizer import StreamingEqualizer
+from vectorized_trace_extractor import loadImageArray
+
+################
+# Configurations
+################
+
+defaultRepeat     = 5
+defaultThreshold  = 0.25
+defaultMemoryThreshold = 0.25
+defaultMaxSamples = 100_000_000
+
+# Peak memory increases below this aren't regressions, see Note 2.
+minMemoryIncreaseBytes = 64 * 1024
+
+equalizationSizes = [1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000]
+
+# The streaming equalizer is only timed up to this size, it's the same code per block.
+streamingMaxSamples = 10_000_000
+
+pathBench = ".//"
+
+###########
+# Functions
+###########
+
+def timeFunction(function, repeat):
+    # Returns (best time in seconds, peak memory in bytes), see Note 1.
+    bestTime = float("inf")
+    for _ in range(repeat):
+        startTime = time.perf_counter()
+        function()
+        bestTime = min(bestTime, time.perf_counter() - startTime)
+    tracemalloc.start()
+    try:
+        function()
+        _, peakMemory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (bestTime, peakMemory)
+
+def addResult(results, name, function, repeat, numItems, unit):
+    seconds, peakMemory = timeFunction(function, repeat)
+    results[name] = {"seconds": seconds, "items": numItems, "unit": unit,
+                     "throughput": numItems / seconds if seconds > 0 else float("inf"),
+                     "peakMemoryBytes": peakMemory}
+    print("... %-44s %12.6f s  %12.4e %s  peak mem: %10d bytes" %
+          (name, seconds, results[name]["throughput"], unit, peakMemory))
+
+def loadImageFileArray(fileName):
+    with Image.open(fileName) as imgIn:
+        return loadImageArray(imgIn)
+
+def runExtractionBenchmarks(results, repeat):
+    with Image.open(extractor.pathImgIn + extractor.fileImgIn) as imgIn:
+        imgArrayIn = loadImageArray(imgIn)
+    for zoneIndex, zone in enumerate(extractor.zoneLst):
+        upperLeftX, upperLeftY, downRightX, downRightY = zone
+        numPixels = (downRightX - upperLeftX) * (downRightY - upperLeftY)
+        addResult(results, "processZone[zone_%d]" % (zoneIndex + 1),
+                  lambda zone = zone: extractor.processZone(imgArrayIn, None, zone),
+                  repeat, numPixels, "pixels/s")
+    numPixels = sum((zone[2] - zone[0]) * (zone[3] - zone[1]) for zone in extractor.zoneLst)
+    addResult(results, "extractSignalPixelPos",
+              lambda: extractor.extractSignalPixelPos(imgArrayIn, None, extractor.zoneLst),
+              repeat, numPixels, "pixels/s")
+    addResult(results, "loadImageArray",
+              lambda: loadImageFileArray(extractor.pathImgIn + extractor.fileImgIn),
+              repeat, imgArrayIn.shape[0] * imgArrayIn.shape[1], "pixels/s")
+    pointsPairLst = extractor.extractSignalPixelPos(imgArrayIn, None, extractor.zoneLst)
+    return extractor.startingPointsExtender(pointsPairLst)
+
+def runInterpolationBenchmarks(results, repeat, pointsPairLst):
+    # "mapToFreq_and_dB()" marks a debug pixel and prints, a dummy pixel map is used.
+    dummyPixelsOut = {}
+    mappedPointsPairLst = extractor.mapToFreq_and_dB(pointsPairLst, dummyPixelsOut)
+    numFreqs = 1000
+    freqs = np.linspace(0.0, 1000.0, numFreqs).tolist()
+    addResult(results, "getInterpolated_dB_for_freq",
+              lambda: [extractor.getInterpolated_dB_for_freq(mappedPointsPairLst, freq, False)
+                       for freq in freqs],
+              repeat, numFreqs, "freqs/s")
+    for freqStep, label in ((10.0, "10MHz"), (1.0, "1MHz"), (0.001, "1kHz")):
+        numFreqs = int((1000.0 + freqStep) / freqStep)
+        addResult(results, "calcFixedStepInterpolAttenuationTable[%s]" % label,
+                  lambda freqStep = freqStep: extractor.calcFixedStepInterpolAttenuationTable(
+                      mappedPointsPairLst, freqStep, (0.0, 1000.0), False),
+                  repeat, numFreqs, "freqs/s")
+    return AttenuationProfile.fromMappedPointsPairLst(mappedPointsPairLst)
+
+def runEqualizationBenchmarks(results, repeat, profile, maxSamples):
+    sampleRate = defaultSampleRate
+    streamingEqualizer = StreamingEqualizer.fromProfile(profile, sampleRate)
+    rng = np.random.default_rng(0)
+    for numSamples in equalizationSizes:
+        if numSamples > maxSamples:
+            break
+        samples = rng.standard_normal(numSamples).astype(np.float32)
+        # The big records are only timed once, each run takes seconds.
+        sizeRepeat = repeat if numSamples <= 1_000_000 else 1
+        plan = buildPlan(profile, sampleRate, numSamples)
+        addResult(results, "equalizeFullRecord[%d]" % numSamples,
+                  lambda: equalizeWithPlan(samples, plan), sizeRepeat, numSamples, "samples/s")
+        if numSamples <= streamingMaxSamples:
+            addResult(results, "equalizeStreaming[%d]" % numSamples,
+                      lambda: sum(chunk.size for chunk in
+                                  streamingEqualizer.equalizeArray(samples)),
+                      sizeRepeat, numSamples, "samples/s")
+        del samples, plan
+
+def compareWithBaseline(results, baseline, threshold, memoryThreshold = defaultMemoryThreshold):
+    # Returns the list of the regressed benchmark names, see Note 2.
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print("... %-44s new benchmark" % name)
+            continue
+        ratio = result["seconds"] / baseline[name]["seconds"]
+        memoryRatio = (result["peakMemoryBytes"] / baseline[name]["peakMemoryBytes"]
+                       if baseline[name]["peakMemoryBytes"] > 0 else 1.0)
+        memoryIncrease = result["peakMemoryBytes"] - baseline[name]["peakMemoryBytes"]
+        status = "ok"
+        if ratio > 1.0 + threshold or (memoryRatio > 1.0 + memoryThreshold and
+                                       memoryIncrease > minMemoryIncreaseBytes):
+            status = "REGRESSION"
+            regressions.append(name)
+        print("... %-44s time x%.3f  memory x%.3f  %s" % (name, ratio, memoryRatio, status))
+    return regressions
+
+def runBenchmarks(repeat = defaultRepeat, maxSamples = defaultMaxSamples):
+    results = {}
+    pointsPairLst = runExtractionBenchmarks(results, repeat)
+    profile = runInterpolationBenchmarks(results, repeat, pointsPairLst)
+    runEqualizationBenchmarks(results, repeat, profile, maxSamples)
+    return results
+
+def makeReport(results):
+    return {"meta": {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+                     "python": sys.version.split()[0], "numpy": np.__version__,
+                     "platform": platform.platform(), "machine": platform.machine()},
+            "results": results}
+
+def parseArguments(argv = None):
+    parser = argparse.ArgumentParser(description="Benchmark suite of the scope frequency "
+                                                 "response correction code.")
+    parser.add_argument("--output", default=pathBench + "bench_results.json",
+                        help="JSON file of the results")
+    parser.add_argument("--compare", default=None, help="baseline JSON file to compare with")
+    parser.add_argument("--threshold", type=float, default=defaultThreshold,
+                        help="max relative slow down allowed in the compare mode")
+    parser.add_argument("--memory-threshold", type=float, default=defaultMemoryThreshold,
+                        help="max relative peak memory increase allowed in the compare mode")
+    parser.add_argument("--max-samples", type=int, default=defaultMaxSamples,
+                        help="max size of the synthetic equalization records")
+    parser.add_argument("--repeat", type=int, default=defaultRepeat, help="runs of each benchmark")
+    return parser.parse_args(argv)
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    args = parseArguments()
+    print("\nStarting...")
+    results = runBenchmarks(args.repeat, args.max_samples)
+    with open(args.output, mode='w') as jsonFile:
+        json.dump(makeReport(results), jsonFile, indent=2)
+    print("...results written to", args.output)
+    exitCode = 0
+    if args.compare is not None:
+        with open(args.compare, mode='r') as jsonFile:
+            baseline = json.load(jsonFile)["results"]
+        regressions = compareWithBaseline(results, baseline, args.threshold,
+                                          args.memory_threshold)
+        if regressions:
+            print("...%d regressions: %s" % (len(regressions), ", ".join(regressions)))
+            exitCode = 1
+    print("...end\n")
+    raise SystemExit(exitCode)
+
@@ -0,0 +1,145 @@
+# Name: binary_profile_format.py
+# Description: Compact versioned binary file format for the attenuation
+#              profiles, with a memory-mapped loader, so that the startup of
+#              the correction service doesn't depend on the CSV parsing speed.
+#              It also has a converter from the existing "dbVAttenuationTable_*"
+#              CSV files in "output_out/".
+#
+# File layout (little endian):
+#
+#   Header with 64 bytes:
+#     offset  0: 8 bytes   magic "OFRCPROF"
+#     offset  8: uint16    format version
+#     offset 10: uint8     column item size in bytes, 4 (float32) or 8 (float64)
+#     offset 11: uint8     flags, bit 0 is set when there is a phase column
+#     offset 12: uint16    number of columns
+#     offset 14: uint16    reserved
+#     offset 16: uint64    number of points
+#     offset 24: 40 bytes  reserved, zeros
+#
+#   Columns, each one contiguous, in this order:
+#     Frequency MHz, Attenuation dBV, VoltsScaleFactor, [Phase degrees]
+#
+# Note 1: The loader memory-maps the columns block with "np.memmap()" and the
+#         columns are views over it, so there are zero copies. With float64
+#         files, the "AttenuationProfile" also uses the mapped arrays directly.
+#
+# Note 2: The stored profile is the compiled profile, with the synthetic
+#         0 Hz and -100 dBV end points already applied.
+#
+# License:        MIT Open Source License
+#
+
+import os
+import struct
+import numpy as np
+
+from attenuation_profile import AttenuationProfile, calculateVoltfactorArray
+
+################
+# Configurations
+################
+
+pathTables = ".//output_out//"
+binaryProfileExtension = ".ofrp"
+
+###########
+# Constants
+###########
+
+PROFILE_MAGIC   = b"OFRCPROF"
+PROFILE_VERSION = 1
+HEADER_SIZE     = 64
+HEADER_STRUCT   = struct.Struct("<8sHBBHHQ40x")
+
+FLAG_HAS_PHASE = 0x01
+
+COLUMN_NAMES = ["Frequency MHz", "Attenuation dBV", "VoltsScaleFactor", "Phase degrees"]
+
+ITEM_SIZE_TO_DTYPE = {4: np.dtype("<f4"), 8: np.dtype("<f8")}
+
+###########
+# Functions
+###########
+
+def writeBinaryProfileFile(profile, pathOut, fileName, dtype = np.float64):
+    # Writes an "AttenuationProfile" in the binary format, with float32 or
+    # float64 columns.
+    dtype = np.dtype(dtype).newbyteorder("<")
+    if dtype.itemsize not in ITEM_SIZE_TO_DTYPE or dtype.kind != "f":
+        raise ValueError("The binary profile columns must be float32 or float64.")
+    columns = [profile.freqMHz, profile.dBV, calculateVoltfactorArray(profile.dBV)]
+    flags = 0
+    if profile.hasPhase():
+        columns.append(profile.phaseDeg)
+        flags |= FLAG_HAS_PHASE
+    numPoints = len(profile)
+    header = HEADER_STRUCT.pack(PROFILE_MAGIC, PROFILE_VERSION, dtype.itemsize,
+                                flags, len(columns), 0, numPoints)
+    with open(pathOut + fileName, mode='wb') as binFile:
+        binFile.write(header)
+        for column in columns:
+            binFile.write(np.ascontiguousarray(column, dtype=dtype).tobytes())
+
+def readBinaryProfileHeader(inputPath, fileName):
+    # Returns the header as a dictionary.
+    with open(inputPath + fileName, mode='rb') as binFile:
+        headerBytes = binFile.read(HEADER_SIZE)
+    if len(headerBytes) != HEADER_SIZE:
+        raise ValueError("File too small to be a binary profile: " + fileName)
+    magic, version, itemSize, flags, numColumns, _, numPoints = HEADER_STRUCT.unpack(headerBytes)
+    if magic != PROFILE_MAGIC:
+        raise ValueError("Not a binary profile file: " + fileName)
+    if version != PROFILE_VERSION:
+        raise ValueError("Unsupported binary profile version %d: %s" % (version, fileName))
+    if itemSize not in ITEM_SIZE_TO_DTYPE:
+        raise ValueError("Unsupported column item size %d: %s" % (itemSize, fileName))
+    hasPhase = (flags & FLAG_HAS_PHASE) != 0
+    expectedColumns = 4 if hasPhase else 3
+    if numColumns != expectedColumns:
+        raise ValueError("Inconsistent number of columns %d: %s" % (numColumns, fileName))
+    return {"version": version, "dtype": ITEM_SIZE_TO_DTYPE[itemSize],
+            "hasPhase": hasPhase, "numColumns": numColumns, "numPoints": numPoints}
+
+def mapBinaryProfileFile(inputPath, fileName):
+    # Memory-maps the binary profile.
+    # Returns the tuple (header, columns) where columns is a dictionary with
+    # the column name as key and a read only array view as value.
+    header = readBinaryProfileHeader(inputPath, fileName)
+    expectedSize = (HEADER_SIZE + header["numColumns"] * header["numPoints"]
+                    * header["dtype"].itemsize)
+    if os.path.getsize(inputPath + fileName) < expectedSize:
+        raise ValueError("Truncated binary profile file: " + fileName)
+    block = np.memmap(inputPath + fileName, dtype=header["dtype"], mode='r',
+                      offset=HEADER_SIZE, shape=(header["numColumns"], header["numPoints"]))
+    columns = {COLUMN_NAMES[index]: block[index] for index in range(header["numColumns"])}
+    return (header, columns)
+
+def loadBinaryProfile(inputPath, fileName):
+    # Loads a binary profile file as an "AttenuationProfile".
+    header, columns = mapBinaryProfileFile(inputPath, fileName)
+    return AttenuationProfile(columns["Frequency MHz"], columns["Attenuation dBV"],
+                              columns.get("Phase degrees"))
+
+def convertCSVToBinaryProfile(inputPath, fileName, pathOut, dtype = np.float64):
+    # Converts a "dbVAttenuationTable_*" CSV file into a binary profile file,
+    # with the same name and the ".ofrp" extension. Returns the output file name.
+    profile = AttenuationProfile.fromCSVFile(inputPath, fileName)
+    fileNameOut = os.path.splitext(fileName)[0] + binaryProfileExtension
+    writeBinaryProfileFile(profile, pathOut, fileNameOut, dtype)
+    return fileNameOut
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    # Converts all the CSV attenuation tables in "output_out/".
+    print("\nStarting...")
+    for fileName in sorted(os.listdir(pathTables)):
+        if fileName.startswith("dbVAttenuationTable_") and fileName.endswith(".csv"):
+            fileNameOut = convertCSVToBinaryProfile(pathTables, fileName, pathTables)
+            profile = loadBinaryProfile(pathTables, fileNameOut)
+            print("...", fileNameOut, "generated,", len(profile), "points...")
+    print("...end\n")
+
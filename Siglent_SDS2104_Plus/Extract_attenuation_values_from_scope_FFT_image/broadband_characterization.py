@@ -0,0 +1,272 @@
+# Name: broadband_characterization.py
+# Description: Single shot characterization of the frequency response of the
+#              scope (or of a probe), with a broadband excitation, instead of
+#              the stepped sweeps of one frequency at a time that take an hour.
+#              The excitation is a logarithmic chirp or a multitone with low
+#              crest factor, and the magnitude and the phase of thousands of
+#              frequency bins are estimated from one or a few captures, by the
+#              H1 estimator, the averaged cross spectrum over the averaged
+#              excitation spectrum:
+#                  H1(f) = mean(conj(X) * Y) / mean(|X|^2)
+#              with the coherence, |Sxy|^2 / (Sxx * Syy), that tells which bins
+#              can be trusted.
+#              The result is an "AttenuationProfile", with phase, the same
+#              structure of the profiles of the extractor, and it can be written
+#              to a CSV file that "AttenuationProfile.fromCSVFile()" reads.
+#
+# Note 1: With a periodic excitation, one period of the excitation in each
+#         segment and a rectangular window, there is no leakage, each bin of
+#         the multitone is measured exactly. For the other cases use the Hann
+#         window with overlapped segments.
+#
+# Note 2: The multitone phases start with the Schroeder phases and are then
+#         improved by some iterations of clipping the peaks in the time domain
+#         and restoring the tone amplitudes in the frequency domain, this
+#         lowers the crest factor, so more power for the same ADC range.
+#
+# Note 3: In the simulated scope the excitation is the "AWG" signal, that is
+#         known exactly. With a real generator the excitation should be
+#         captured by a second channel, "Y / X" then cancels the generator
+#         response.
+#
+# License:        MIT Open Source License
+#
+
+import collections
+import csv
+import time
+import numpy as np
+
+from attenuation_profile import AttenuationProfile, PHASE_COLUMN_NAME, calculateVoltfactorArray
+from equalizer_response import defaultSampleRate, frontEndLimitMHz
+from waveform_io import parseWaveDescriptor, skipBlockPrefix, codesToVolts, codesDtype
+
+################
+# Configurations
+################
+
+pathTables = ".//output_out//"
+CSVFile_defaultTable = "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv"
+CSVFile_characterization = "dbVAttenuationTable_broadband_characterization.csv"
+
+defaultPeriod          = 1 << 16
+defaultNumTones        = 4000
+defaultCrestIterations = 30
+defaultMinCoherence    = 0.99
+
+characterizationHeaderCSV = ["Frequency MHz", "Attenuation dBV", "VoltsScaleFactor",
+                             PHASE_COLUMN_NAME, "Coherence"]
+
+###########
+# Constants
+###########
+
+WINDOW_RECTANGULAR = "WINDOW_RECTANGULAR"
+WINDOW_HANN        = "WINDOW_HANN"
+
+#########
+# Classes
+#########
+
+FrequencyResponseEstimate = collections.namedtuple("FrequencyResponseEstimate",
+        ["freqMHz", "response", "coherence", "excitationPower", "numAverages"])
+
+class H1Estimator:
+    # Accumulates the averaged spectra of the captures, so that the captures
+    # can be added one at a time.
+
+    def __init__(self, segmentSize, sampleRate = defaultSampleRate, window = WINDOW_RECTANGULAR,
+                 overlap = 0.0):
+        if not 0.0 <= overlap < 1.0:
+            raise ValueError("The overlap must be in [0, 1).")
+        self.segmentSize = segmentSize
+        self.sampleRate  = sampleRate
+        self.step = max(1, int(round(segmentSize * (1.0 - overlap))))
+        if window == WINDOW_RECTANGULAR:
+            self.window = None
+        elif window == WINDOW_HANN:
+            self.window = np.hanning(segmentSize + 1)[:-1]
+        else:
+            raise ValueError("Unknown window: " + str(window))
+        numBins = segmentSize // 2 + 1
+        self.sumXX = np.zeros(numBins)
+        self.sumYY = np.zeros(numBins)
+        self.sumXY = np.zeros(numBins, dtype=np.complex128)
+        self.numAverages = 0
+
+    def _segmentsSpectra(self, samples):
+        segments = np.lib.stride_tricks.sliding_window_view(samples, self.segmentSize)[::self.step]
+        if self.window is not None:
+            segments = segments * self.window
+        return np.fft.rfft(segments, axis=1)
+
+    def addCapture(self, excitation, response):
+        # Param: excitation and response are the input and the output of the
+        #        system, with the same length and aligned in time.
+        excitation = np.asarray(excitation, dtype=np.float64)
+        response   = np.asarray(response, dtype=np.float64)
+        if excitation.shape != response.shape or excitation.size < self.segmentSize:
+            raise ValueError("The excitation and the response must have the same length, "
+                             "of at least one segment.")
+        spectrumX = self._segmentsSpectra(excitation)
+        spectrumY = self._segmentsSpectra(response)
+        self.sumXX += np.sum(spectrumX.real ** 2 + spectrumX.imag ** 2, axis=0)
+        self.sumYY += np.sum(spectrumY.real ** 2 + spectrumY.imag ** 2, axis=0)
+        self.sumXY += np.sum(np.conj(spectrumX) * spectrumY, axis=0)
+        self.numAverages += spectrumX.shape[0]
+
+    def estimate(self):
+        if self.numAverages == 0:
+            raise ValueError("There are no captures.")
+        with np.errstate(divide='ignore', invalid='ignore'):
+            response = np.where(self.sumXX > 0.0, self.sumXY / self.sumXX, 0.0)
+            coherence = np.where(self.sumXX * self.sumYY > 0.0,
+                                 np.abs(self.sumXY) ** 2 / (self.sumXX * self.sumYY), 0.0)
+        freqMHz = np.fft.rfftfreq(self.segmentSize, 1.0 / self.sampleRate) / 1.0e6
+        return FrequencyResponseEstimate(freqMHz, response, coherence,
+                                         self.sumXX / self.numAverages, self.numAverages)
+
+###########
+# Functions
+###########
+
+def calcCrestFactor(samples):
+    return float(np.max(np.abs(samples)) / np.sqrt(np.mean(samples ** 2)))
+
+def makeLogChirp(numSamples, sampleRate = defaultSampleRate, startFreqMHz = 1.0,
+                 endFreqMHz = 900.0, amplitude = 1.0):
+    # Logarithmic (exponential) chirp from startFreqMHz to endFreqMHz in numSamples.
+    duration = numSamples / sampleRate
+    startFreq, endFreq = startFreqMHz * 1.0e6, endFreqMHz * 1.0e6
+    rate = np.log(endFreq / startFreq) / duration
+    timeAxis = np.arange(numSamples) / sampleRate
+    phase = 2.0 * np.pi * startFreq * np.expm1(rate * timeAxis) / rate
+    return amplitude * np.sin(phase)
+
+def makeMultitone(period = defaultPeriod, sampleRate = defaultSampleRate, startFreqMHz = 1.0,
+                  endFreqMHz = 900.0, numTones = defaultNumTones, amplitude = 1.0,
+                  numIterations = defaultCrestIterations):
+    # Periodic multitone with the tones in the FFT bins of the period, equally
+    # spaced between startFreqMHz and endFreqMHz, with the peak at "amplitude".
+    # Returns (one period of the excitation, tone bin indexes), see Note 2.
+    binMHz = sampleRate / period / 1.0e6
+    toneBins = np.unique(np.round(np.linspace(startFreqMHz / binMHz, endFreqMHz / binMHz,
+                                              numTones)).astype(np.int64))
+    toneBins = toneBins[(toneBins > 0) & (toneBins < period // 2)]
+    indexes = np.arange(1, toneBins.size + 1)
+    phases = -np.pi * indexes * (indexes - 1) / toneBins.size
+    spectrum = np.zeros(period // 2 + 1, dtype=np.complex128)
+    spectrum[toneBins] = np.exp(1j * phases)
+    samples = np.fft.irfft(spectrum, period)
+    bestSamples, bestCrest = samples, calcCrestFactor(samples)
+    for _ in range(numIterations):
+        limit = 0.8 * np.max(np.abs(samples))
+        clippedSpectrum = np.fft.rfft(np.clip(samples, -limit, limit))
+        spectrum[toneBins] = np.exp(1j * np.angle(clippedSpectrum[toneBins]))
+        samples = np.fft.irfft(spectrum, period)
+        crest = calcCrestFactor(samples)
+        if crest < bestCrest:
+            bestSamples, bestCrest = samples, crest
+    return (amplitude * bestSamples / np.max(np.abs(bestSamples)), toneBins)
+
+def estimateFrequencyResponse(excitation, response, sampleRate = defaultSampleRate,
+                              segmentSize = defaultPeriod, window = WINDOW_RECTANGULAR,
+                              overlap = 0.0):
+    estimator = H1Estimator(segmentSize, sampleRate, window, overlap)
+    estimator.addCapture(excitation, response)
+    return estimator.estimate()
+
+def selectValidBins(estimate, minCoherence = defaultMinCoherence, freqRangeMHz = None,
+                    minRelativePower = 1e-6):
+    # The bins with excitation power and with a good coherence.
+    valid = estimate.coherence >= minCoherence
+    valid &= estimate.excitationPower >= minRelativePower * np.max(estimate.excitationPower)
+    valid &= estimate.freqMHz > 0.0
+    if freqRangeMHz is not None:
+        valid &= (estimate.freqMHz >= freqRangeMHz[0]) & (estimate.freqMHz <= freqRangeMHz[1])
+    return np.flatnonzero(valid)
+
+def responsePointsFromEstimate(estimate, minCoherence = defaultMinCoherence, freqRangeMHz = None):
+    # Returns (freqMHz, dBV, phaseDeg, coherence) of the valid bins.
+    bins = selectValidBins(estimate, minCoherence, freqRangeMHz)
+    if bins.size == 0:
+        raise ValueError("There is no bin with enough coherence.")
+    response = estimate.response[bins]
+    dBV = 20.0 * np.log10(np.abs(response))
+    phaseDeg = np.rad2deg(np.unwrap(np.angle(response)))
+    return (estimate.freqMHz[bins], dBV, phaseDeg, estimate.coherence[bins])
+
+def profileFromEstimate(estimate, minCoherence = defaultMinCoherence, freqRangeMHz = None,
+                        flag_add_end_points = True):
+    # Like the profiles of the extractor, the end points are added for the interpolation.
+    freqMHz, dBV, phaseDeg, _ = responsePointsFromEstimate(estimate, minCoherence, freqRangeMHz)
+    return AttenuationProfile(freqMHz, dBV, phaseDeg, flag_add_end_points = flag_add_end_points)
+
+def writeCharacterizationCSVFile(estimate, pathOut, fileName, minCoherence = defaultMinCoherence,
+                                 freqRangeMHz = None):
+    # Writes the valid bins, "AttenuationProfile.fromCSVFile()" adds the end points.
+    freqMHz, dBV, phaseDeg, coherence = responsePointsFromEstimate(estimate, minCoherence,
+                                                                   freqRangeMHz)
+    with open(pathOut + fileName, mode='w', newline='') as tableFile:
+        tableWriter = csv.writer(tableFile, delimiter=',', quotechar='"',
+                                 quoting=csv.QUOTE_MINIMAL)
+        tableWriter.writerow(characterizationHeaderCSV)
+        tableWriter.writerows(zip(freqMHz, dBV, calculateVoltfactorArray(dBV), phaseDeg,
+                                  coherence))
+
+def characterizeOverSCPI(client, excitation, numCaptures = 4, minCoherence = defaultMinCoherence,
+                         freqRangeMHz = None):
+    # Uploads the excitation to the simulated scope generator, see Note 3,
+    # captures it "numCaptures" times and returns (profile, estimate).
+    excitation = np.asarray(excitation, dtype=np.float64)
+    client.writeBlock(":SIM:AWG:DATA ", excitation.astype("<f4"))
+    client.write(":SIM:SIGN AWG")
+    preambleBytes = bytes(client.queryBlock(":WAV:PRE?"))
+    metadata = parseWaveDescriptor(preambleBytes[skipBlockPrefix(preambleBytes):])
+    sampleRate = 1.0 / metadata.sampleInterval
+    numPeriods = metadata.numSamples // excitation.size
+    if numPeriods == 0:
+        raise ValueError("The capture is shorter then one period of the excitation.")
+    numSamples = numPeriods * excitation.size
+    # The float32 excitation that the generator really outputs.
+    reference = np.tile(excitation.astype(np.float32).astype(np.float64), numPeriods)
+    codes = np.empty(metadata.numSamples, dtype=codesDtype(metadata))
+    estimator = H1Estimator(excitation.size, sampleRate)
+    for _ in range(numCaptures):
+        client.queryBlock(":WAV:DATA?", codes)
+        estimator.addCapture(reference, codesToVolts(codes[:numSamples], metadata))
+    estimate = estimator.estimate()
+    return (profileFromEstimate(estimate, minCoherence, freqRangeMHz), estimate)
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    from minimum_phase_response import withMinimumPhase
+    from scpi_link import SCPISocketClient
+    from simulated_scpi_scope import SimulatedScope, SimulatedScopeServer
+    print("\nStarting...")
+    # The simulated scope has the extracted magnitude and its minimum phase.
+    trueProfile = withMinimumPhase(AttenuationProfile.fromCSVFile(pathTables, CSVFile_defaultTable),
+                                   maxFreqMHz=frontEndLimitMHz)
+    period = defaultPeriod
+    scope = SimulatedScope(trueProfile, numPoints=16 * period, noiseVolts=0.002)
+    multitone, toneBins = makeMultitone(period)
+    chirp = makeLogChirp(period, startFreqMHz=1.0, endFreqMHz=900.0)
+    print("...multitone tones: %d  crest factor: %.2f" % (toneBins.size, calcCrestFactor(multitone)))
+    print("...chirp crest factor: %.2f" % calcCrestFactor(chirp))
+    with SimulatedScopeServer(scope) as server:
+        with SCPISocketClient(server.host, server.port) as client:
+            for name, excitation in (("multitone", multitone), ("log chirp", chirp)):
+                startTime = time.perf_counter()
+                profile, estimate = characterizeOverSCPI(client, excitation,
+                                                         freqRangeMHz=(1.0, 900.0))
+                elapsedTime = time.perf_counter() - startTime
+                inRange = (profile.freqMHz >= 1.0) & (profile.freqMHz <= 900.0)
+                freqs = profile.freqMHz[inRange]
+                print("...%-9s bins: %5d  time s: %.2f  max error dB: %.4f  max error degrees: %.3f"
+                      % (name, freqs.size, elapsedTime,
+                         np.max(np.abs(profile.dBV[inRange] - trueProfile.db(freqs))),
+                         np.max(np.abs(profile.phaseDeg[inRange] - trueProfile.phase_deg(freqs)))))
+    print("...end\n")
@@ -0,0 +1,372 @@
+# Name: equalization_regression_harness.py
+# Description: Synthetic end to end accuracy and throughput regression harness
+#              of the equalization, so that a faster code path can't silently
+#              break the correction quality.
+#              Synthetic test signals (square wave, pulse and multitone, all
+#              band limited to the 945 MHz front end limit) pass through a
+#              simulated scope with the response of
+#              "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv", and then
+#              through each equalization mode:
+#                -MODE_NONE, the captured signal without correction, as a
+#                 reference of how much each mode improves it.
+#                -MODE_FULL_RECORD, "equalizeFullRecord()".
+#                -MODE_PLAN, "equalizeWithPlan()" with a cached plan.
+#                -MODE_SINGLE_PRECISION, "SinglePrecisionEqualizer".
+#                -MODE_STREAMING, the overlap-save "StreamingEqualizer".
+#                -MODE_FIR_LINEAR and MODE_FIR_MINIMUM, "FIREqualizer".
+#              For each signal and mode it records the reconstruction error
+#              against the band limited ideal signal (RMS, 10 % to 90 % rise
+#              time and overshoot of the edges) and the throughput in samples/s.
+#              The results are written to a JSON file, and the compare mode
+#              fails when any accuracy or throughput metric regresses past its
+#              threshold against a saved baseline.
+#              It also checks the README validation point, 570 MHz at -2.99 dB
+#              in the image and -2.9725 dB in the table.
+#
+# Usage:
+#   python equalization_regression_harness.py [--output harness.json]
+#          [--compare baseline.json] [--speed-threshold 0.25]
+#          [--accuracy-threshold 0.05] [--num-samples 262144] [--repeat 5]
+#          [--min-duration 0.5]
+#
+# Note 1: The signal frequencies are rounded to a whole number of periods in
+#         the record, so the records are periodic and the FFT of the simulated
+#         scope has no wrap around edge. The FIR and the streaming modes are
+#         linear convolutions, so the metrics skip "edgeMargin" samples at
+#         each end of the record.
+#
+# Note 2: The profile has no phase, the simulated scope only attenuates, so the
+#         minimum phase FIR adds its own phase-shift and has a larger error by
+#         design, it isn't checked against the uncorrected signal but only
+#         against its own baseline.
+#
+# Note 3: Exit code 1 when a check fails: the README point, a mode with more
+#         error then the uncorrected signal, or in the compare mode a
+#         regression. The accuracy regressions are an RMS error larger by more
+#         then "accuracyThreshold" (relative), a rise time longer by more then
+#         "riseTimeTolerance_ps" or an overshoot larger by more then
+#         "overshootTolerance" percentage points, the improvements aren't
+#         regressions. The throughput regressions are a samples/s lower by
+#         more then "speedThreshold".
+#
+# Note 4: Each mode has a warm up call, out of the timing, and then the modes
+#         of a signal are timed interleaved, one run of each mode per round,
+#         for at least "repeat" rounds and "minDuration" seconds per mode, and
+#         the median of the runs is used. The speed of the machine changes over
+#         some hundreds of ms (other load, clock changes), the best of a few
+#         runs of some ms in a row changes too much between the runs of the
+#         same code, the interleaved runs see the same machine states.
+#         A fixed workload, "calibrationWorkload()", is timed in the same
+#         rounds, and the compare mode divides the speed ratio of each mode by
+#         the one of the calibration, so a machine that is slower or faster as
+#         a whole (ex: between the baseline run and this run) isn't a
+#         regression of the code.
+#
+# License:        MIT Open Source License
+#
+
+import argparse
+import json
+import time
+import numpy as np
+
+from attenuation_profile import AttenuationProfile
+from benchmark_suite import makeReport
+from equalizer_plan_cache import EqualizerPlanCache, equalizeWithPlan
+from equalizer_response import (applyProfileResponse, equalizeFullRecord, rfftFreqsMHz,
+                                defaultSampleRate, frontEndLimitMHz)
+from fir_equalizer_designer import FIREqualizer, LINEAR_PHASE, MINIMUM_PHASE
+from simulated_scpi_scope import (generateSyntheticSignal, SIGNAL_SQUARE, SIGNAL_PULSE,
+                                  SIGNAL_MULTITONE)
+from single_precision_equalizer import SinglePrecisionEqualizer
+from streaming_equalizer import StreamingEqualizer
+
+################
+# Configurations
+################
+
+pathTables = ".//output_out//"
+CSVFile_defaultTable = "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv"
+pathHarness = ".//"
+
+defaultNumSamples = 1 << 18
+defaultRepeat     = 5
+defaultMinDuration = 0.5
+defaultSignalFreqHz = 10.0e6
+
+defaultSpeedThreshold    = 0.25
+defaultAccuracyThreshold = 0.05
+riseTimeTolerance_ps = 20.0
+overshootTolerance   = 1.0
+
+# Samples skipped at each end of the record by the metrics, see Note 1.
+edgeMargin = 4096
+
+# Max number of edges used for the rise time and the overshoot.
+maxEdges = 32
+
+# README validation point.
+readmeCheckFreqMHz     = 570.0
+readmeImage_dB         = -2.99
+readmeTable_dB         = -2.9725
+readmeImageTolerance_dB = 0.05
+readmeTableTolerance_dB = 0.001
+
+###########
+# Constants
+###########
+
+MODE_NONE             = "MODE_NONE"
+MODE_FULL_RECORD      = "MODE_FULL_RECORD"
+MODE_PLAN             = "MODE_PLAN"
+MODE_SINGLE_PRECISION = "MODE_SINGLE_PRECISION"
+MODE_STREAMING        = "MODE_STREAMING"
+MODE_FIR_LINEAR       = "MODE_FIR_LINEAR"
+MODE_FIR_MINIMUM      = "MODE_FIR_MINIMUM"
+
+modeLst = [MODE_NONE, MODE_FULL_RECORD, MODE_PLAN, MODE_SINGLE_PRECISION, MODE_STREAMING,
+           MODE_FIR_LINEAR, MODE_FIR_MINIMUM]
+
+signalLst = [SIGNAL_SQUARE, SIGNAL_PULSE, SIGNAL_MULTITONE]
+
+# Fixed workload timed with the modes, see Note 4.
+CALIBRATION = "CALIBRATION"
+
+###########
+# Functions
+###########
+
+def makeEqualizeFunction(mode, profile, numSamples, sampleRate = defaultSampleRate):
+    # The plans, kernels and buffers of the mode are made here, so that only
+    # the equalization itself is timed.
+    edgeMHz = frontEndLimitMHz
+    if mode == MODE_NONE:
+        return lambda samples: samples
+    if mode == MODE_FULL_RECORD:
+        return lambda samples: equalizeFullRecord(samples, sampleRate, profile,
+                                                  passbandEdgeMHz=edgeMHz)
+    if mode == MODE_PLAN:
+        plan = EqualizerPlanCache().getPlan(profile, sampleRate, numSamples,
+                                            passbandEdgeMHz=edgeMHz)
+        return lambda samples: equalizeWithPlan(samples, plan)
+    if mode == MODE_SINGLE_PRECISION:
+        equalizer = SinglePrecisionEqualizer(profile, sampleRate, passbandEdgeMHz=edgeMHz)
+        out = np.empty(numSamples, dtype=np.float32)
+        return lambda samples: equalizer.equalize(samples, out)
+    if mode == MODE_STREAMING:
+        equalizer = StreamingEqualizer.fromProfile(profile, sampleRate, passbandEdgeMHz=edgeMHz)
+        return lambda samples: np.concatenate(list(equalizer.equalizeArray(samples)))
+    if mode in (MODE_FIR_LINEAR, MODE_FIR_MINIMUM):
+        equalizer = FIREqualizer(profile, sampleRate, passbandEdgeMHz=edgeMHz,
+                                 phaseMode=LINEAR_PHASE if mode == MODE_FIR_LINEAR
+                                 else MINIMUM_PHASE)
+        return equalizer.apply
+    raise ValueError("Unknown equalization mode: " + str(mode))
+
+def calibrationWorkload(samples):
+    # A forward and an inverse FFT of the record, the core of most modes.
+    return np.fft.irfft(np.fft.rfft(samples), samples.size)
+
+def bandLimit(samples, sampleRate, maxFreqMHz = frontEndLimitMHz):
+    # Ideal brick wall low pass, the signal that a perfect correction recovers.
+    spectrum = np.fft.rfft(samples)
+    spectrum[rfftFreqsMHz(samples.size, sampleRate) > maxFreqMHz] = 0.0
+    return np.fft.irfft(spectrum, samples.size)
+
+def makeTestCase(signalType, numSamples, profile, sampleRate = defaultSampleRate,
+                 freqHz = defaultSignalFreqHz):
+    # Returns (ideal, band limited ideal, captured), see Note 1.
+    numPeriods = max(1, int(round(freqHz * numSamples / sampleRate)))
+    freqHz = numPeriods * sampleRate / numSamples
+    ideal = generateSyntheticSignal(signalType, numSamples, sampleRate, freqHz)
+    reference = bandLimit(ideal, sampleRate)
+    captured = applyProfileResponse(reference, sampleRate, profile)
+    return (ideal, reference, captured)
+
+def findRisingEdges(ideal):
+    # The indexes of the rising edges of the ideal signal, inside the margins.
+    edges = np.flatnonzero((ideal[1:] > 0.0) & (ideal[:-1] <= 0.0)) + 1
+    edges = edges[(edges > edgeMargin) & (edges < ideal.size - edgeMargin)]
+    return edges[:maxEdges]
+
+def measureEdges(samples, ideal, sampleRate):
+    # Returns (mean 10 % to 90 % rise time in ps, mean overshoot in % of the
+    # step), or (None, None) for signals without edges.
+    edges = findRisingEdges(ideal)
+    if edges.size == 0 or np.max(ideal) == np.min(ideal):
+        return (None, None)
+    low, high = float(np.min(ideal)), float(np.max(ideal))
+    # The window ends before the next falling edge, ex: the short pulses.
+    highLength = int(np.min(np.diff(np.flatnonzero(np.diff(ideal) != 0.0))))
+    window = max(4, min(40, highLength - 2))
+    levels = low + np.array([0.1, 0.5, 0.9]) * (high - low)
+    riseTimes, overshoots = [], []
+    for edge in edges:
+        segment = samples[edge - window:edge + window]
+        index50 = int(np.argmax(segment >= levels[1]))
+        below10 = np.flatnonzero(segment[:index50] < levels[0])
+        above90 = np.flatnonzero(segment[index50:] >= levels[2])
+        if below10.size == 0 or above90.size == 0:
+            continue
+        index10, index90 = below10[-1], index50 + above90[0]
+        # Linear interpolation of the crossings.
+        cross10 = index10 + (levels[0] - segment[index10]) / (segment[index10 + 1] - segment[index10])
+        cross90 = index90 - (segment[index90] - levels[2]) / (segment[index90] - segment[index90 - 1])
+        riseTimes.append((cross90 - cross10) / sampleRate * 1e12)
+        overshoots.append((np.max(segment[index50:]) - high) / (high - low) * 100.0)
+    if not riseTimes:
+        return (None, None)
+    return (float(np.mean(riseTimes)), float(np.mean(overshoots)))
+
+def timeEqualizations(equalizeFns, captured, repeat, minDuration = defaultMinDuration):
+    # Returns the dictionaries ({mode: median time in seconds}, {mode: output}),
+    # see Note 4.
+    outputs = {mode: equalizeFn(captured) for mode, equalizeFn in equalizeFns.items()}
+    times = {mode: [] for mode in equalizeFns}
+    numRounds = 0
+    totalStartTime = time.perf_counter()
+    while numRounds < repeat or \
+          time.perf_counter() - totalStartTime < minDuration * len(equalizeFns):
+        for mode, equalizeFn in equalizeFns.items():
+            startTime = time.perf_counter()
+            equalizeFn(captured)
+            times[mode].append(time.perf_counter() - startTime)
+        numRounds += 1
+    return ({mode: float(np.median(modeTimes)) for mode, modeTimes in times.items()}, outputs)
+
+def runHarness(numSamples = defaultNumSamples, repeat = defaultRepeat,
+               sampleRate = defaultSampleRate, minDuration = defaultMinDuration):
+    profile = AttenuationProfile.fromCSVFile(pathTables, CSVFile_defaultTable)
+    equalizeFns = {mode: makeEqualizeFunction(mode, profile, numSamples, sampleRate)
+                   for mode in modeLst}
+    middle = slice(edgeMargin, numSamples - edgeMargin)
+    results = {}
+    for signalType in signalLst:
+        ideal, reference, captured = makeTestCase(signalType, numSamples, profile, sampleRate)
+        referenceRiseTime, referenceOvershoot = measureEdges(reference, ideal, sampleRate)
+        timedFns = dict(equalizeFns, **{CALIBRATION: calibrationWorkload})
+        modeSeconds, outputs = timeEqualizations(timedFns, captured, repeat, minDuration)
+        for mode in modeLst:
+            seconds = modeSeconds[mode]
+            output = np.asarray(outputs[mode], dtype=np.float64)
+            error = output[middle] - reference[middle]
+            riseTime, overshoot = measureEdges(output, ideal, sampleRate)
+            name = "%s/%s" % (signalType, mode)
+            results[name] = {"signal": signalType, "mode": mode, "numSamples": numSamples,
+                             "rmsError": float(np.sqrt(np.mean(error ** 2))),
+                             "maxError": float(np.max(np.abs(error))),
+                             "riseTime_ps": riseTime, "referenceRiseTime_ps": referenceRiseTime,
+                             "overshootPercent": overshoot,
+                             "referenceOvershootPercent": referenceOvershoot,
+                             "seconds": seconds,
+                             "samplesPerSecond": numSamples / seconds if seconds > 0 else
+                                                 float("inf"),
+                             "calibrationSamplesPerSecond": numSamples /
+                                                            modeSeconds[CALIBRATION]}
+            printResult(name, results[name])
+    return (profile, results)
+
+def printResult(name, result):
+    edgeText = ""
+    if result["riseTime_ps"] is not None:
+        edgeText = "  rise ps: %6.1f (ideal %6.1f)  overshoot %%: %5.2f (ideal %5.2f)" % (
+                   result["riseTime_ps"], result["referenceRiseTime_ps"],
+                   result["overshootPercent"], result["referenceOvershootPercent"])
+    print("... %-40s RMS error: %.5f  samples/s: %.3e%s" %
+          (name, result["rmsError"], result["samplesPerSecond"], edgeText))
+
+def checkReadmePoint(profile):
+    # Returns the list of the failed checks, the README 570 MHz point.
+    value_dB = profile.db(readmeCheckFreqMHz)
+    failures = []
+    if abs(value_dB - readmeImage_dB) > readmeImageTolerance_dB:
+        failures.append("README image point %.1f MHz: %.4f dB" % (readmeCheckFreqMHz, value_dB))
+    if abs(value_dB - readmeTable_dB) > readmeTableTolerance_dB:
+        failures.append("README table point %.1f MHz: %.4f dB" % (readmeCheckFreqMHz, value_dB))
+    print("... README point %.1f MHz: %.4f dB (image %.2f dB, table %.4f dB)" %
+          (readmeCheckFreqMHz, value_dB, readmeImage_dB, readmeTable_dB))
+    return failures
+
+def checkImprovement(results):
+    # Every mode must have less error then the uncorrected capture, except the
+    # minimum phase FIR, see Note 2.
+    failures = []
+    for name, result in results.items():
+        uncorrected = results["%s/%s" % (result["signal"], MODE_NONE)]
+        if result["mode"] not in (MODE_NONE, MODE_FIR_MINIMUM) and \
+           result["rmsError"] >= uncorrected["rmsError"]:
+            failures.append("%s doesn't improve the uncorrected signal" % name)
+    return failures
+
+def compareWithBaseline(results, baseline, speedThreshold = defaultSpeedThreshold,
+                        accuracyThreshold = defaultAccuracyThreshold):
+    # Returns the list of the regressions, see Note 3.
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print("... %-40s new case" % name)
+            continue
+        base = baseline[name]
+        problems = []
+        if result["rmsError"] > base["rmsError"] * (1.0 + accuracyThreshold) + 1e-12:
+            problems.append("RMS error x%.3f" % (result["rmsError"] / max(base["rmsError"], 1e-300)))
+        if result["riseTime_ps"] is not None and base["riseTime_ps"] is not None and \
+           result["riseTime_ps"] - base["riseTime_ps"] > riseTimeTolerance_ps:
+            problems.append("rise time %+.1f ps" % (result["riseTime_ps"] - base["riseTime_ps"]))
+        if result["overshootPercent"] is not None and base["overshootPercent"] is not None and \
+           result["overshootPercent"] - base["overshootPercent"] > overshootTolerance:
+            problems.append("overshoot %+.2f %%" %
+                            (result["overshootPercent"] - base["overshootPercent"]))
+        # Relative to the calibration workload of each run, see Note 4.
+        machineRatio = result["calibrationSamplesPerSecond"] / \
+                       base.get("calibrationSamplesPerSecond",
+                                result["calibrationSamplesPerSecond"])
+        speedRatio = result["samplesPerSecond"] / base["samplesPerSecond"] / machineRatio
+        if result["mode"] != MODE_NONE and speedRatio < 1.0 / (1.0 + speedThreshold):
+            problems.append("samples/s x%.3f" % speedRatio)
+        print("... %-40s speed x%.3f  machine x%.3f  %s" %
+              (name, speedRatio, machineRatio,
+               "REGRESSION: " + ", ".join(problems) if problems else "ok"))
+        regressions.extend("%s %s" % (name, problem) for problem in problems)
+    return regressions
+
+def parseArguments(argv = None):
+    parser = argparse.ArgumentParser(description="Accuracy and throughput regression harness "
+                                                 "of the equalization.")
+    parser.add_argument("--output", default=pathHarness + "harness_results.json",
+                        help="JSON file of the results")
+    parser.add_argument("--compare", default=None, help="baseline JSON file to compare with")
+    parser.add_argument("--speed-threshold", type=float, default=defaultSpeedThreshold,
+                        help="max relative slow down allowed in the compare mode")
+    parser.add_argument("--accuracy-threshold", type=float, default=defaultAccuracyThreshold,
+                        help="max relative RMS error increase allowed in the compare mode")
+    parser.add_argument("--num-samples", type=int, default=defaultNumSamples,
+                        help="samples of each synthetic record")
+    parser.add_argument("--repeat", type=int, default=defaultRepeat,
+                        help="min timed rounds of each signal")
+    parser.add_argument("--min-duration", type=float, default=defaultMinDuration,
+                        help="min timed seconds of each mode")
+    return parser.parse_args(argv)
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    args = parseArguments()
+    print("\nStarting...")
+    profile, results = runHarness(args.num_samples, args.repeat,
+                                  minDuration=args.min_duration)
+    failures = checkReadmePoint(profile) + checkImprovement(results)
+    with open(args.output, mode='w') as jsonFile:
+        json.dump(makeReport(results), jsonFile, indent=2)
+    print("...results written to", args.output)
+    if args.compare is not None:
+        with open(args.compare, mode='r') as jsonFile:
+            baseline = json.load(jsonFile)["results"]
+        failures += compareWithBaseline(results, baseline, args.speed_threshold,
+                                        args.accuracy_threshold)
+    for failure in failures:
+        print("...FAILED:", failure)
+    print("...end\n")
+    raise SystemExit(1 if failures else 0)
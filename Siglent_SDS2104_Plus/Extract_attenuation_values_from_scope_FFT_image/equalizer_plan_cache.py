@@ -0,0 +1,179 @@
+# Name: equalizer_plan_cache.py
+# Description: Cache of the equalizer response plans for each FFT size.
+#              An equalization of a record with N samples needs the inverse
+#              complex response sampled at the exact "np.fft.rfft()" bin
+#              frequencies, for a given (sample rate, N, profile, gain clamp).
+#              The plan cache builds this vector only once for each key, keeps
+#              it as a contiguous complex64 or complex128 array, evicts the
+#              least recently used plans when the memory budget is exceeded and
+#              can persist the plans to disk, so that a restarted service
+#              doesn't rebuild them.
+#
+# Note 1: The profile part of the key is the profile content fingerprint, so
+#         two equal profiles loaded from different files share the plans.
+#
+# Note 2: The plans on disk are ".npy" files named with the hash of the key,
+#         they are loaded memory-mapped.
+#
+# License:        MIT Open Source License
+#
+
+import collections
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+from attenuation_profile import AttenuationProfile
+from pipeline_instrumentation import timedStage, incrementCounter
+from equalizer_response import (calcInverseComplexResponse, rfftFreqsMHz,
+                                defaultSampleRate, defaultMaxGain_dB)
+
+################
+# Configurations
+################
+
+pathTables = ".//output_out//"
+CSVFile_defaultTable = "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv"
+
+defaultMemoryBudgetBytes = 256 * 1024 * 1024
+
+#########
+# Classes
+#########
+
+PlanKey = collections.namedtuple("PlanKey", ["sampleRate", "numSamples", "profileFingerprint",
+                                             "maxGain_dB", "passbandEdgeMHz", "dtype"])
+
+class EqualizerPlanCache:
+
+    def __init__(self, memoryBudgetBytes = defaultMemoryBudgetBytes, pathPlans = None):
+        # Param: pathPlans is the directory of the plans on disk, None to
+        #        keep the plans only in memory.
+        self.memoryBudgetBytes = memoryBudgetBytes
+        self.pathPlans = pathPlans
+        self._plans = collections.OrderedDict()
+        self.memoryBytes = 0
+        self.hits       = 0
+        self.misses     = 0
+        self.diskHits   = 0
+        self.evictions  = 0
+        if pathPlans is not None:
+            os.makedirs(pathPlans, exist_ok=True)
+
+    def makeKey(self, profile, sampleRate, numSamples, maxGain_dB = defaultMaxGain_dB,
+                passbandEdgeMHz = None, dtype = np.complex128):
+        return PlanKey(float(sampleRate), int(numSamples), profile.fingerprint(),
+                       float(maxGain_dB),
+                       None if passbandEdgeMHz is None else float(passbandEdgeMHz),
+                       np.dtype(dtype).name)
+
+    def getPlan(self, profile, sampleRate, numSamples, maxGain_dB = defaultMaxGain_dB,
+                passbandEdgeMHz = None, dtype = np.complex128):
+        # Returns the read only inverse complex response for the rfft bins.
+        key = self.makeKey(profile, sampleRate, numSamples, maxGain_dB,
+                           passbandEdgeMHz, dtype)
+        plan = self._plans.get(key)
+        if plan is not None:
+            self._plans.move_to_end(key)
+            self.hits += 1
+            incrementCounter("plan_cache.hits")
+            return plan
+        self.misses += 1
+        incrementCounter("plan_cache.misses")
+        plan = self._loadPlanFromDisk(key)
+        if plan is None:
+            plan = buildPlan(profile, sampleRate, numSamples, maxGain_dB,
+                             passbandEdgeMHz, dtype)
+            self._savePlanToDisk(key, plan)
+        else:
+            self.diskHits += 1
+        self._insert(key, plan)
+        return plan
+
+    def _insert(self, key, plan):
+        self._plans[key] = plan
+        self.memoryBytes += plan.nbytes
+        # The plan just inserted is never evicted, even if it's bigger then the budget.
+        while self.memoryBytes > self.memoryBudgetBytes and len(self._plans) > 1:
+            _, evictedPlan = self._plans.popitem(last=False)
+            self.memoryBytes -= evictedPlan.nbytes
+            self.evictions += 1
+
+    def _planFileName(self, key):
+        return "plan_" + hashlib.sha1(repr(tuple(key)).encode("utf-8")).hexdigest() + ".npy"
+
+    def _loadPlanFromDisk(self, key):
+        if self.pathPlans is None:
+            return None
+        fileName = os.path.join(self.pathPlans, self._planFileName(key))
+        if not os.path.exists(fileName):
+            return None
+        plan = np.load(fileName, mmap_mode='r')
+        if plan.dtype != np.dtype(key.dtype) or plan.shape != (key.numSamples // 2 + 1,):
+            return None
+        return plan
+
+    def _savePlanToDisk(self, key, plan):
+        if self.pathPlans is None:
+            return
+        fileName = os.path.join(self.pathPlans, self._planFileName(key))
+        # Written to a temporary file and renamed, so that a concurrent reader
+        # never sees a partial plan. The temporary name is unique, so that two
+        # processes saving the same plan don't write the same temporary file.
+        fileDescriptor, tmpFileName = tempfile.mkstemp(suffix=".tmp.npy", dir=self.pathPlans)
+        try:
+            with os.fdopen(fileDescriptor, mode='wb') as tmpFile:
+                np.save(tmpFile, plan)
+            os.replace(tmpFileName, fileName)
+        except BaseException:
+            os.remove(tmpFileName)
+            raise
+
+    def clear(self):
+        self._plans.clear()
+        self.memoryBytes = 0
+
+    def stats(self):
+        return {"plans": len(self._plans), "memoryBytes": self.memoryBytes,
+                "memoryBudgetBytes": self.memoryBudgetBytes, "hits": self.hits,
+                "misses": self.misses, "diskHits": self.diskHits,
+                "evictions": self.evictions}
+
+###########
+# Functions
+###########
+
+@timedStage()
+def buildPlan(profile, sampleRate, numSamples, maxGain_dB = defaultMaxGain_dB,
+              passbandEdgeMHz = None, dtype = np.complex128):
+    response = calcInverseComplexResponse(profile, rfftFreqsMHz(numSamples, sampleRate),
+                                          maxGain_dB, passbandEdgeMHz)
+    plan = np.ascontiguousarray(response, dtype=dtype)
+    plan.flags.writeable = False
+    return plan
+
+@timedStage()
+def equalizeWithPlan(samples, plan):
+    # One FFT equalization of a record with a plan of the same length.
+    samples = np.asarray(samples)
+    spectrum = np.fft.rfft(samples)
+    if spectrum.shape != plan.shape:
+        raise ValueError("The plan was built for a different number of samples.")
+    spectrum *= plan
+    return np.fft.irfft(spectrum, samples.size)
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    print("\nStarting...")
+    profile = AttenuationProfile.fromCSVFile(pathTables, CSVFile_defaultTable)
+    planCache = EqualizerPlanCache()
+    for _ in range(1000):
+        for numSamples in (1000, 14000, 140000):
+            plan = planCache.getPlan(profile, defaultSampleRate, numSamples)
+    print("...", planCache.stats())
+    print("...end\n")
+
@@ -0,0 +1,86 @@
+# Name: equalizer_response.py
+# Description: Inverse frequency response of the scope, derived from the
+#              attenuation profiles, that is applied by the equalizers.
+#              For each frequency the equalizer gain is the inverse of the
+#              Volts scale factor and the equalizer phase is the inverse of
+#              the profile phase-shift (when the profile has phase).
+#
+# Note 1: The gain is limited to "maxGain_dB", so that the -100 dBV tail of the
+#         tables doesn't explode into noise. Above the "passbandEdgeMHz" (ex:
+#         the 945 MHz front end limit) the gain is zero, there is no signal
+#         there to correct, only noise.
+#
+# Note 2: Frequencies of the profiles are in MHz and the sample rate is in
+#         samples per second.
+#
+# License:        MIT Open Source License
+#
+
+import numpy as np
+
+from pipeline_instrumentation import timedStage
+
+################
+# Configurations
+################
+
+# SDS2000X Plus, 2 GSa/s for each ADC.
+defaultSampleRate = 2.0e9
+
+defaultMaxGain_dB = 20.0
+
+# Max frequency of the Siglent SDS2104X Plus front end.
+frontEndLimitMHz = 945.0
+
+###########
+# Functions
+###########
+
+def rfftFreqsMHz(numSamples, sampleRate):
+    # The frequencies in MHz of the bins of "np.fft.rfft()".
+    return np.fft.rfftfreq(numSamples, 1.0 / sampleRate) / 1.0e6
+
+def calcInverseGain(profile, freqMHz, maxGain_dB = defaultMaxGain_dB,
+                    passbandEdgeMHz = None):
+    # Equalizer gain, the inverse of the Volts scale factor, see Note 1.
+    gain_dB = np.minimum(-np.asarray(profile.db(freqMHz), dtype=np.float64), maxGain_dB)
+    gain = np.power(10.0, gain_dB / 20.0)
+    if passbandEdgeMHz is not None:
+        gain = np.where(np.asarray(freqMHz) <= passbandEdgeMHz, gain, 0.0)
+    return gain
+
+def calcInverseComplexResponse(profile, freqMHz, maxGain_dB = defaultMaxGain_dB,
+                               passbandEdgeMHz = None, flag_use_phase = True):
+    # Complex equalizer response, gain and the inverse of the profile phase-shift.
+    gain = calcInverseGain(profile, freqMHz, maxGain_dB, passbandEdgeMHz)
+    if flag_use_phase == False or not profile.hasPhase():
+        return gain.astype(np.complex128)
+    phaseRad = np.deg2rad(profile.phase_deg(freqMHz))
+    return gain * np.exp(-1j * phaseRad)
+
+def calcComplexResponse(profile, freqMHz, flag_use_phase = True):
+    # Complex response of the scope itself, used to simulate captures.
+    volts = np.asarray(profile.volt_factor(freqMHz), dtype=np.float64)
+    if flag_use_phase == False or not profile.hasPhase():
+        return volts.astype(np.complex128)
+    return volts * np.exp(1j * np.deg2rad(profile.phase_deg(freqMHz)))
+
+def applyProfileResponse(samples, sampleRate, profile, flag_use_phase = True):
+    # Simulates the scope signal path, applies the profile response to a
+    # record with one FFT over all the record.
+    samples = np.asarray(samples, dtype=np.float64)
+    spectrum = np.fft.rfft(samples)
+    spectrum *= calcComplexResponse(profile, rfftFreqsMHz(samples.size, sampleRate),
+                                    flag_use_phase)
+    return np.fft.irfft(spectrum, samples.size)
+
+@timedStage()
+def equalizeFullRecord(samples, sampleRate, profile, maxGain_dB = defaultMaxGain_dB,
+                       passbandEdgeMHz = None):
+    # The README pipeline, one FFT over all the record, inverse response and iFFT.
+    samples = np.asarray(samples, dtype=np.float64)
+    spectrum = np.fft.rfft(samples)
+    spectrum *= calcInverseComplexResponse(profile, rfftFreqsMHz(samples.size, sampleRate),
+                                           maxGain_dB, passbandEdgeMHz)
+    return np.fft.irfft(spectrum, samples.size)
+
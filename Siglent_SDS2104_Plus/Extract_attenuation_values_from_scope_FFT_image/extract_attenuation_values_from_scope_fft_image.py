@@ -95,6 +95,11 @@ import math
 import numpy as np
 import csv
 
+from attenuation_profile import AttenuationProfile
+from pipeline_instrumentation import (stageTimer, timedStage, enableInstrumentation,
+                                      formatReport, dumpReport, dumpChromeTrace)
+from vectorized_trace_extractor import loadImageArray, extractTracePixelPos, extractTracesPixelPos
+
 ################
 # Configurations
 ################
@@ -107,11 +112,25 @@ flag_plot_extracted_signal_points = True   # True   False
 flag_mark_left_grid_Y_points      = True   # True   False
 flag_mark_bottom_grid_X_points    = True   # True   False
 
+# Flag that makes the "__main__" use the on disk cache of the pipeline stages,
+# only the stale stages are recomputed, see "incremental_extraction_pipeline.py".
+flag_use_stage_cache = False               # True   False
+
+# Flags that control the per stage timing and memory instrumentation, see
+# "pipeline_instrumentation.py". The report files are written in "pathOut".
+flag_enable_instrumentation = False        # True   False
+flag_trace_memory           = False        # True   False
+flag_write_chrome_trace     = False        # True   False
+
 # The hex byte for each R, G, B component of the attenuation graph line color.
 signalColorR = 0xB0
 signalColorG = 0x14
 signalColorB = 0xE8
 
+# Max absolute difference allowed in each R, G, B component of the graph line
+# color, 0 is an exact match.
+signalColorTolerance = 0
+
 # The hex byte for each R, G, B component of the color point extracted over
 # the graph line.
 outputSignalMarkerColorR = 0xFF
@@ -205,6 +224,8 @@ delta_freq = 100.0
 pathImgIn    = ".//img_in//"
 pathOut      = ".//output_out//"
 fileImgOut   = "output_debug_img.png"
+fileInstrumentationReport = "instrumentation_report.json"
+fileInstrumentationTrace  = "instrumentation_chrome_trace.json"
 CSVFile_dbVAttenuationTable_OriginalFreq = "dbVAttenuationTable_OriginalFreq_0_to_1_GHz.csv"
 CSVFile_dbVAttenuationTable_interpolated_1M_Step  = "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv"
 CSVFile_dbVAttenuationTable_interpolated_10M_Step = "dbVAttenuationTable_interpol_10M_step_0_to_1_GHz.csv"
@@ -227,30 +248,16 @@ def getImgInfo(img):
     pixels = img.load()   # Create the pixel map
     return (sizeX, sizeY, pixels)
 
-def processZone(pixelsIn, pixelsOut, zone):
+@timedStage()
+def processZone(imgArrayIn, pixelsOut, zone):
     # Extract the pixel points of a zone.
-    upperLeftX, upperLeftY, downRightX, downRightY = zone
-    pointPairLst = []
-    for x in range(upperLeftX, downRightX):
-        firstPointY = -1
-        counter = 0
-        for y in range(upperLeftY, downRightY):
-            pix = pixelsIn[x, y]
-            r = pix[0]
-            g = pix[1]
-            b = pix[2]
-            if r == signalColorR and g == signalColorG and b == signalColorB:
-                if (counter == 0):
-                    firstPointY = y
-                counter += 1
-        if counter > 0:
-            calcY = float(firstPointY) + (float(counter - 1) / 2.0)
-            pointPairLst.append( [x, calcY] )
-            # pixelsOut[x, round(y)] = (outputSignalMarkerColorR,
-            #                           outputSignalMarkerColorG,
-            #                           outputSignalMarkerColorB)
+    # Note: The image is a NumPy array, see "vectorized_trace_extractor.py".
+    signalColor = (signalColorR, signalColorG, signalColorB)
+    pointPairLst = extractTracePixelPos(imgArrayIn, [zone], signalColor,
+                                        signalColorTolerance)
     return pointPairLst
 
+@timedStage()
 def startingPointsExtender(pointsPairLst):
     # This function extends the starting points from the first left pixel in "zone 1",
     # flat zone wi 0 dB reference attenuation all the way to the zero frequency (0 Hz),
@@ -262,14 +269,23 @@ def startingPointsExtender(pointsPairLst):
         pointsPairLst.insert(0, [x, valueY])
     return pointsPairLst
 
-def extractSignalPixelPos(pixelsIn, pixelsOut, zoneLst):
+@timedStage()
+def extractSignalPixelPos(imgArrayIn, pixelsOut, zoneLst):
     # Extract the FFT line plot pixel positions of the PNG image.
-    lstPointPairs = []
-    for zone in zoneLst:
-        zonePoints = processZone(pixelsIn, pixelsOut, zone)
-        lstPointPairs += zonePoints 
+    # All the zones are processed with one single color mask.
+    signalColor = (signalColorR, signalColorG, signalColorB)
+    lstPointPairs = extractTracePixelPos(imgArrayIn, zoneLst, signalColor,
+                                         signalColorTolerance)
     return lstPointPairs
 
+@timedStage()
+def extractMultipleSignalsPixelPos(imgArrayIn, zoneLst, signalColorLst):
+    # Extract the FFT line plot pixel positions of several traces, ex: one
+    # for each channel, in one single pass over the PNG image.
+    return extractTracesPixelPos(imgArrayIn, zoneLst, signalColorLst,
+                                 signalColorTolerance)
+
+@timedStage()
 def markPointsInOutputImg(pointsPairLst, pixelsOut):
     # Add the marking over a copy of the input image for verification
     # of correctness, rapid validation to help in development.
@@ -334,6 +350,7 @@ def calculateVoltfactor(dBV):
     voltScaleFactor = math.pow(10.0, dBV / 20.0)
     return voltScaleFactor
 
+@timedStage()
 def mapToFreq_and_dB(pointsPairLst, pixelsOut):
     flag_function_debug = True
 
@@ -380,6 +397,7 @@ def getInterpolated_dB_for_freq(mappedPointsPairLst, freq, flag_print):
               str("%.4f" % interp_voltsFactor))
     return (freq, interp_dBV, interp_voltsFactor)
 
+@timedStage()
 def readFromCSVFile(inputPath, fileName):
     headerRow = None
     outputTable = []
@@ -397,6 +415,7 @@ def readFromCSVFile(inputPath, fileName):
             print(', '.join(row))      
     return (headerRow, outputTable)
 
+@timedStage()
 def writeToCSVFile(mappedPointsPairLst, pathOut, fileName, tableMode):
     with open(pathOut + fileName, mode='w', newline='') as tableFile:
         tableWriter = csv.writer(tableFile, delimiter=',', quotechar='"',
@@ -412,57 +431,76 @@ def writeToCSVFile(mappedPointsPairLst, pathOut, fileName, tableMode):
             # freq, dBV, voltsScaleFactor, x, y = point
             # tableWriter.writerow([freq, dBV, voltsScaleFactor, x, y])
 
+@timedStage()
 def calcFixedStepInterpolAttenuationTable(mappedPointsPairLst, freqStep,
                                           freqRange, flag_print):
     # Param: freqRange is a tuple "(startFreq, endFreq)".
+    # Note: The profile extends the range from 0Hz up to 1000MHz, so that
+    #       interpolation work well, see "attenuation_profile.py". All the
+    #       frequencies are interpolated in one single vectorized call.
+    profile = AttenuationProfile.fromMappedPointsPairLst(mappedPointsPairLst)
+    freqs, interp_dBV, interp_voltsFactor = profile.fixedStepTable(freqStep, freqRange)
+    fixedStepTable = list(zip(freqs.tolist(), interp_dBV.tolist(),
+                              interp_voltsFactor.tolist()))
     if flag_print == True:
         print("")  # Just to add a "\n". 
-    fixedStepTable = []
-    startFreq = freqRange[0]
-    endFreq   = freqRange[1]
-    numIntervals = int((endFreq - startFreq + freqStep) / freqStep)
-
-    # Extend the range from 0Hz up to 1000MHz, so that interpolation work well.
-    tmpPointsPairLst = mappedPointsPairLst.copy()
-    # Insert synthetic 0 MHz with 0.0 dBV value in the begining.
-    tmpIndex = 0
-    tmpFreq  = 0.0
-    tmp_dBV  = 0.0
-    tmpPointsPairLst.insert(tmpIndex, [tmpFreq, tmp_dBV])
-    # Append to the end 1 synthetic data point, 1 MHz past the last real value with -100 dBV.
-    lastIndex = len(tmpPointsPairLst) - 1
-    tmpFreq   = tmpPointsPairLst[lastIndex][0] + 1.0 # MHz
-    tmp_dBV   = -100.0
-    tmpPointsPairLst.append([tmpFreq, tmp_dBV])
-    # Append to the end 1 synthetic data point at 1 GHz with -100 dBV.
-    tmpFreq = 1000 # MHz
-    tmp_dBV = -100.0
-    tmpPointsPairLst.append([tmpFreq, tmp_dBV])
-
-    for intervalIndex in range(0, numIntervals):
-        freq = startFreq + freqStep * intervalIndex
-        dataPoint = getInterpolated_dB_for_freq(tmpPointsPairLst, freq, flag_print)
-        fixedStepTable.append(dataPoint)
-    if flag_print == True:
+        for freq, dBV, voltsFactor in fixedStepTable:
+            print("freq:", str(freq), "  dBV:", str("%.4f" % dBV), "  Volts scale factor:",
+                  str("%.4f" % voltsFactor))
         print("")  # Just to add a "\n". 
     return fixedStepTable
 
+def writeInstrumentationReport():
+    for line in formatReport():
+        print("...", line)
+    dumpReport(pathOut + fileInstrumentationReport)
+    if flag_write_chrome_trace == True:
+        dumpChromeTrace(pathOut + fileInstrumentationTrace)
+
+def runCachedMain():
+    # The same outputs of the "__main__", with the stage cache.
+    from incremental_extraction_pipeline import (StageCache, runCachedExtraction,
+                                                 defaultTableFileNames)
+    from batch_extract_profiles import defaultScopeConfig
+    stageCache = StageCache()
+    mappedPointsPairLst = runCachedExtraction(pathImgIn + fileImgIn, defaultScopeConfig(),
+                                              pathOut, defaultTableFileNames(), stageCache)
+    flag_print = True
+    for freq in (430.0, 500.0, 570.0):
+        getInterpolated_dB_for_freq(mappedPointsPairLst, freq, flag_print)
+    print("")
+    for line in stageCache.report():
+        print("...", line)
+
 ######
 # Main
 ######
 
-if __name__ == "__main__":
+if __name__ == "__main__" and flag_enable_instrumentation == True:
+    enableInstrumentation(flag_trace_memory)
+
+if __name__ == "__main__" and flag_use_stage_cache == True:
+    print("\nStarting...")
+    runCachedMain()
+    if flag_enable_instrumentation == True:
+        writeInstrumentationReport()
+    print("...end\n")
+
+elif __name__ == "__main__":
     # Load the scope PNG image from file.
     print("\nStarting...")
-    imgIn = Image.open(pathImgIn + fileImgIn)
+    with stageTimer("image_decode"):
+        imgIn = Image.open(pathImgIn + fileImgIn)
+        imgIn.load()
     print("...input scope PNG image loaded...\n")
     imgOut = imgIn.copy()
 
     # Image In and Out info. 
     sizeInX, sizeInY, pixelsIn = getImgInfo(imgIn)
     sizeOutX, sizeOutY, pixelsOut = getImgInfo(imgOut)
+    imgArrayIn = loadImageArray(imgIn)
     
-    pointsPairLst = extractSignalPixelPos(pixelsIn, pixelsOut, zoneLst)
+    pointsPairLst = extractSignalPixelPos(imgArrayIn, pixelsOut, zoneLst)
     pointsPairLst = startingPointsExtender(pointsPairLst)
     markPointsInOutputImg(pointsPairLst, pixelsOut)
     mappedPointsPairLst = mapToFreq_and_dB(pointsPairLst, pixelsOut)
@@ -506,9 +544,13 @@ if __name__ == "__main__":
     print("...output CSV  1 MHz step interpolated attenuation (0 Hz to 1GHz) file generated...")
 
     # Write the debug extrated points validaion of the scope processed output PNG image. 
-    imgOut.save(pathOut + fileImgOut)
+    with stageTimer("png_save"):
+        imgOut.save(pathOut + fileImgOut)
     print("...output extracted points validation scope processed PNG image file generated...")
 
+    if flag_enable_instrumentation == True:
+        writeInstrumentationReport()
+
     print("...end\n")
 
 
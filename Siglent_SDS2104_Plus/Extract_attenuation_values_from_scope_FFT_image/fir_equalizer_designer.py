@@ -0,0 +1,204 @@
+# Name: fir_equalizer_designer.py
+# Description: FIR equalizer designer for low latency time domain correction,
+#              ex: for live view, where there is no time to wait for a full
+#              record FFT.
+#              It designs a linear phase or a minimum phase FIR inverse filter
+#              from the attenuation table produced by
+#              "calcFixedStepInterpolAttenuationTable()" (or from any
+#              "AttenuationProfile"), with a given number of taps, a max gain
+#              limit (so that the -100 dBV tail doesn't explode into noise) and
+#              a passband edge (ex: the 945 MHz front end limit).
+#              The apply path picks the direct convolution or the FFT
+#              convolution by the size of the record and of the filter, so
+#              that short screen sized records are corrected with very low
+#              latency.
+#
+# Note 1: The linear phase filter has a constant delay of (numTaps - 1) / 2
+#         samples, that is removed by the apply path. It corrects the
+#         amplitude and the phase-shift of the profile.
+#         The minimum phase filter has almost no delay, but it only uses the
+#         amplitude of the profile (its phase is the minimum phase one for that
+#         amplitude, see Note 2).
+#
+# Note 2: The minimum phase spectrum is obtained by the real cepstrum method,
+#         the log magnitude is folded in the quefrency domain, so that all the
+#         zeros stay inside the unit circle. That is, the real cepstrum is the
+#         inverse FFT of the log magnitude, its negative quefrencies are
+#         added to the positive ones and zeroed, and the FFT and the exponential
+#         of the result give the minimum phase spectrum with the same magnitude.
+#
+# License:        MIT Open Source License
+#
+
+import time
+import numpy as np
+
+from attenuation_profile import AttenuationProfile
+from pipeline_instrumentation import timedStage
+from equalizer_response import (calcInverseGain, rfftFreqsMHz, applyProfileResponse,
+                                defaultSampleRate, defaultMaxGain_dB, frontEndLimitMHz)
+from streaming_equalizer import designOverlapSaveKernel, nextPowerOf2
+
+################
+# Configurations
+################
+
+pathTables = ".//output_out//"
+CSVFile_defaultTable = "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv"
+
+defaultNumTaps = 63
+
+# The dense frequency grid of the minimum phase design has this times the
+# number of taps.
+minPhaseDesignOversampling = 32
+
+# Magnitude floor for the log of the cepstrum, -120 dB.
+minPhaseMagnitudeFloor = 1e-6
+
+# Relative cost of one FFT convolution output sample for each log2 of the
+# FFT size, when compared with one direct convolution multiply accumulate.
+# Measured with NumPy, the direct path is faster for short filters.
+fftConvolutionCostFactor = 4.0
+
+###########
+# Constants
+###########
+
+LINEAR_PHASE  = "LINEAR_PHASE"
+MINIMUM_PHASE = "MINIMUM_PHASE"
+
+DIRECT_CONVOLUTION = "DIRECT_CONVOLUTION"
+FFT_CONVOLUTION    = "FFT_CONVOLUTION"
+
+###########
+# Functions
+###########
+
+def profileFromFixedStepTable(fixedStepTable):
+    # Param: fixedStepTable is the output of "calcFixedStepInterpolAttenuationTable()",
+    #        rows of (freq, dBV, voltScaleFactor).
+    table = np.array([row[:2] for row in fixedStepTable], dtype=np.float64)
+    return AttenuationProfile(table[:, 0], table[:, 1])
+
+def calcMinimumPhaseSpectrum(magnitude):
+    # Param: magnitude is sampled in the "np.fft.rfft()" bins of a grid with
+    #        2 * (len(magnitude) - 1) points.
+    # Returns the minimum phase complex spectrum with this magnitude, see Note 2.
+    gridSize = 2 * (magnitude.size - 1)
+    logMagnitude = np.log(np.maximum(magnitude, minPhaseMagnitudeFloor))
+    cepstrum = np.fft.irfft(logMagnitude, gridSize)
+    folded = np.zeros(gridSize, dtype=np.float64)
+    folded[0] = cepstrum[0]
+    folded[1:gridSize // 2] = 2.0 * cepstrum[1:gridSize // 2]
+    folded[gridSize // 2] = cepstrum[gridSize // 2]
+    return np.exp(np.fft.rfft(folded))
+
+def designMinimumPhaseFIR(profile, sampleRate, numTaps, maxGain_dB, passbandEdgeMHz):
+    gridSize = nextPowerOf2(numTaps * minPhaseDesignOversampling)
+    gain = calcInverseGain(profile, rfftFreqsMHz(gridSize, sampleRate), maxGain_dB,
+                           passbandEdgeMHz)
+    impulse = np.fft.irfft(calcMinimumPhaseSpectrum(gain), gridSize)[:numTaps]
+    # Right half of a Blackman window, the energy of a minimum phase filter
+    # is concentrated in the first taps.
+    return impulse * np.blackman(2 * numTaps + 1)[numTaps:-1]
+
+@timedStage()
+def designFIREqualizer(profile, sampleRate = defaultSampleRate, numTaps = defaultNumTaps,
+                       maxGain_dB = defaultMaxGain_dB, passbandEdgeMHz = frontEndLimitMHz,
+                       phaseMode = LINEAR_PHASE):
+    # Returns the FIR equalizer taps, see Note 1.
+    if phaseMode == LINEAR_PHASE:
+        return designOverlapSaveKernel(profile, sampleRate, numTaps, maxGain_dB,
+                                       passbandEdgeMHz)
+    elif phaseMode == MINIMUM_PHASE:
+        return designMinimumPhaseFIR(profile, sampleRate, numTaps, maxGain_dB,
+                                     passbandEdgeMHz)
+    raise ValueError("Unknown phase mode: " + str(phaseMode))
+
+def chooseConvolutionMethod(numSamples, numTaps):
+    # Simple cost model of the two convolution paths.
+    directCost = float(numSamples) * numTaps
+    fftSize = nextPowerOf2(numSamples + numTaps - 1)
+    fftCost = fftConvolutionCostFactor * fftSize * np.log2(fftSize)
+    return DIRECT_CONVOLUTION if directCost <= fftCost else FFT_CONVOLUTION
+
+def fftConvolve(samples, taps):
+    # Full linear convolution with one FFT.
+    outSize = samples.size + taps.size - 1
+    fftSize = nextPowerOf2(outSize)
+    spectrum = np.fft.rfft(samples, fftSize)
+    spectrum *= np.fft.rfft(taps, fftSize)
+    return np.fft.irfft(spectrum, fftSize)[:outSize]
+
+@timedStage()
+def applyFIR(samples, taps, delay = 0, method = None):
+    # Filters the record and removes the filter delay, the output has the
+    # same length as the input.
+    samples = np.asarray(samples, dtype=np.float64)
+    if samples.size == 0:
+        return np.empty(0, dtype=np.float64)
+    if method is None:
+        method = chooseConvolutionMethod(samples.size, taps.size)
+    if method == DIRECT_CONVOLUTION:
+        full = np.convolve(samples, taps)
+    else:
+        full = fftConvolve(samples, taps)
+    return full[delay:delay + samples.size]
+
+#########
+# Classes
+#########
+
+class FIREqualizer:
+
+    def __init__(self, profile, sampleRate = defaultSampleRate, numTaps = defaultNumTaps,
+                 maxGain_dB = defaultMaxGain_dB, passbandEdgeMHz = frontEndLimitMHz,
+                 phaseMode = LINEAR_PHASE):
+        self.sampleRate = sampleRate
+        self.phaseMode  = phaseMode
+        self.taps = designFIREqualizer(profile, sampleRate, numTaps, maxGain_dB,
+                                       passbandEdgeMHz, phaseMode)
+        self.taps.flags.writeable = False
+        self.numTaps = self.taps.size
+        self.delay = (self.numTaps - 1) // 2 if phaseMode == LINEAR_PHASE else 0
+
+    @classmethod
+    def fromFixedStepTable(cls, fixedStepTable, **kwargs):
+        return cls(profileFromFixedStepTable(fixedStepTable), **kwargs)
+
+    def apply(self, samples, method = None):
+        return applyFIR(samples, self.taps, self.delay, method)
+
+    def frequencyResponse(self, numPoints = 1024):
+        # Returns (freqMHz, complex response) of the designed filter, with the
+        # linear phase delay removed.
+        gridSize = 2 * (numPoints - 1)
+        freqMHz = rfftFreqsMHz(gridSize, self.sampleRate)
+        response = np.fft.rfft(self.taps, gridSize)
+        response *= np.exp(2j * np.pi * np.arange(response.size) * self.delay / gridSize)
+        return (freqMHz, response)
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    print("\nStarting...")
+    profile = AttenuationProfile.fromCSVFile(pathTables, CSVFile_defaultTable)
+    sampleRate = defaultSampleRate
+    numSamples = 1400
+    timeAxis = np.arange(numSamples) / sampleRate
+    original = np.sign(np.sin(2.0 * np.pi * 50.0e6 * timeAxis + 0.1))
+    captured = applyProfileResponse(original, sampleRate, profile)
+    for phaseMode in (LINEAR_PHASE, MINIMUM_PHASE):
+        equalizer = FIREqualizer(profile, sampleRate, phaseMode=phaseMode)
+        startTime = time.perf_counter()
+        corrected = equalizer.apply(captured)
+        elapsedTime = time.perf_counter() - startTime
+        middle = slice(equalizer.numTaps, numSamples - equalizer.numTaps)
+        print("...", phaseMode, " method:", chooseConvolutionMethod(numSamples, equalizer.numTaps),
+              " latency us: %.1f" % (elapsedTime * 1e6),
+              " RMS error captured: %.5f" % np.sqrt(np.mean((captured[middle] - original[middle]) ** 2)),
+              " corrected: %.5f" % np.sqrt(np.mean((corrected[middle] - original[middle]) ** 2)))
+    print("...end\n")
+
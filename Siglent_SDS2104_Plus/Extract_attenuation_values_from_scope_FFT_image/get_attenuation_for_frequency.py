@@ -0,0 +1,176 @@
+# Name: get_attenuation_for_frequency.py
+# Description: Lookup service that gives the attenuation of the scope at any
+#              frequency, to be used by the equalizer that asks for the
+#              attenuation millions of times for each capture.
+#              The "dbVAttenuationTable_*" data is loaded into an index:
+#                -Uniform grid tables (ex: the 1 MHz and 10 MHz step tables)
+#                 use a direct slot calculation, "(freq - startFreq) / step",
+#                 so each lookup is O(1) and not a search.
+#                -Non uniform tables (ex: the original pixel frequencies table)
+#                 fall back to an index based on "np.searchsorted()".
+#              Repeated scalar queries hit a bounded LRU cache, with the hit
+#              and miss counters exposed so that the cache can be sized.
+#
+# Note 1: The interpolation is linear in dBV, like "np.interp()", and the
+#         frequencies outside the table are clamped to the end values. Then
+#         the Volts scale factor is calculated from the interpolated dBV.
+#
+# Note 2: Frequencies are in MHz, like in the CSV tables.
+#
+# License:        MIT Open Source License
+#
+
+import functools
+import math
+import numpy as np
+
+from attenuation_profile import AttenuationProfile, calculateVoltfactorArray
+
+################
+# Configurations
+################
+
+pathTables = ".//output_out//"
+CSVFile_defaultTable = "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv"
+
+defaultCacheSize = 4096
+
+# Relative tolerance in the step size to consider a table an uniform grid.
+uniformGridRelTolerance = 1e-9
+
+#########
+# Classes
+#########
+
+class UniformGridIndex:
+    # O(1) index, the slot of a frequency is calculated directly.
+
+    def __init__(self, freqMHz, values):
+        self.startFreq = float(freqMHz[0])
+        self.lastSlot  = freqMHz.size - 2
+        self.freqMHz   = np.ascontiguousarray(freqMHz, dtype=np.float64)
+        self.values    = np.ascontiguousarray(values, dtype=np.float64)
+        self.slopes    = self.calcSlopes()
+        # Python lists for the scalar path, they are faster then NumPy scalars.
+        self._freqLst  = self.freqMHz.tolist()
+        self._valueLst = self.values.tolist()
+        self._slopeLst = self.slopes.tolist()
+        self.minFreq = self._freqLst[0]
+        self.maxFreq = self._freqLst[-1]
+
+    def calcSlopes(self):
+        self.step    = float(self.freqMHz[1] - self.freqMHz[0])
+        self.invStep = 1.0 / self.step
+        return np.diff(self.values) * self.invStep
+
+    def slotArray(self, freqs):
+        slots = ((freqs - self.startFreq) * self.invStep).astype(np.int64)
+        return np.clip(slots, 0, self.lastSlot)
+
+    def slotScalar(self, freq):
+        slot = int((freq - self.startFreq) * self.invStep)
+        return min(max(slot, 0), self.lastSlot)
+
+    def lookupArray(self, freqs):
+        freqs = np.clip(np.asarray(freqs, dtype=np.float64), self.minFreq, self.maxFreq)
+        slots = self.slotArray(freqs)
+        return self.values[slots] + (freqs - self.freqMHz[slots]) * self.slopes[slots]
+
+    def lookupScalar(self, freq):
+        freq = min(max(freq, self.minFreq), self.maxFreq)
+        slot = self.slotScalar(freq)
+        return self._valueLst[slot] + (freq - self._freqLst[slot]) * self._slopeLst[slot]
+
+class SortedGridIndex(UniformGridIndex):
+    # O(log n) index for non uniform tables, the slot is found with a binary search.
+
+    def calcSlopes(self):
+        # There is no fixed step, ex: the first two frequencies can be equal.
+        deltaFreq = np.diff(self.freqMHz)
+        # Repeated frequencies have a zero slope, the first value is used.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(deltaFreq > 0.0, np.diff(self.values) / deltaFreq, 0.0)
+
+    def slotArray(self, freqs):
+        slots = np.searchsorted(self.freqMHz, freqs, side='right') - 1
+        return np.clip(slots, 0, self.lastSlot)
+
+    def slotScalar(self, freq):
+        slot = int(np.searchsorted(self.freqMHz, freq, side='right')) - 1
+        return min(max(slot, 0), self.lastSlot)
+
+class AttenuationLookup:
+
+    def __init__(self, profile, cacheSize = defaultCacheSize):
+        if len(profile) < 2:
+            raise ValueError("The attenuation table needs at least two points.")
+        self.profile = profile
+        self.index   = buildIndex(profile.freqMHz, profile.dBV)
+        self._cached_dB_for_freq = functools.lru_cache(maxsize=cacheSize)(self.index.lookupScalar)
+
+    @classmethod
+    def fromCSVFile(cls, inputPath = pathTables, fileName = CSVFile_defaultTable,
+                    cacheSize = defaultCacheSize):
+        return cls(AttenuationProfile.fromCSVFile(inputPath, fileName), cacheSize)
+
+    def isUniformGrid(self):
+        return not isinstance(self.index, SortedGridIndex)
+
+    def db(self, freqs):
+        # Attenuation in dBV for a scalar frequency or an array of frequencies.
+        if np.ndim(freqs) == 0:
+            return self._cached_dB_for_freq(float(freqs))
+        return self.index.lookupArray(freqs)
+
+    def volt_factor(self, freqs):
+        # Volts scale factor for a scalar frequency or an array of frequencies.
+        if np.ndim(freqs) == 0:
+            return math.pow(10.0, self.db(freqs) / 20.0)
+        return calculateVoltfactorArray(self.db(freqs))
+
+    def getAttenuationForFreq(self, freq):
+        # Returns the tuple (freq, dBV, voltScaleFactor) like
+        # "getInterpolated_dB_for_freq()".
+        dBV = self.db(freq)
+        return (freq, dBV, math.pow(10.0, dBV / 20.0))
+
+    def cacheInfo(self):
+        # Named tuple with the hits, misses, maxsize and currsize of the LRU cache.
+        return self._cached_dB_for_freq.cache_info()
+
+    def cacheClear(self):
+        self._cached_dB_for_freq.cache_clear()
+
+###########
+# Functions
+###########
+
+def isUniformGrid(freqMHz):
+    if freqMHz.size < 2:
+        return False
+    deltaFreq = np.diff(freqMHz)
+    step = deltaFreq[0]
+    if step <= 0.0:
+        return False
+    return bool(np.all(np.abs(deltaFreq - step) <= abs(step) * uniformGridRelTolerance))
+
+def buildIndex(freqMHz, values):
+    if isUniformGrid(freqMHz):
+        return UniformGridIndex(freqMHz, values)
+    return SortedGridIndex(freqMHz, values)
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    print("\nStarting...")
+    attenuationLookup = AttenuationLookup.fromCSVFile()
+    print("...table loaded, uniform grid index:", attenuationLookup.isUniformGrid())
+    for freq in (430.0, 500.0, 570.0, 570.0):
+        freq, dBV, voltsFactor = attenuationLookup.getAttenuationForFreq(freq)
+        print("freq:", str(freq), "  dBV:", str("%.4f" % dBV), "  Volts scale factor:",
+              str("%.4f" % voltsFactor))
+    print(attenuationLookup.cacheInfo())
+    print("...end\n")
+
@@ -0,0 +1,282 @@
+# Name: incremental_extraction_pipeline.py
+# Description: Content addressed incremental cache for the stages of the
+#              extraction pipeline, so that a re-run only recomputes the stages
+#              that are stale.
+#              The stages are: image load, "extractSignalPixelPos()",
+#              "startingPointsExtender()", "mapToFreq_and_dB()", the fixed step
+#              tables, the CSV files and the debug PNG image. The output of each
+#              stage is stored on disk under the hash of its inputs, that is,
+#              the image bytes and the config values that the stage uses,
+#              chained with the hashes of the stages before it.
+#              Because the keys only depend on the inputs, and not on the
+#              outputs, a stage whose output is in the cache never needs the
+#              stages before it, ex: when only the output step changed, the
+#              image isn't even decoded.
+#              The cache hits and misses are reported for each stage.
+#
+# Note 1: The config is the same of "batch_extract_profiles.py" and the default
+#         config reproduces the outputs of the extractor module "__main__".
+#
+# Note 2: The keys only hash the inputs, so they also include a version of the
+#         code, "stageCacheVersion" for the cache format and of each stage in
+#         "stageCodeVersions". Bump the version of a stage when its code (or the
+#         code it calls in the extractor module) changes the output, and the
+#         stage and all the stages after it are recomputed.
+#
+# Note 3: The output files (CSV and PNG) are also cached, if an output file
+#         already has the content of the cached stage output, it isn't
+#         written again.
+#
+# License:        MIT Open Source License
+#
+
+import csv
+import hashlib
+import io
+import os
+import pickle
+import time
+from PIL import Image
+
+import extract_attenuation_values_from_scope_fft_image as extractor
+from attenuation_profile import AttenuationProfile
+from pipeline_instrumentation import stageTimer, incrementCounter
+from batch_extract_profiles import extendStartingPoints, mapPointsToFreq_and_dB, hexColorToRGB
+from vectorized_trace_extractor import loadImageArray, extractTracePixelPos
+
+################
+# Configurations
+################
+
+pathStageCache = ".//stage_cache//"
+
+# Versions of the cache format and of the code of each stage, see Note 2.
+stageCacheVersion = 1
+stageCodeVersions = {"image_load":               1,
+                     "extract_signal_pixel_pos": 1,
+                     "starting_points_extender": 1,
+                     "map_to_freq_and_dB":       1,
+                     "csv_original_freq":        1,
+                     "fixed_step_table":         1,
+                     "csv_fixed_step_table":     1,
+                     "debug_png":                1}
+
+#########
+# Classes
+#########
+
+class StageCache:
+
+    def __init__(self, pathCache = pathStageCache, flag_enabled = True):
+        self.pathCache = pathCache
+        self.flag_enabled = flag_enabled
+        self.stageStats = {}
+
+    def makeKey(self, *parts):
+        # Hash of the key parts, bytes are hashed as they are and the other
+        # values by their "repr()", salted by the cache version, see Note 2.
+        sha = hashlib.sha256()
+        for part in (stageCacheVersion,) + parts:
+            partBytes = part if isinstance(part, bytes) else repr(part).encode("utf-8")
+            sha.update(len(partBytes).to_bytes(8, "little"))
+            sha.update(partBytes)
+        return sha.hexdigest()
+
+    def _stats(self, stageName):
+        return self.stageStats.setdefault(stageName, {"hits": 0, "misses": 0, "seconds": 0.0})
+
+    def _fileName(self, stageName, key):
+        return os.path.join(self.pathCache, stageName, key + ".pkl")
+
+    def get(self, stageName, key, computeFn):
+        # Returns the cached output of the stage, or computes and stores it.
+        startTime = time.perf_counter()
+        stats = self._stats(stageName)
+        fileName = self._fileName(stageName, key)
+        if self.flag_enabled and os.path.exists(fileName):
+            with stageTimer("stage_cache_load." + stageName):
+                with open(fileName, mode='rb') as cacheFile:
+                    value = pickle.load(cacheFile)
+            stats["hits"] += 1
+            incrementCounter("stage_cache.%s.hits" % stageName)
+        else:
+            with stageTimer("stage_compute." + stageName):
+                value = computeFn()
+            stats["misses"] += 1
+            incrementCounter("stage_cache.%s.misses" % stageName)
+            if self.flag_enabled:
+                os.makedirs(os.path.dirname(fileName), exist_ok=True)
+                tmpFileName = fileName + ".tmp"
+                with open(tmpFileName, mode='wb') as cacheFile:
+                    pickle.dump(value, cacheFile, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmpFileName, fileName)
+        # The time of the upstream stages computed inside "computeFn" is also
+        # counted here, the report is of the time spent to get each output.
+        stats["seconds"] += time.perf_counter() - startTime
+        return value
+
+    def ensureFile(self, stageName, key, fileNameOut, produceBytesFn):
+        # Makes sure that the output file has the content of the stage, see Note 3.
+        content = self.get(stageName, key, produceBytesFn)
+        if os.path.exists(fileNameOut):
+            with open(fileNameOut, mode='rb') as fileOut:
+                if fileOut.read() == content:
+                    return
+        with open(fileNameOut, mode='wb') as fileOut:
+            fileOut.write(content)
+
+    def report(self):
+        lines = []
+        for stageName, stats in self.stageStats.items():
+            lines.append("%-26s hits: %3d  misses: %3d  time: %8.3f ms" %
+                         (stageName, stats["hits"], stats["misses"], stats["seconds"] * 1e3))
+        return lines
+
+###########
+# Functions
+###########
+
+def tableToCSVBytes(table, tableMode):
+    # The same CSV content of "writeToCSVFile()", in memory.
+    stringOut = io.StringIO(newline='')
+    tableWriter = csv.writer(stringOut, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    if tableMode == extractor.SHORT_TABLE_MODE:
+        tableWriter.writerow(extractor.shortTableHeaderCSV)
+    elif tableMode == extractor.LONG_TABLE_MODE:
+        tableWriter.writerow(extractor.longTableHeaderCSV)
+    for point in table:
+        tableWriter.writerow(point)
+    return stringOut.getvalue().encode("utf-8")
+
+def renderDebugImageBytes(imageBytes, pointsPairLst, config):
+    # Marks the extracted points and the grid over a copy of the input image,
+    # with the same markers of "markPointsInOutputImg()" and "mapToFreq_and_dB()".
+    imgOut = Image.open(io.BytesIO(imageBytes))
+    imgOut.load()
+    pixelsOut = imgOut.load()
+    white = (extractor.outputSignalMarkerColorR, extractor.outputSignalMarkerColorG,
+             extractor.outputSignalMarkerColorB)
+    red   = (extractor.outputSignalMarkerInitialExtensionColorR,
+             extractor.outputSignalMarkerInitialExtensionColorG,
+             extractor.outputSignalMarkerInitialExtensionColorB)
+    green = (0x00, 0xFF, 0x00)
+    zone_0_lowerX = config["zones"][0][0]
+    if extractor.flag_mark_4_corners_graph_limits == True:
+        for x in (config["graphMinX"], extractor.maxX_GraphLimit):
+            for y in (extractor.minY_GraphLimit, config["graphMaxY"]):
+                pixelsOut[x, round(y)] = white
+    if extractor.flag_plot_extracted_signal_points == True:
+        for x, y in pointsPairLst:
+            pixelsOut[x, round(y)] = red if x < zone_0_lowerX else white
+    if extractor.flag_mark_left_grid_Y_points == True:
+        for y, _ in config["gridY"]:
+            pixelsOut[config["graphMinX"], y] = green
+    if extractor.flag_mark_bottom_grid_X_points == True:
+        for x, _ in config["gridX"]:
+            pixelsOut[x, config["graphMaxY"]] = green
+    dB_zero_point = pointsPairLst[zone_0_lowerX - config["graphMinX"] + 1]
+    pixelsOut[dB_zero_point[0], dB_zero_point[1]] = green
+    bytesOut = io.BytesIO()
+    imgOut.save(bytesOut, format="PNG")
+    return bytesOut.getvalue()
+
+def debugImageSettings():
+    # The settings of the extractor module used by "renderDebugImageBytes()".
+    return (extractor.flag_mark_4_corners_graph_limits,
+            extractor.flag_plot_extracted_signal_points,
+            extractor.flag_mark_left_grid_Y_points,
+            extractor.flag_mark_bottom_grid_X_points,
+            extractor.maxX_GraphLimit, extractor.minY_GraphLimit,
+            extractor.outputSignalMarkerColorR, extractor.outputSignalMarkerColorG,
+            extractor.outputSignalMarkerColorB,
+            extractor.outputSignalMarkerInitialExtensionColorR,
+            extractor.outputSignalMarkerInitialExtensionColorG,
+            extractor.outputSignalMarkerInitialExtensionColorB)
+
+def runCachedExtraction(imageFileName, config, pathOut, tableFileNames, stageCache):
+    # Runs the extraction pipeline with the stage cache.
+    # Param: tableFileNames is a dictionary {freqStep: CSV file name}.
+    # Returns the mapped points.
+    with open(imageFileName, mode='rb') as imageFile:
+        imageBytes = imageFile.read()
+
+    # The keys of all the stages, chained, see the Description.
+    # The code version of each stage is chained too, see Note 2.
+    versions = stageCodeVersions
+    imageKey   = stageCache.makeKey("image", versions["image_load"], imageBytes)
+    extractKey = stageCache.makeKey(imageKey, versions["extract_signal_pixel_pos"],
+                                    config["zones"], config["traceColor"],
+                                    config["colorTolerance"])
+    extendKey  = stageCache.makeKey(extractKey, versions["starting_points_extender"],
+                                    config["extendStartingPoints"], config["graphMinX"])
+    mapKey     = stageCache.makeKey(extendKey, versions["map_to_freq_and_dB"], config["gridX"],
+                                    config["gridY"], config["zones"][0][0], config["graphMinX"])
+
+    def loadImage():
+        with Image.open(io.BytesIO(imageBytes)) as imgIn:
+            return loadImageArray(imgIn)
+
+    def extractPoints():
+        imgArrayIn = stageCache.get("image_load", imageKey, loadImage)
+        return extractTracePixelPos(imgArrayIn, config["zones"],
+                                    hexColorToRGB(config["traceColor"]),
+                                    config["colorTolerance"])
+
+    def extendPoints():
+        pointsPairLst = stageCache.get("extract_signal_pixel_pos", extractKey, extractPoints)
+        if config["extendStartingPoints"] == True:
+            return extendStartingPoints(pointsPairLst, config["graphMinX"])
+        return pointsPairLst
+
+    def getExtendedPoints():
+        return stageCache.get("starting_points_extender", extendKey, extendPoints)
+
+    def getMappedPoints():
+        return stageCache.get("map_to_freq_and_dB", mapKey,
+                              lambda: mapPointsToFreq_and_dB(getExtendedPoints(), config))
+
+    stageCache.ensureFile("csv_original_freq", stageCache.makeKey(mapKey, "csv",
+                                                               versions["csv_original_freq"]),
+                          pathOut + extractor.CSVFile_dbVAttenuationTable_OriginalFreq,
+                          lambda: tableToCSVBytes(getMappedPoints(), extractor.LONG_TABLE_MODE))
+
+    for freqStep, fileName in tableFileNames.items():
+        tableKey = stageCache.makeKey(mapKey, versions["fixed_step_table"], freqStep,
+                                      config["freqRange"])
+
+        def calcTable(freqStep = freqStep):
+            profile = AttenuationProfile.fromMappedPointsPairLst(getMappedPoints())
+            freqs, dBV, voltsFactor = profile.fixedStepTable(freqStep, tuple(config["freqRange"]))
+            return list(zip(freqs.tolist(), dBV.tolist(), voltsFactor.tolist()))
+
+        def calcCSV(tableKey = tableKey, calcTable = calcTable):
+            table = stageCache.get("fixed_step_table", tableKey, calcTable)
+            return tableToCSVBytes(table, extractor.SHORT_TABLE_MODE)
+
+        stageCache.ensureFile("csv_fixed_step_table", stageCache.makeKey(tableKey, "csv",
+                                                               versions["csv_fixed_step_table"]),
+                              pathOut + fileName, calcCSV)
+
+    # The rendering flags and the marker colors of the extractor are also
+    # inputs of the debug image.
+    debugKey = stageCache.makeKey(imageKey, extendKey, versions["debug_png"], config["gridX"],
+                                  config["gridY"], config["graphMaxY"], debugImageSettings())
+    stageCache.ensureFile("debug_png", debugKey, pathOut + extractor.fileImgOut,
+                          lambda: renderDebugImageBytes(imageBytes, getExtendedPoints(),
+                                                        config))
+    return getMappedPoints()
+
+def defaultTableFileNames():
+    # The fixed step tables of the extractor module "__main__".
+    return {10.0: extractor.CSVFile_dbVAttenuationTable_interpolated_10M_Step,
+            1.0:  extractor.CSVFile_dbVAttenuationTable_interpolated_1M_Step}
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    print("\nStarting...")
+    extractor.runCachedMain()
+    print("...end\n")
+
@@ -10,7 +10,7 @@
 #
 # TODO:
 #     -Loading of CSV data information.  
-#     -Smooth function. ex: Running average
+#     -Smooth function. ex: Running average  (done, see "attenuation_smoothing.py")
 #     -Interpolation
 #     -Graph visualization
 #
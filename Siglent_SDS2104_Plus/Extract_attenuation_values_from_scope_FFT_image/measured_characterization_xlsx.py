@@ -0,0 +1,226 @@
+# Name: measured_characterization_xlsx.py
+# Description: Reader of the frequency response measured one frequency at a
+#              time with a generator, in the spreadsheet
+#              "Data_collected/Osciloscope_20MHz_bandwidth_limit_v04.xlsx".
+#              For each frequency the sheet has the Volts with the full
+#              bandwidth and with the 20 MHz bandwidth limit, and the time
+#              delay between them, so it has the amplitude and the phase-shift
+#              of the 20 MHz bandwidth limit filter.
+#
+# Default layout, sheet "Folha1", one frequency per row from row 8:
+#   B  Freq. MHz
+#   C  V FullBand
+#   D  V 20MHz
+#   E  V normalized         =ROUND(D/C, 4)
+#   H  delta_T              ns
+#   I  delta_corr           ns
+#   J  TotDelta_T ns        =H+I
+#   K  1º Degree nS         =ROUND(((1/B)/360)*1000, 4)
+#   L  phase_shift degrees  =ROUND(J/K, 4)
+#   M  inv phase            =-L
+#
+# Other workbooks of the same measurement can have another sheet name, first
+# row and columns, they are parameters of the readers, ex:
+#   readMeasuredCharacterization(fileName, "Sheet1",
+#                                dict(defaultColumnLetters, deltaCorr_ns="J"), 2)
+#
+# Note 1: The formula cells are saved by the spreadsheet program without the
+#         calculated values, so the formulas of the columns E to M are
+#         calculated here from the measured columns B, C, D, H and I, with the
+#         same rounding of the sheet.
+#
+# Note 2: The phase of the profiles is the phase-shift of the scope signal
+#         path, negative for a delay. The measured delay is positive, so the
+#         profile phase is the column M, "inv phase".
+#
+# Note 3: openpyxl is only needed to read the spreadsheet, it's imported only
+#         if it's installed.
+#
+# Note 4: Parsing the spreadsheet takes hundreds of ms, "loadMeasuredProfile()"
+#         caches the profile of each spreadsheet in the binary profile format
+#         (".ofrp", see "binary_profile_format.py"), named with the hash of the
+#         spreadsheet content, so a changed spreadsheet is parsed again and an
+#         unchanged one is loaded memory-mapped in about a millisecond. With the
+#         cache, openpyxl is only needed for the new spreadsheets.
+#         The hash also includes "PARSER_VERSION" and the layout (sheet, columns
+#         and first row), bump the version when the parsing or the formulas
+#         change the profile (ex: the sign of the phase), so that the profiles
+#         cached by the old code aren't used.
+#
+# License:        MIT Open Source License
+#
+
+import hashlib
+import os
+import time
+import numpy as np
+
+from attenuation_profile import AttenuationProfile
+from binary_profile_format import writeBinaryProfileFile, loadBinaryProfile, binaryProfileExtension
+from pipeline_instrumentation import incrementCounter
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+################
+# Configurations
+################
+
+pathDataCollected = "..//Data_collected//"
+XLSXFile_20MHzBandwidthLimit = "Osciloscope_20MHz_bandwidth_limit_v04.xlsx"
+
+pathMeasuredCache = ".//measured_cache//"
+
+###########
+# Constants
+###########
+
+SHEET_NAME = "Folha1"
+FIRST_DATA_ROW = 8
+
+COLUMN_FREQ_MHz      = "B"
+COLUMN_V_FULL_BAND   = "C"
+COLUMN_V_LIMITED     = "D"
+COLUMN_DELTA_T_ns    = "H"
+COLUMN_DELTA_CORR_ns = "I"
+
+defaultColumnLetters = {"freqMHz": COLUMN_FREQ_MHz, "vFullBand": COLUMN_V_FULL_BAND,
+                        "vLimited": COLUMN_V_LIMITED, "deltaT_ns": COLUMN_DELTA_T_ns,
+                        "deltaCorr_ns": COLUMN_DELTA_CORR_ns}
+
+# Version of the parsing and of the formulas, in the cache names, see Note 4.
+PARSER_VERSION = 1
+
+###########
+# Functions
+###########
+
+def roundLikeSheet(values, numDigits):
+    # The spreadsheet ROUND() rounds the halves away from zero, "np.round()"
+    # rounds them to the even number.
+    scale = 10.0 ** numDigits
+    scaled = np.asarray(values, dtype=np.float64) * scale
+    return np.sign(scaled) * np.floor(np.abs(scaled) + 0.5) / scale
+
+def readMeasuredColumns(fileName, sheetName = SHEET_NAME, columnLetters = None,
+                        firstDataRow = FIRST_DATA_ROW):
+    # Returns a dict with the float64 arrays of the measured columns, see Note 3.
+    # Param: columnLetters dict {column name: letter}, None for
+    #        "defaultColumnLetters", it must have all of its names.
+    if openpyxl is None:
+        raise RuntimeError("openpyxl is needed to read the spreadsheet: " + fileName)
+    columnLetters = defaultColumnLetters if columnLetters is None else columnLetters
+    missingNames = set(defaultColumnLetters) - set(columnLetters)
+    if missingNames:
+        raise ValueError("Missing columns: " + ", ".join(sorted(missingNames)))
+    workbook = openpyxl.load_workbook(fileName, read_only=True, data_only=False)
+    try:
+        if sheetName not in workbook.sheetnames:
+            raise ValueError("There is no sheet %s in %s, the sheets are: %s." %
+                             (sheetName, fileName, ", ".join(workbook.sheetnames)))
+        sheet = workbook[sheetName]
+        columnIndexes = [(openpyxl.utils.column_index_from_string(letter) - 1, name)
+                         for name, letter in columnLetters.items()]
+        freqIndex = openpyxl.utils.column_index_from_string(columnLetters["freqMHz"]) - 1
+        columns = {name: [] for name in columnLetters}
+        for row in sheet.iter_rows(min_row=firstDataRow, values_only=True):
+            if len(row) <= max(index for index, _ in columnIndexes) or row[freqIndex] is None:
+                # The data ends at the first row without frequency.
+                break
+            for index, name in columnIndexes:
+                if not isinstance(row[index], (int, float)):
+                    raise ValueError("Not a number in the column %s of the row with the "
+                                     "frequency %s MHz." % (name, row[freqIndex]))
+                columns[name].append(float(row[index]))
+    finally:
+        workbook.close()
+    return {name: np.array(values, dtype=np.float64) for name, values in columns.items()}
+
+def calcDerivedColumns(columns):
+    # The formulas of the sheet, see Note 1.
+    freqMHz = columns["freqMHz"]
+    voltsNormalized = roundLikeSheet(columns["vLimited"] / columns["vFullBand"], 4)
+    totalDelay_ns = columns["deltaT_ns"] + columns["deltaCorr_ns"]
+    nsPerDegree = roundLikeSheet(((1.0 / freqMHz) / 360.0) * 1000.0, 4)
+    phaseShiftDeg = roundLikeSheet(totalDelay_ns / nsPerDegree, 4)
+    derived = dict(columns)
+    derived.update({"voltsNormalized": voltsNormalized, "totalDelay_ns": totalDelay_ns,
+                    "nsPerDegree": nsPerDegree, "phaseShiftDeg": phaseShiftDeg,
+                    "invPhaseDeg": -phaseShiftDeg,
+                    "dBV": 20.0 * np.log10(voltsNormalized)})
+    return derived
+
+def readMeasuredCharacterization(fileName, sheetName = SHEET_NAME, columnLetters = None,
+                                 firstDataRow = FIRST_DATA_ROW):
+    return calcDerivedColumns(readMeasuredColumns(fileName, sheetName, columnLetters,
+                                                  firstDataRow))
+
+def profileFromMeasuredCharacterization(measured):
+    # The profile of the 20 MHz bandwidth limit, with the phase, see Note 2.
+    return AttenuationProfile(measured["freqMHz"], measured["dBV"], measured["invPhaseDeg"])
+
+def hashFileContent(fileName, chunkSize = 1 << 20):
+    sha = hashlib.sha256()
+    with open(fileName, mode='rb') as inputFile:
+        for chunk in iter(lambda: inputFile.read(chunkSize), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def cachedProfileFileName(fileName, fileHash, sheetName = SHEET_NAME, columnLetters = None,
+                          firstDataRow = FIRST_DATA_ROW):
+    # The name of the cached profile, with the hash of the spreadsheet content,
+    # of the parser version and of the layout, see Note 4.
+    columnLetters = defaultColumnLetters if columnLetters is None else columnLetters
+    key = repr((PARSER_VERSION, fileHash, sheetName, sorted(columnLetters.items()),
+                firstDataRow))
+    stem = os.path.splitext(os.path.basename(fileName))[0]
+    return "%s_v%d_%s%s" % (stem, PARSER_VERSION,
+                            hashlib.sha256(key.encode("utf-8")).hexdigest()[:16],
+                            binaryProfileExtension)
+
+def loadMeasuredProfile(fileName, pathCache = pathMeasuredCache, sheetName = SHEET_NAME,
+                        columnLetters = None, firstDataRow = FIRST_DATA_ROW):
+    # The profile of a spreadsheet, from the binary cache when the spreadsheet
+    # didn't change, see Note 4.
+    # Param: pathCache None to always parse the spreadsheet.
+    def parseProfile():
+        return profileFromMeasuredCharacterization(
+            readMeasuredCharacterization(fileName, sheetName, columnLetters, firstDataRow))
+    if pathCache is None:
+        return parseProfile()
+    cacheFileName = cachedProfileFileName(fileName, hashFileContent(fileName), sheetName,
+                                          columnLetters, firstDataRow)
+    if os.path.exists(pathCache + cacheFileName):
+        incrementCounter("measured_cache.hits")
+        return loadBinaryProfile(pathCache, cacheFileName)
+    incrementCounter("measured_cache.misses")
+    profile = parseProfile()
+    os.makedirs(pathCache, exist_ok=True)
+    # Written to a temporary file and renamed, so that a concurrent reader
+    # never sees a partial profile.
+    tmpFileName = cacheFileName + ".tmp"
+    writeBinaryProfileFile(profile, pathCache, tmpFileName)
+    os.replace(pathCache + tmpFileName, pathCache + cacheFileName)
+    return loadBinaryProfile(pathCache, cacheFileName)
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    print("\nStarting...")
+    measured = readMeasuredCharacterization(pathDataCollected + XLSXFile_20MHzBandwidthLimit)
+    for freq, volts, dBV, phase in zip(measured["freqMHz"], measured["voltsNormalized"],
+                                       measured["dBV"], measured["invPhaseDeg"]):
+        print("...freq MHz: %6.2f  V normalized: %.4f  dBV: %8.4f  phase degrees: %9.4f" %
+              (freq, volts, dBV, phase))
+    print("...", profileFromMeasuredCharacterization(measured))
+    for name in ("parse", "cached", "cached"):
+        startTime = time.perf_counter()
+        profile = loadMeasuredProfile(pathDataCollected + XLSXFile_20MHzBandwidthLimit,
+                                      None if name == "parse" else pathMeasuredCache)
+        elapsedTime = time.perf_counter() - startTime
+        print("...%-6s ms: %8.2f  %s" % (name, elapsedTime * 1e3, profile))
+    print("...end\n")
@@ -0,0 +1,220 @@
+# Name: minimum_phase_response.py
+# Description: Minimum phase response synthesis from the magnitude only
+#              attenuation tables (the "dbVAttenuationTable_*" files have no
+#              phase), so that the equalizer can also correct the phase-shift
+#              without hours of phase sweeps with a generator.
+#              The magnitude of the profile is sampled in a dense FFT grid and
+#              the phase is obtained by the real cepstrum (Hilbert transform of
+#              the log magnitude) method, with the same
+#              "calcMinimumPhaseSpectrum()" of the minimum phase FIR design.
+#              The responses are cached for each (profile, sample rate, grid
+#              size), and the synthesized phase can be compared with the phase
+#              measured in "Osciloscope_20MHz_bandwidth_limit_v04.xlsx".
+#
+# Note 1: The minimum phase depends on the magnitude at all the frequencies up
+#         to the Nyquist frequency, but the profiles only cover part of it.
+#         Above "maxFreqMHz" (by default the last point of the profile) the
+#         magnitude is extrapolated, held constant or continued with the
+#         dB/decade slope of the last octave of the profile.
+#         For the profiles loaded from the CSV files, "maxFreqMHz" should be the
+#         front end limit (945 MHz), so that the synthetic -100 dBV end points
+#         are not used.
+#
+# Note 2: A real signal path is a minimum phase system plus a pure delay (ex:
+#         the cables), the comparison with the measured phase also reports the
+#         error after removing the best fit pure delay.
+#
+# Note 3: The phase is in degrees, negative for a delay, the same convention
+#         of the profiles.
+#
+# License:        MIT Open Source License
+#
+
+import collections
+import time
+import numpy as np
+
+from attenuation_profile import AttenuationProfile
+from equalizer_response import rfftFreqsMHz, defaultSampleRate, frontEndLimitMHz
+from fir_equalizer_designer import calcMinimumPhaseSpectrum, minPhaseMagnitudeFloor
+from measured_characterization_xlsx import (readMeasuredCharacterization, pathDataCollected,
+                                            XLSXFile_20MHzBandwidthLimit)
+
+################
+# Configurations
+################
+
+pathTables = ".//output_out//"
+CSVFile_defaultTable = "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv"
+
+defaultGridSize = 1 << 16
+
+defaultMaxCacheEntries = 16
+
+###########
+# Constants
+###########
+
+EXTRAPOLATE_HOLD  = "EXTRAPOLATE_HOLD"
+EXTRAPOLATE_SLOPE = "EXTRAPOLATE_SLOPE"
+
+#########
+# Classes
+#########
+
+MinimumPhaseResponse = collections.namedtuple("MinimumPhaseResponse",
+                                              ["freqMHz", "response", "phaseDeg"])
+
+class MinimumPhaseCache:
+    # LRU cache of the synthesized responses, one for each
+    # (profile fingerprint, sample rate, grid size, max freq, extrapolation).
+
+    def __init__(self, maxEntries = defaultMaxCacheEntries):
+        self.maxEntries = maxEntries
+        self._responses = collections.OrderedDict()
+        self.hits   = 0
+        self.misses = 0
+
+    def getResponse(self, profile, sampleRate = defaultSampleRate, gridSize = defaultGridSize,
+                    maxFreqMHz = None, extrapolation = EXTRAPOLATE_SLOPE):
+        key = (profile.fingerprint(), float(sampleRate), int(gridSize),
+               None if maxFreqMHz is None else float(maxFreqMHz), extrapolation)
+        result = self._responses.get(key)
+        if result is not None:
+            self._responses.move_to_end(key)
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = synthesizeMinimumPhaseResponse(profile, sampleRate, gridSize, maxFreqMHz,
+                                                extrapolation)
+        self._responses[key] = result
+        while len(self._responses) > self.maxEntries:
+            self._responses.popitem(last=False)
+        return result
+
+    def clear(self):
+        self._responses.clear()
+
+    def stats(self):
+        return {"entries": len(self._responses), "hits": self.hits, "misses": self.misses}
+
+# Cache used when no cache is given.
+defaultMinimumPhaseCache = MinimumPhaseCache()
+
+###########
+# Functions
+###########
+
+def calcTailSlope_dB_per_decade(profile, maxFreqMHz):
+    # Slope of the last octave of the profile below "maxFreqMHz", by a least
+    # squares fit over the log of the frequency. Never positive.
+    inOctave = (profile.freqMHz >= maxFreqMHz / 2.0) & (profile.freqMHz <= maxFreqMHz)
+    inOctave &= profile.freqMHz > 0.0
+    if np.count_nonzero(inOctave) < 2:
+        return 0.0
+    slope = np.polyfit(np.log10(profile.freqMHz[inOctave]), profile.dBV[inOctave], 1)[0]
+    return min(0.0, float(slope))
+
+def calcMagnitudeOnGrid(profile, freqMHz, maxFreqMHz = None, extrapolation = EXTRAPOLATE_SLOPE):
+    # Linear magnitude of the profile at the frequencies, see Note 1.
+    if maxFreqMHz is None:
+        maxFreqMHz = float(profile.freqMHz[-1])
+    freqMHz = np.asarray(freqMHz, dtype=np.float64)
+    dBV = profile.db(np.minimum(freqMHz, maxFreqMHz))
+    if extrapolation == EXTRAPOLATE_SLOPE:
+        slope = calcTailSlope_dB_per_decade(profile, maxFreqMHz)
+        above = freqMHz > maxFreqMHz
+        dBV[above] += slope * np.log10(freqMHz[above] / maxFreqMHz)
+    elif extrapolation != EXTRAPOLATE_HOLD:
+        raise ValueError("Unknown extrapolation: " + str(extrapolation))
+    return np.maximum(np.power(10.0, dBV / 20.0), minPhaseMagnitudeFloor)
+
+def synthesizeMinimumPhaseResponse(profile, sampleRate = defaultSampleRate,
+                                   gridSize = defaultGridSize, maxFreqMHz = None,
+                                   extrapolation = EXTRAPOLATE_SLOPE):
+    # Returns a read only "MinimumPhaseResponse" over the rfft bins of the grid.
+    if gridSize < 4 or gridSize % 2 != 0:
+        raise ValueError("The grid size must be even and at least 4.")
+    freqMHz = rfftFreqsMHz(gridSize, sampleRate)
+    magnitude = calcMagnitudeOnGrid(profile, freqMHz, maxFreqMHz, extrapolation)
+    response = calcMinimumPhaseSpectrum(magnitude)
+    phaseDeg = np.rad2deg(np.unwrap(np.angle(response)))
+    for array in (freqMHz, response, phaseDeg):
+        array.flags.writeable = False
+    return MinimumPhaseResponse(freqMHz, response, phaseDeg)
+
+def minimumPhaseDeg(profile, freqs, sampleRate = defaultSampleRate, gridSize = defaultGridSize,
+                    maxFreqMHz = None, extrapolation = EXTRAPOLATE_SLOPE, cache = None):
+    # The minimum phase in degrees interpolated at the frequencies in MHz.
+    if cache is None:
+        cache = defaultMinimumPhaseCache
+    result = cache.getResponse(profile, sampleRate, gridSize, maxFreqMHz, extrapolation)
+    return np.interp(freqs, result.freqMHz, result.phaseDeg)
+
+def withMinimumPhase(profile, sampleRate = defaultSampleRate, gridSize = defaultGridSize,
+                     maxFreqMHz = None, extrapolation = EXTRAPOLATE_SLOPE, cache = None):
+    # Returns a new profile with the same magnitude and the minimum phase.
+    phaseDeg = minimumPhaseDeg(profile, profile.freqMHz, sampleRate, gridSize, maxFreqMHz,
+                               extrapolation, cache)
+    return AttenuationProfile(profile.freqMHz, profile.dBV, phaseDeg)
+
+def comparePhase(freqMHz, synthesizedPhaseDeg, measuredPhaseDeg):
+    # Error of the synthesized phase against the measured phase, see Note 2.
+    freqMHz = np.asarray(freqMHz, dtype=np.float64)
+    error = np.asarray(synthesizedPhaseDeg) - np.asarray(measuredPhaseDeg)
+    # A pure delay of tau us is a phase of -360 * f * tau degrees, f in MHz.
+    delayPhasePerUs = -360.0 * freqMHz
+    delay_us = -float(np.dot(error, delayPhasePerUs) / np.dot(delayPhasePerUs, delayPhasePerUs))
+    errorWithoutDelay = error + delayPhasePerUs * delay_us
+    return {"freqMHz": freqMHz.tolist(), "errorDeg": error.tolist(),
+            "rmsErrorDeg": float(np.sqrt(np.mean(error ** 2))),
+            "maxErrorDeg": float(np.max(np.abs(error))),
+            "bestFitDelay_ns": delay_us * 1000.0,
+            "errorWithoutDelayDeg": errorWithoutDelay.tolist(),
+            "rmsErrorWithoutDelayDeg": float(np.sqrt(np.mean(errorWithoutDelay ** 2))),
+            "maxErrorWithoutDelayDeg": float(np.max(np.abs(errorWithoutDelay)))}
+
+def reportAgainstMeasured(fileName = pathDataCollected + XLSXFile_20MHzBandwidthLimit,
+                          sampleRate = defaultSampleRate, gridSize = defaultGridSize,
+                          extrapolation = EXTRAPOLATE_SLOPE, cache = None):
+    # Synthesizes the minimum phase of the measured magnitude of the spreadsheet
+    # and compares it with the measured phase.
+    measured = readMeasuredCharacterization(fileName)
+    magnitudeProfile = AttenuationProfile(measured["freqMHz"], measured["dBV"])
+    synthesized = minimumPhaseDeg(magnitudeProfile, measured["freqMHz"], sampleRate, gridSize,
+                                  None, extrapolation, cache)
+    report = comparePhase(measured["freqMHz"], synthesized, measured["invPhaseDeg"])
+    report["synthesizedPhaseDeg"] = synthesized.tolist()
+    report["measuredPhaseDeg"] = measured["invPhaseDeg"].tolist()
+    return report
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    print("\nStarting...")
+    for extrapolation in (EXTRAPOLATE_HOLD, EXTRAPOLATE_SLOPE):
+        report = reportAgainstMeasured(extrapolation=extrapolation)
+        print("...20 MHz bandwidth limit, %s" % extrapolation)
+        print("...   RMS error degrees: %.2f  max: %.2f" %
+              (report["rmsErrorDeg"], report["maxErrorDeg"]))
+        print("...   best fit delay ns: %.3f  RMS error without it: %.2f  max: %.2f" %
+              (report["bestFitDelay_ns"], report["rmsErrorWithoutDelayDeg"],
+               report["maxErrorWithoutDelayDeg"]))
+    for freq, synthesized, measured in zip(report["freqMHz"], report["synthesizedPhaseDeg"],
+                                           report["measuredPhaseDeg"]):
+        print("...   freq MHz: %5.1f  minimum phase: %8.3f  measured: %8.3f" %
+              (freq, synthesized, measured))
+
+    profile = AttenuationProfile.fromCSVFile(pathTables, CSVFile_defaultTable)
+    cache = MinimumPhaseCache()
+    for gridSize in (1 << 12, 1 << 16, 1 << 20, 1 << 16):
+        startTime = time.perf_counter()
+        phaseProfile = withMinimumPhase(profile, gridSize=gridSize, maxFreqMHz=frontEndLimitMHz,
+                                        cache=cache)
+        elapsedTime = time.perf_counter() - startTime
+        print("...grid: %8d  time ms: %8.2f  phase at 500 MHz: %8.2f degrees" %
+              (gridSize, elapsedTime * 1e3, phaseProfile.phase_deg(500.0)))
+    print("...", cache.stats())
+    print("...end\n")
@@ -0,0 +1,173 @@
+# Name: multichannel_equalizer.py
+# Description: Parallel multi-channel equalization, ex: the 4 channels of the
+#              SDS2104X Plus, that are on 2 ADC pairs.
+#              Each channel is equalized in a process of a process pool and the
+#              sample buffers are passed by "multiprocessing.shared_memory",
+#              instead of being pickled. Only the small profiles and the
+#              shared memory names are sent to the workers.
+#              Each channel can use its own profile, because each channel pair
+#              has its own frequency response.
+#
+# Note 1: The acquisition can write the samples directly into the shared
+#         input buffer ("SharedChannelBuffers.input"), so that there isn't
+#         any copy of the samples between the acquisition and the workers.
+#
+# Note 2: Each worker process keeps its own "EqualizerPlanCache", so that the
+#         inverse response of each (sample rate, N, profile) is only built once
+#         for each worker.
+#
+# License:        MIT Open Source License
+#
+
+import concurrent.futures
+import os
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+from attenuation_profile import AttenuationProfile
+from pipeline_instrumentation import timedStage
+from equalizer_plan_cache import EqualizerPlanCache, equalizeWithPlan
+from equalizer_response import defaultSampleRate, defaultMaxGain_dB
+
+################
+# Configurations
+################
+
+pathTables = ".//output_out//"
+CSVFile_defaultTable = "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv"
+
+#########
+# Classes
+#########
+
+class SharedChannelBuffers:
+    # Input and output sample buffers of all the channels, in shared memory.
+
+    def __init__(self, numChannels, numSamples, dtype = np.float64):
+        self.numChannels = numChannels
+        self.numSamples  = numSamples
+        self.dtype = np.dtype(dtype)
+        numBytes = max(1, numChannels * numSamples * self.dtype.itemsize)
+        self._shmInput  = shared_memory.SharedMemory(create=True, size=numBytes)
+        self._shmOutput = shared_memory.SharedMemory(create=True, size=numBytes)
+        shape = (numChannels, numSamples)
+        self.input  = np.ndarray(shape, dtype=self.dtype, buffer=self._shmInput.buf)
+        self.output = np.ndarray(shape, dtype=self.dtype, buffer=self._shmOutput.buf)
+
+    def describe(self):
+        # The picklable description that the workers use to attach to the buffers.
+        return (self._shmInput.name, self._shmOutput.name, self.numChannels,
+                self.numSamples, self.dtype.str)
+
+    def close(self):
+        self.input = None
+        self.output = None
+        for shm in (self._shmInput, self._shmOutput):
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+class MultiChannelEqualizer:
+
+    def __init__(self, numWorkers = None):
+        if numWorkers is None:
+            numWorkers = os.cpu_count() or 1
+        self.numWorkers = numWorkers
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=numWorkers)
+
+    @timedStage("multichannel_equalize")
+    def equalizeBuffers(self, buffers, profileLst, sampleRate = defaultSampleRate,
+                        maxGain_dB = defaultMaxGain_dB, passbandEdgeMHz = None):
+        # Equalizes each channel of "buffers.input" into "buffers.output".
+        # Param: profileLst has one profile for each channel, "None" for a
+        #        channel that is only copied.
+        if len(profileLst) != buffers.numChannels:
+            raise ValueError("There must be one profile for each channel.")
+        description = buffers.describe()
+        futures = [self.executor.submit(_equalizeChannelWorker, description, channelIndex,
+                                        profile, sampleRate, maxGain_dB, passbandEdgeMHz)
+                   for channelIndex, profile in enumerate(profileLst)]
+        for future in futures:
+            future.result()
+        return buffers.output
+
+    def equalizeChannels(self, channelSamplesLst, profileLst, sampleRate = defaultSampleRate,
+                         maxGain_dB = defaultMaxGain_dB, passbandEdgeMHz = None):
+        # Convenience path for samples that are not in shared memory yet,
+        # returns a list with a corrected array for each channel.
+        numSamples = len(channelSamplesLst[0])
+        with SharedChannelBuffers(len(channelSamplesLst), numSamples) as buffers:
+            for channelIndex, samples in enumerate(channelSamplesLst):
+                buffers.input[channelIndex] = samples
+            output = self.equalizeBuffers(buffers, profileLst, sampleRate, maxGain_dB,
+                                          passbandEdgeMHz)
+            return [channel.copy() for channel in output]
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+###########
+# Functions
+###########
+
+# Plan cache of each worker process, see Note 2.
+_workerPlanCache = None
+
+def _equalizeChannelWorker(description, channelIndex, profile, sampleRate, maxGain_dB,
+                           passbandEdgeMHz):
+    global _workerPlanCache
+    if _workerPlanCache is None:
+        _workerPlanCache = EqualizerPlanCache()
+    shmInputName, shmOutputName, numChannels, numSamples, dtypeStr = description
+    shmInput  = shared_memory.SharedMemory(name=shmInputName)
+    shmOutput = shared_memory.SharedMemory(name=shmOutputName)
+    try:
+        shape = (numChannels, numSamples)
+        samples = np.ndarray(shape, dtype=dtypeStr, buffer=shmInput.buf)[channelIndex]
+        output  = np.ndarray(shape, dtype=dtypeStr, buffer=shmOutput.buf)[channelIndex]
+        if profile is None:
+            output[:] = samples
+        else:
+            plan = _workerPlanCache.getPlan(profile, sampleRate, numSamples, maxGain_dB,
+                                            passbandEdgeMHz)
+            output[:] = equalizeWithPlan(samples, plan)
+        del samples, output
+    finally:
+        shmInput.close()
+        shmOutput.close()
+    return channelIndex
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    print("\nStarting...")
+    profile = AttenuationProfile.fromCSVFile(pathTables, CSVFile_defaultTable)
+    numChannels = 4
+    numSamples  = 1 << 22
+    profileLst  = [profile] * numChannels
+    with SharedChannelBuffers(numChannels, numSamples) as buffers:
+        buffers.input[:] = np.random.default_rng(0).normal(size=(numChannels, numSamples))
+        with MultiChannelEqualizer() as equalizer:
+            # The first run builds the plans in the workers.
+            equalizer.equalizeBuffers(buffers, profileLst)
+            startTime = time.perf_counter()
+            equalizer.equalizeBuffers(buffers, profileLst)
+            elapsedTime = time.perf_counter() - startTime
+        print("...workers:", equalizer.numWorkers, " channels:", numChannels,
+              " samples/s: %.3e" % (numChannels * numSamples / elapsedTime))
+    print("...end\n")
+
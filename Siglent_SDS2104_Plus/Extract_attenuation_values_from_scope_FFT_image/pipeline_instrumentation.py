@@ -0,0 +1,221 @@
+# Name: pipeline_instrumentation.py
+# Description: Lightweight timing and memory instrumentation of the stages of
+#              the correction pipeline, so that when a capture feels slow we
+#              can see if it's the image decode, the pixel scanning, the
+#              interpolation, the CSV writing, the PNG saving or the equalizer.
+#              It has:
+#                -"stageTimer(name)" context manager and "timedStage(name)"
+#                 decorator, with almost zero cost when disabled.
+#                -Peak memory of each stage sampled with "tracemalloc"
+#                 (optional, because tracemalloc slows down the allocations).
+#                -Counters, "incrementCounter(name, value)".
+#                -A structured per run report (JSON) and, optionally, a
+#                 Chrome trace JSON file (open it in "chrome://tracing" or in
+#                 "https://ui.perfetto.dev").
+#
+# Usage:
+#   enableInstrumentation(flag_trace_memory = True)
+#   with stageTimer("image_decode"):
+#       ...
+#   dumpReport("run_report.json")
+#   dumpChromeTrace("run_trace.json")
+#
+# Note 1: When disabled, "stageTimer()" returns a shared no-op context manager
+#         and the decorated functions only check one flag before calling the
+#         original function.
+#
+# Note 2: The stages can be nested, the peak memory of a stage includes the
+#         peak memory of the stages inside it.
+#
+# License:        MIT Open Source License
+#
+
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+#########
+# Classes
+#########
+
+class _InstrumentationState:
+
+    def __init__(self):
+        self.enabled = False
+        self.flag_trace_memory = False
+        self.flag_started_tracemalloc = False
+        self.events   = []
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.startTimeNs = time.perf_counter_ns()
+
+_state = _InstrumentationState()
+
+class _NoOpTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+_noOpTimer = _NoOpTimer()
+
+class _StageTimer:
+
+    __slots__ = ("name", "startNs", "memoryFrame")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.memoryFrame = None
+        if _state.flag_trace_memory:
+            stack = _memoryStack()
+            _, outerPeak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1][1] = max(stack[-1][1], outerPeak)
+            tracemalloc.reset_peak()
+            self.memoryFrame = [tracemalloc.get_traced_memory()[0], 0]
+            stack.append(self.memoryFrame)
+        self.startNs = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        endNs = time.perf_counter_ns()
+        peakBytes = None
+        if self.memoryFrame is not None:
+            stack = _memoryStack()
+            _, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, self.memoryFrame[1])
+            peakBytes = peak - self.memoryFrame[0]
+            stack.pop()
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+        event = (self.name, self.startNs - _state.startTimeNs, endNs - self.startNs,
+                 threading.get_ident(), peakBytes)
+        with _state.lock:
+            _state.events.append(event)
+        return False
+
+###########
+# Functions
+###########
+
+def _memoryStack():
+    stack = getattr(_state.local, "memoryStack", None)
+    if stack is None:
+        stack = []
+        _state.local.memoryStack = stack
+    return stack
+
+def enableInstrumentation(flag_trace_memory = False):
+    _state.enabled = True
+    _state.flag_trace_memory = flag_trace_memory
+    if flag_trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _state.flag_started_tracemalloc = True
+
+def disableInstrumentation():
+    _state.enabled = False
+    _state.flag_trace_memory = False
+    if _state.flag_started_tracemalloc:
+        tracemalloc.stop()
+        _state.flag_started_tracemalloc = False
+
+def isInstrumentationEnabled():
+    return _state.enabled
+
+def resetInstrumentation():
+    with _state.lock:
+        _state.events = []
+        _state.counters = {}
+        _state.startTimeNs = time.perf_counter_ns()
+
+def stageTimer(name):
+    # Context manager that times a stage, see Note 1.
+    if not _state.enabled:
+        return _noOpTimer
+    return _StageTimer(name)
+
+def timedStage(name = None):
+    # Decorator that times each call of the function as a stage.
+    def decorator(function):
+        stageName = name if name is not None else function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _state.enabled:
+                return function(*args, **kwargs)
+            with _StageTimer(stageName):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def incrementCounter(name, value = 1):
+    if not _state.enabled:
+        return
+    with _state.lock:
+        _state.counters[name] = _state.counters.get(name, 0) + value
+
+def buildReport():
+    # Aggregated report of the run, for each stage the number of calls, the
+    # total, mean and max time in ms and the max peak memory in bytes.
+    with _state.lock:
+        events = list(_state.events)
+        counters = dict(_state.counters)
+    stages = {}
+    for name, _, durationNs, _, peakBytes in events:
+        stage = stages.setdefault(name, {"calls": 0, "totalMs": 0.0, "maxMs": 0.0,
+                                         "peakMemoryBytes": None})
+        durationMs = durationNs / 1e6
+        stage["calls"]   += 1
+        stage["totalMs"] += durationMs
+        stage["maxMs"]    = max(stage["maxMs"], durationMs)
+        if peakBytes is not None:
+            stage["peakMemoryBytes"] = max(stage["peakMemoryBytes"] or 0, peakBytes)
+    for stage in stages.values():
+        stage["meanMs"] = stage["totalMs"] / stage["calls"]
+    return {"pid": os.getpid(), "stages": stages, "counters": counters}
+
+def formatReport(report = None):
+    if report is None:
+        report = buildReport()
+    lines = []
+    for name, stage in sorted(report["stages"].items(), key=lambda item: -item[1]["totalMs"]):
+        peak = stage["peakMemoryBytes"]
+        lines.append("%-40s calls: %6d  total: %10.3f ms  mean: %9.3f ms  peak mem: %s" %
+                     (name, stage["calls"], stage["totalMs"], stage["meanMs"],
+                      "-" if peak is None else "%d bytes" % peak))
+    for name, value in sorted(report["counters"].items()):
+        lines.append("%-40s counter: %s" % (name, value))
+    return lines
+
+def dumpReport(fileName):
+    with open(fileName, mode='w') as reportFile:
+        json.dump(buildReport(), reportFile, indent=2)
+
+def dumpChromeTrace(fileName):
+    # Chrome trace event format, complete events ("ph": "X") in microseconds.
+    with _state.lock:
+        events = list(_state.events)
+        counters = dict(_state.counters)
+    pid = os.getpid()
+    traceEvents = []
+    for name, startNs, durationNs, threadId, peakBytes in events:
+        traceEvent = {"name": name, "ph": "X", "pid": pid, "tid": threadId,
+                      "ts": startNs / 1e3, "dur": durationNs / 1e3}
+        if peakBytes is not None:
+            traceEvent["args"] = {"peakMemoryBytes": peakBytes}
+        traceEvents.append(traceEvent)
+    endTs = max((event["ts"] + event["dur"] for event in traceEvents), default=0.0)
+    for name, value in counters.items():
+        traceEvents.append({"name": name, "ph": "C", "pid": pid, "ts": endTs,
+                            "args": {name: value}})
+    with open(fileName, mode='w') as traceFile:
+        json.dump({"traceEvents": traceEvents, "displayTimeUnit": "ms"}, traceFile)
+
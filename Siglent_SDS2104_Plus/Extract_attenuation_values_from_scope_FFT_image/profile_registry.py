@@ -0,0 +1,314 @@
+# Name: profile_registry.py
+# Description: Registry of all the stored attenuation profiles, indexed by
+#              scope model, channel pair, mode and accessory, so that the
+#              equalizer can get the response of the exact bench setup.
+#              The README lists what shapes the response, the probe or the
+#              coax cable, the input impedance, the front end amplifier, the
+#              anti-aliasing filter, the 8 bit or 10 bit mode and the 20 MHz
+#              bandwidth limit. Each stored profile is one stage of this chain:
+#                -STAGE_FRONT_END, the scope itself for a channel pair and mode,
+#                 ex: the "dbVAttenuationTable_*" tables of each scope folder.
+#                -STAGE_MODE, a filter that a mode adds, ex: the 20 MHz limit
+#                 measured in "Osciloscope_20MHz_bandwidth_limit_v04.xlsx".
+#                -STAGE_ACCESSORY, a probe or a cable.
+#              The profiles are only loaded the first time they are used, and
+#              the stages of a setup are composed in a single cascade profile,
+#              with the dB (and the phases) added, that is memoized, so changing
+#              the probe at the bench doesn't recompute anything already seen.
+#
+# Note 1: The dB of each stage is linearly interpolated between its points, so
+#         the sum is exact in the union of the frequencies of all the stages,
+#         the cascade uses this union as the common grid. But a stage isn't
+#         extrapolated, outside of its points it would keep its first and last
+#         values, ex: the 20 MHz limit measured from 2 MHz to 40 MHz would stay
+#         at its 40 MHz value up to 1 GHz, and an equalizer would invert that.
+#         So the cascade only covers the frequency range that all the stages
+#         cover, and it's an error when there is no common range. The equalizer
+#         of a cascade must then have a "passbandEdgeMHz" inside this range.
+#
+# Note 2: The cascade only has phase when all the stages have phase, else it
+#         has no phase, "minimum_phase_response.withMinimumPhase()" can then
+#         synthesize it.
+#
+# Note 3: The fields of an entry can be ANY ("*"), ex: a probe that is the same
+#         for all the scope models. When more then one entry matches, the exact
+#         match wins over ANY, then the table variants are chosen by the order
+#         of "variantPreference", and then a binary profile wins over a CSV.
+#
+# Note 4: A manifest is a JSON file with a list of entries, for the profiles
+#         of other scopes and accessories shared by the community (step 2 of
+#         the README), the file names are relative to the manifest.
+#         ex: [{"scopeModel": "Rigol_DS1104Z", "channelPair": "C1C2", "mode": "8BIT",
+#               "accessory": "NONE", "stage": "STAGE_FRONT_END",
+#               "fileName": "dbVAttenuationTable_x.csv"}]
+#
+# License:        MIT Open Source License
+#
+
+import collections
+import json
+import os
+import re
+import numpy as np
+
+from attenuation_profile import AttenuationProfile
+from binary_profile_format import loadBinaryProfile, binaryProfileExtension
+from measured_characterization_xlsx import loadMeasuredProfile, XLSXFile_20MHzBandwidthLimit
+
+################
+# Configurations
+################
+
+# The folder with one folder for each scope model.
+pathScopeModels = "..//..//"
+
+defaultChannelPair = "C1C2"
+defaultMode        = "8BIT"
+defaultAccessory   = "NONE"
+
+# The table variants, from the preferred one, see Note 3.
+variantPreference = ["interpol_1M_step", "interpol_10M_step", "OriginalFreq"]
+
+defaultMaxCascadeEntries = 32
+
+###########
+# Constants
+###########
+
+ANY = "*"
+
+STAGE_FRONT_END = "STAGE_FRONT_END"
+STAGE_MODE      = "STAGE_MODE"
+STAGE_ACCESSORY = "STAGE_ACCESSORY"
+
+stageOrder = [STAGE_FRONT_END, STAGE_MODE, STAGE_ACCESSORY]
+
+MODE_20MHz_LIMIT = "BW20M"
+
+tableFilePattern = re.compile(r"^dbVAttenuationTable_(.+)\.(csv|ofrp)$")
+
+#########
+# Classes
+#########
+
+ProfileEntry = collections.namedtuple("ProfileEntry",
+        ["scopeModel", "channelPair", "mode", "accessory", "stage", "variant", "fileName"])
+
+class ProfileRegistry:
+
+    def __init__(self, maxCascadeEntries = defaultMaxCascadeEntries):
+        self.entries = []
+        self._profiles = {}
+        self._cascades = collections.OrderedDict()
+        self.maxCascadeEntries = maxCascadeEntries
+        self.numLoads = 0
+        self.cascadeHits   = 0
+        self.cascadeMisses = 0
+
+    def register(self, scopeModel, channelPair, mode, accessory, stage, fileName,
+                 variant = ""):
+        # Adds an entry, the file is only loaded when the profile is used.
+        if stage not in stageOrder:
+            raise ValueError("Unknown stage: " + str(stage))
+        entry = ProfileEntry(scopeModel, channelPair.upper(), mode.upper(), accessory.upper(),
+                             stage, variant, os.path.normpath(fileName))
+        if entry not in self.entries:
+            self.entries.append(entry)
+        return entry
+
+    def scanScopeModels(self, path = pathScopeModels):
+        # Registers the "dbVAttenuationTable_*" files found in each scope model
+        # folder (ex: in "output_out/" of the extractor) as its front end, for
+        # all the channel pairs, in the default mode.
+        numEntries = len(self.entries)
+        for scopeModel in sorted(os.listdir(path)):
+            modelPath = os.path.join(path, scopeModel)
+            if not os.path.isdir(modelPath) or scopeModel.startswith("."):
+                continue
+            for dirPath, dirNames, fileNames in os.walk(modelPath):
+                dirNames[:] = sorted(dirName for dirName in dirNames
+                                     if not dirName.startswith((".", "__")))
+                for fileName in sorted(fileNames):
+                    match = tableFilePattern.match(fileName)
+                    if match is not None:
+                        self.register(scopeModel, ANY, defaultMode, ANY, STAGE_FRONT_END,
+                                      os.path.join(dirPath, fileName), variant=match.group(1))
+        return len(self.entries) - numEntries
+
+    def loadManifest(self, fileName):
+        # Registers the entries of a manifest, see Note 4.
+        with open(fileName, mode='r') as manifestFile:
+            manifest = json.load(manifestFile)
+        basePath = os.path.dirname(fileName)
+        for item in manifest:
+            self.register(item["scopeModel"], item.get("channelPair", ANY),
+                          item.get("mode", ANY), item.get("accessory", ANY), item["stage"],
+                          os.path.join(basePath, item["fileName"]), item.get("variant", ""))
+        return len(manifest)
+
+    def findEntry(self, stage, scopeModel, channelPair, mode, accessory):
+        # The best entry of the stage for the setup, or None, see Note 3.
+        setup = (scopeModel, channelPair.upper(), mode.upper(), accessory.upper())
+        bestEntry, bestRank = None, None
+        for entry in self.entries:
+            if entry.stage != stage:
+                continue
+            fields = (entry.scopeModel, entry.channelPair, entry.mode, entry.accessory)
+            if any(field != ANY and field != wanted for field, wanted in zip(fields, setup)):
+                continue
+            numAny = sum(field == ANY for field in fields)
+            variantRank = next((index for index, variant in enumerate(variantPreference)
+                                if entry.variant.startswith(variant)), len(variantPreference))
+            # The binary profiles load faster then the same CSV tables.
+            rank = (numAny, variantRank, not entry.fileName.endswith(binaryProfileExtension))
+            if bestRank is None or rank < bestRank:
+                bestEntry, bestRank = entry, rank
+        return bestEntry
+
+    def getProfile(self, entry):
+        # Loads the profile of the entry the first time it's asked.
+        profile = self._profiles.get(entry)
+        if profile is None:
+            profile = loadProfileFile(entry.fileName)
+            self._profiles[entry] = profile
+            self.numLoads += 1
+        return profile
+
+    def stageEntries(self, scopeModel, channelPair = defaultChannelPair, mode = defaultMode,
+                     accessory = defaultAccessory):
+        # The entries of the stages of the setup. The front end is searched in
+        # the default mode when the mode has no front end of its own, and then
+        # the mode is a STAGE_MODE filter over it.
+        frontEnd = self.findEntry(STAGE_FRONT_END, scopeModel, channelPair, mode, accessory)
+        if frontEnd is None:
+            frontEnd = self.findEntry(STAGE_FRONT_END, scopeModel, channelPair, defaultMode,
+                                      accessory)
+        if frontEnd is None:
+            raise KeyError("There is no front end profile for %s %s %s." %
+                           (scopeModel, channelPair, mode))
+        entries = [frontEnd]
+        if frontEnd.mode != mode.upper():
+            modeEntry = self.findEntry(STAGE_MODE, scopeModel, channelPair, mode, accessory)
+            if modeEntry is None:
+                raise KeyError("There is no profile for the mode %s of %s." % (mode, scopeModel))
+            entries.append(modeEntry)
+        if accessory.upper() != defaultAccessory:
+            accessoryEntry = self.findEntry(STAGE_ACCESSORY, scopeModel, channelPair, mode,
+                                            accessory)
+            if accessoryEntry is None:
+                raise KeyError("There is no profile for the accessory %s." % accessory)
+            entries.append(accessoryEntry)
+        return entries
+
+    def getCascade(self, scopeModel, channelPair = defaultChannelPair, mode = defaultMode,
+                   accessory = defaultAccessory):
+        # The memoized cascade profile of the setup.
+        entries = tuple(self.stageEntries(scopeModel, channelPair, mode, accessory))
+        cascade = self._cascades.get(entries)
+        if cascade is not None:
+            self._cascades.move_to_end(entries)
+            self.cascadeHits += 1
+            return cascade
+        self.cascadeMisses += 1
+        cascade = composeCascade([self.getProfile(entry) for entry in entries])
+        self._cascades[entries] = cascade
+        while len(self._cascades) > self.maxCascadeEntries:
+            self._cascades.popitem(last=False)
+        return cascade
+
+    def scopeModels(self):
+        return sorted({entry.scopeModel for entry in self.entries if entry.scopeModel != ANY})
+
+    def stats(self):
+        return {"entries": len(self.entries), "loadedProfiles": len(self._profiles),
+                "loads": self.numLoads, "cascades": len(self._cascades),
+                "cascadeHits": self.cascadeHits, "cascadeMisses": self.cascadeMisses}
+
+###########
+# Functions
+###########
+
+def loadProfileFile(fileName):
+    # Loads a CSV table, a binary profile or the measured spreadsheet.
+    inputPath, baseName = os.path.split(fileName)
+    inputPath += os.sep
+    extension = os.path.splitext(baseName)[1].lower()
+    if extension == ".csv":
+        return AttenuationProfile.fromCSVFile(inputPath, baseName)
+    if extension == binaryProfileExtension:
+        return loadBinaryProfile(inputPath, baseName)
+    if extension == ".xlsx":
+        return loadMeasuredProfile(fileName)
+    raise ValueError("Unknown profile file type: " + fileName)
+
+def composeCascade(profiles):
+    # One profile with the sum of the dB (and of the phases) of the stages,
+    # in the union of their frequencies inside the common range, see Note 1
+    # and Note 2.
+    if len(profiles) == 1:
+        return profiles[0]
+    minFreqMHz = max(profile.freqMHz[0] for profile in profiles)
+    maxFreqMHz = min(profile.freqMHz[-1] for profile in profiles)
+    if minFreqMHz > maxFreqMHz:
+        raise ValueError("The stages have no common frequency range, %s." %
+                         ", ".join("%g to %g MHz" % (profile.freqMHz[0], profile.freqMHz[-1])
+                                   for profile in profiles))
+    freqMHz = np.unique(np.concatenate([profile.freqMHz for profile in profiles]))
+    freqMHz = freqMHz[(freqMHz >= minFreqMHz) & (freqMHz <= maxFreqMHz)]
+    dBV = np.sum([profile.db(freqMHz) for profile in profiles], axis=0)
+    phaseDeg = None
+    if all(profile.hasPhase() for profile in profiles):
+        phaseDeg = np.sum([profile.phase_deg(freqMHz) for profile in profiles], axis=0)
+    return AttenuationProfile(freqMHz, dBV, phaseDeg)
+
+def buildDefaultRegistry(path = pathScopeModels):
+    # The tables of all the scope models and the measured 20 MHz limit of
+    # the Siglent SDS2104X Plus.
+    registry = ProfileRegistry()
+    registry.scanScopeModels(path)
+    fileName = os.path.join(path, "Siglent_SDS2104_Plus", "Data_collected",
+                            XLSXFile_20MHzBandwidthLimit)
+    if os.path.isfile(fileName):
+        registry.register("Siglent_SDS2104_Plus", ANY, MODE_20MHz_LIMIT, ANY, STAGE_MODE,
+                          fileName, variant="measured")
+    return registry
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    import time
+    print("\nStarting...")
+    registry = buildDefaultRegistry()
+    print("...scope models:", registry.scopeModels())
+    for entry in registry.entries:
+        print("...   %-22s %-5s %-6s %-5s %-16s %s" % (entry.scopeModel, entry.channelPair,
+              entry.mode, entry.accessory, entry.stage, os.path.basename(entry.fileName)))
+    # A synthetic x10 probe, -3 dB at 350 MHz, shared by all the scopes.
+    probeFreqs = np.linspace(0.0, 1000.0, 201)
+    probe_dBV = -10.0 * np.log10(1.0 + (probeFreqs / 350.0) ** 2)
+    probePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output_out")
+    np.savetxt(os.path.join(probePath, "probe_x10_synthetic.csv"),
+               np.column_stack((probeFreqs, probe_dBV)), delimiter=",",
+               header="Frequency MHz,Attenuation dBV", comments="")
+    registry.register(ANY, ANY, ANY, "PROBE_X10", STAGE_ACCESSORY,
+                      os.path.join(probePath, "probe_x10_synthetic.csv"))
+    setups = [("Siglent_SDS2104_Plus", "C1C2", "8BIT", "NONE"),
+              ("Siglent_SDS2104_Plus", "C1C2", "BW20M", "NONE"),
+              ("Siglent_SDS2104_Plus", "C3C4", "8BIT", "PROBE_X10"),
+              ("Siglent_SDS2104_Plus", "C1C2", "BW20M", "PROBE_X10")]
+    for setup in setups + setups:
+        startTime = time.perf_counter()
+        cascade = registry.getCascade(*setup)
+        elapsedTime = time.perf_counter() - startTime
+        print("...%-40s %5g to %6g MHz  dB at 20 MHz: %7.3f  at the end: %7.3f  ms: %.3f" %
+              (" ".join(setup), cascade.freqMHz[0], cascade.freqMHz[-1], cascade.db(20.0),
+               cascade.dBV[-1], elapsedTime * 1e3))
+    try:
+        registry.getCascade("Rigol_DS1104Z")
+    except KeyError as error:
+        print("...", error)
+    print("...", registry.stats())
+    os.remove(os.path.join(probePath, "probe_x10_synthetic.csv"))
+    print("...end\n")
@@ -0,0 +1,265 @@
+# Name: ref_waveform_uploader.py
+# Description: Upload of the corrected waveforms to a REF channel of the scope
+#              (REF_A in the README), for the direct comparison with the other
+#              signals.
+#              The float Volts are quantized to the 8 bit codes (or the 16 bit
+#              words of the 10 bit mode) of the scope, all in NumPy:
+#                -The vertical scale is searched in the 1-2-5 Volts/div series
+#                 of the scope, the smallest one where the signal still fits
+#                 in the ADC range, and the offset centers the signal.
+#                -The codes are clipped to the ADC range, and the clipped
+#                 samples are counted, so a bad scale is detected.
+#              The codes are sent in a definite length block, in chunks, and
+#              the next chunk is quantized in a worker thread while the link
+#              sends the one before it. The upload throughput is in "stats()",
+#              to check that the REF refresh keeps up with the acquisition.
+#
+# Note 1: Volts = code * (verticalGain / codePerDiv) - verticalOffset, the
+#         same formula of "waveform_io.codesToVolts()".
+#
+# Note 2: With "flag_auto_scale = False" the scale of the capture is used, the
+#         REF is then shown with the same scale of the channel, but the
+#         corrected signal can have overshoots that clip, see the stats.
+#         With the auto scale the scale and the offset are only sent to the
+#         scope when they change.
+#
+# Note 3: The socket "sendall()" and the NumPy quantization both release the
+#         GIL, so the worker thread really overlaps with the link.
+#
+# Note 4: "sendall()" returns when the data is in the socket buffers, not in
+#         the scope. With "flag_wait_complete" each upload ends with an
+#         "*OPC?" query, so the throughput is the one really seen by the scope.
+#
+# License:        MIT Open Source License
+#
+
+import collections
+import concurrent.futures
+import time
+import numpy as np
+
+from pipeline_instrumentation import timedStage
+from waveform_io import codesDtype, adcCodeLimits
+
+################
+# Configurations
+################
+
+pathTables = ".//output_out//"
+CSVFile_defaultTable = "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv"
+
+# Samples per chunk of the upload.
+defaultChunkSize = 256 * 1024
+
+# Part of the ADC range that the auto scale uses.
+defaultHeadroom = 0.9
+
+###########
+# Constants
+###########
+
+# The Volts/div 1-2-5 series of the scope, from 500 uV/div to 10 V/div.
+VERTICAL_SCALES = np.array([mantissa * 10.0 ** exponent
+                            for exponent in range(-4, 2) for mantissa in (1.0, 2.0, 5.0)])[2:-2]
+
+#########
+# Classes
+#########
+
+QuantizedWaveform = collections.namedtuple("QuantizedWaveform", ["codes", "metadata", "numClipped"])
+
+class RefUploader:
+
+    def __init__(self, client, reference = "REFA", chunkSize = defaultChunkSize,
+                 flag_auto_scale = True, headroom = defaultHeadroom, flag_wait_complete = True):
+        # Param: client a "scpi_link.SCPISocketClient".
+        self.client    = client
+        self.reference = reference
+        self.chunkSize = chunkSize
+        self.flag_auto_scale = flag_auto_scale
+        self.headroom  = headroom
+        self.flag_wait_complete = flag_wait_complete
+        self.executor  = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._buffers  = {}
+        self._sentScale = None
+        self.numUploads = 0
+        self.numBytes   = 0
+        self.numClipped = 0
+        self.uploadTime = 0.0
+        self.lastMetadata = None
+
+    def _chunkBuffers(self, metadata):
+        # Two codes buffers and two float32 work buffers of one chunk, reused.
+        key = (metadata.sampleWidth, metadata.littleEndian)
+        if key not in self._buffers:
+            dtype = codesDtype(metadata)
+            self._buffers[key] = ([np.empty(self.chunkSize, dtype=dtype) for _ in range(2)],
+                                  [np.empty(self.chunkSize, dtype=np.float32) for _ in range(2)])
+        return self._buffers[key]
+
+    def _sendScale(self, metadata):
+        scale = (metadata.verticalGain, metadata.verticalOffset)
+        if scale != self._sentScale:
+            self.client.write(":REF:SCAL %s,%.6E" % (self.reference, scale[0]))
+            self.client.write(":REF:OFFS %s,%.6E" % (self.reference, scale[1]))
+            self._sentScale = scale
+
+    def _quantizedChunks(self, volts, metadata, clippedCounts):
+        # Yields the codes of each chunk, the next chunk is quantized in the
+        # worker while the link sends the one yielded, see Note 3.
+        codesBuffers, workBuffers = self._chunkBuffers(metadata)
+        starts = range(0, volts.size, self.chunkSize)
+
+        def quantizeChunk(index):
+            start = starts[index]
+            chunk = volts[start:start + self.chunkSize]
+            codes, numClipped = quantizeVolts(chunk, metadata, codesBuffers[index % 2][:chunk.size],
+                                              workBuffers[index % 2][:chunk.size])
+            clippedCounts.append(numClipped)
+            return codes
+
+        future = self.executor.submit(quantizeChunk, 0) if len(starts) > 0 else None
+        for index in range(len(starts)):
+            codes = future.result()
+            if index + 1 < len(starts):
+                future = self.executor.submit(quantizeChunk, index + 1)
+            yield codes
+
+    @timedStage("ref_upload")
+    def upload(self, volts, metadata):
+        # Quantizes and sends the Volts to the REF channel. Returns the
+        # metadata of the codes that were sent, see Note 2.
+        # Param: metadata of the capture, the scale of the codes without auto scale.
+        volts = np.asarray(volts)
+        startTime = time.perf_counter()
+        if self.flag_auto_scale:
+            metadata = chooseVerticalScale(volts, metadata, self.headroom)
+            self._sendScale(metadata)
+        metadata = metadata._replace(numSamples=volts.size)
+        clippedCounts = []
+        numBytes = volts.size * metadata.sampleWidth
+        self.client.writeBlockChunks(":REF:DATA %s," % self.reference, numBytes,
+                                     self._quantizedChunks(volts, metadata, clippedCounts))
+        if self.flag_wait_complete:
+            # See Note 4.
+            self.client.query("*OPC?")
+        self.uploadTime += time.perf_counter() - startTime
+        self.numUploads += 1
+        self.numBytes   += numBytes
+        self.numClipped += sum(clippedCounts)
+        self.lastMetadata = metadata
+        return metadata
+
+    def stats(self):
+        return {"uploads": self.numUploads, "bytes": self.numBytes,
+                "clippedSamples": self.numClipped, "uploadSeconds": self.uploadTime,
+                "MBPerSecond": (self.numBytes / self.uploadTime / 1e6
+                                if self.uploadTime > 0.0 else 0.0),
+                "uploadsPerSecond": (self.numUploads / self.uploadTime
+                                     if self.uploadTime > 0.0 else 0.0)}
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+###########
+# Functions
+###########
+
+def chooseVerticalScale(volts, metadata, headroom = defaultHeadroom, flag_center_offset = True):
+    # Returns the metadata with the smallest Volts/div of VERTICAL_SCALES
+    # where the Volts fit in "headroom" of the ADC range. If none fits, the
+    # largest scale is used and the samples clip.
+    minVolts, maxVolts = float(np.min(volts)), float(np.max(volts))
+    offset = -0.5 * (minVolts + maxVolts) if flag_center_offset else metadata.verticalOffset
+    halfSpan = max(maxVolts + offset, -(minVolts + offset), 0.0)
+    usableCodes = headroom * adcCodeLimits(metadata)[1]
+    fits = halfSpan * metadata.codePerDiv / VERTICAL_SCALES <= usableCodes
+    scale = VERTICAL_SCALES[np.argmax(fits)] if np.any(fits) else VERTICAL_SCALES[-1]
+    return metadata._replace(verticalGain=float(scale), verticalOffset=offset)
+
+def quantizeVolts(volts, metadata, out = None, work = None):
+    # Vectorized Volts to codes, see Note 1, clipped to the ADC range.
+    # Returns (codes, number of clipped samples).
+    # Param: work an optional float32 buffer with the size of the Volts.
+    if work is None:
+        work = np.empty(len(volts), dtype=np.float32)
+    if out is None:
+        out = np.empty(len(volts), dtype=codesDtype(metadata))
+    minCode, maxCode = adcCodeLimits(metadata)
+    np.add(volts, np.float32(metadata.verticalOffset), out=work, dtype=np.float32)
+    work *= np.float32(metadata.codePerDiv / metadata.verticalGain)
+    np.rint(work, out=work)
+    numClipped = int(np.count_nonzero(work > maxCode) + np.count_nonzero(work < minCode))
+    np.clip(work, minCode, maxCode, out=work)
+    out[...] = work
+    return (out, numClipped)
+
+def quantizeWaveform(volts, metadata, flag_auto_scale = True, headroom = defaultHeadroom):
+    # Returns the "QuantizedWaveform" of all the Volts at once.
+    if flag_auto_scale:
+        metadata = chooseVerticalScale(volts, metadata, headroom)
+    codes, numClipped = quantizeVolts(volts, metadata)
+    return QuantizedWaveform(codes, metadata._replace(numSamples=len(volts)), numClipped)
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    # Acquire -> equalize -> upload to REFA, with the simulated scope.
+    from attenuation_profile import AttenuationProfile
+    from equalizer_plan_cache import EqualizerPlanCache, equalizeWithPlan
+    from scpi_link import SCPISocketClient
+    from simulated_scpi_scope import SimulatedScope, SimulatedScopeServer
+    from waveform_io import parseWaveDescriptor, skipBlockPrefix, codesToVolts, voltsToCodes
+    print("\nStarting...")
+    profile = AttenuationProfile.fromCSVFile(pathTables, CSVFile_defaultTable)
+    numSamples = 10_000_000
+    corrected = np.sin(np.linspace(0.0, 2000.0 * np.pi, numSamples)).astype(np.float32) * 1.3
+    startTime = time.perf_counter()
+    quantized = quantizeWaveform(corrected, SimulatedScope(profile).metadata())
+    elapsedTime = time.perf_counter() - startTime
+    print("...quantize %d samples ms: %.1f  scale V/div: %g  clipped: %d" %
+          (numSamples, elapsedTime * 1e3, quantized.metadata.verticalGain, quantized.numClipped))
+    startTime = time.perf_counter()
+    voltsToCodes(corrected, quantized.metadata)
+    print("...\"voltsToCodes()\" ms: %.1f" % ((time.perf_counter() - startTime) * 1e3))
+
+    numCaptures = 10
+    for linkBandwidth in (None, 20e6):
+        scope = SimulatedScope(profile, numPoints=1_000_000, noiseVolts=0.002)
+        planCache = EqualizerPlanCache()
+        with SimulatedScopeServer(scope, linkBandwidth=linkBandwidth) as server:
+            with SCPISocketClient(server.host, server.port) as client, \
+                 RefUploader(client) as uploader:
+                preambleBytes = bytes(client.queryBlock(":WAV:PRE?"))
+                metadata = parseWaveDescriptor(preambleBytes[skipBlockPrefix(preambleBytes):])
+                codes = np.empty(metadata.numSamples, dtype=np.int8)
+                acquireTime = 0.0
+                for _ in range(numCaptures):
+                    acquireStart = time.perf_counter()
+                    client.queryBlock(":WAV:DATA?", codes)
+                    volts = codesToVolts(codes, metadata)
+                    corrected = equalizeWithPlan(volts, planCache.getPlan(profile, scope.sampleRate,
+                                                                          volts.size))
+                    acquireTime += time.perf_counter() - acquireStart
+                    uploadMetadata = uploader.upload(corrected, metadata)
+                stats = uploader.stats()
+                sentVolts = codesToVolts(np.frombuffer(scope.references["REFA"], dtype=np.int8),
+                                         uploadMetadata)
+                print("...link %-8s acquire+equalize captures/s: %.2f  upload MB/s: %.2f"
+                      "  uploads/s: %.2f  clipped: %d" %
+                      ("no limit" if linkBandwidth is None else "20 MB/s",
+                       numCaptures / acquireTime, stats["MBPerSecond"], stats["uploadsPerSecond"],
+                       stats["clippedSamples"]))
+                print("...   REFA scale V/div: %g  max error in LSB: %.3f" %
+                      (scope.referenceScales["REFA"][0],
+                       np.max(np.abs(sentVolts - corrected)) /
+                       (uploadMetadata.verticalGain / uploadMetadata.codePerDiv)))
+    print("...end\n")
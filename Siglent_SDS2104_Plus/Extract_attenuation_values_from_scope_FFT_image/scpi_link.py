@@ -0,0 +1,172 @@
+# Name: scpi_link.py
+# Description: Minimal SCPI link to the scope over a raw TCP socket (the LAN
+#              port 5025 of the SDS2000X Plus), with the IEEE 488.2 definite
+#              length binary blocks that carry the waveforms, ex:
+#              "#9000001000<1000 bytes>".
+#              The binary blocks are received directly into a preallocated
+#              buffer with "socket.recv_into()", so that a waveform can be
+#              wrapped with "np.frombuffer()" without any copy.
+#              It's used with the real scope and with the local simulated scope
+#              of "simulated_scpi_scope.py".
+#
+# Note 1: With PyVisa the same commands work over the resource
+#         "TCPIP::<host>::5025::SOCKET", this module only exists so that the
+#         acquisition path doesn't need PyVisa to be tested.
+#
+# Note 2: The Siglent scopes always use 9 length digits in the blocks they
+#         send, "encodeBlockHeader()" does the same. Blocks with any number of
+#         digits are accepted when reading.
+#
+# License:        MIT Open Source License
+#
+
+import socket
+
+################
+# Configurations
+################
+
+defaultSCPIPort = 5025
+defaultTimeout  = 10.0
+
+# Size of the socket receive buffer, the waveforms are many MB.
+socketBufferSize = 4 * 1024 * 1024
+
+###########
+# Functions
+###########
+
+def encodeBlockHeader(numBytes):
+    # "#9" followed by the 9 digits of the length, see Note 2.
+    return b"#9%09d" % numBytes
+
+def encodeBlock(payload):
+    return encodeBlockHeader(len(payload)) + bytes(payload)
+
+def parseBlockHeader(headerBytes):
+    # Returns (header size, payload size) of the block that starts at
+    # "headerBytes[0]", or None if there isn't a complete block header yet.
+    if len(headerBytes) < 2:
+        return None
+    if headerBytes[:1] != b"#" or not headerBytes[1:2].isdigit():
+        raise ValueError("Not an IEEE 488.2 definite length block.")
+    numDigits = int(headerBytes[1:2])
+    if numDigits == 0:
+        raise ValueError("Indefinite length blocks are not supported.")
+    if len(headerBytes) < 2 + numDigits:
+        return None
+    return (2 + numDigits, int(headerBytes[2:2 + numDigits]))
+
+#########
+# Classes
+#########
+
+class SCPISocketClient:
+
+    def __init__(self, host, port = defaultSCPIPort, timeout = defaultTimeout):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, socketBufferSize)
+        self._pending = bytearray()
+        self.bytesReceived = 0
+        self.bytesSent     = 0
+
+    def write(self, command):
+        data = command.encode("ascii") + b"\n"
+        self.sock.sendall(data)
+        self.bytesSent += len(data)
+
+    def writeBlock(self, command, payload, chunkSize = None):
+        # Sends "<command><block>\n", ex: ":REF:DATA REFA,#9...". The payload
+        # can be any object with the buffer protocol, ex: a NumPy array.
+        # With "chunkSize" the payload is sent in chunks of this many bytes.
+        payload = memoryview(payload).cast("B")
+        if chunkSize is None:
+            chunkSize = max(1, payload.nbytes)
+        self.writeBlockChunks(command, payload.nbytes,
+                              (payload[start:start + chunkSize]
+                               for start in range(0, payload.nbytes, chunkSize)))
+
+    def writeBlockChunks(self, command, numBytes, chunks):
+        # Sends a block of "numBytes" from an iterable of buffers, so that the
+        # next chunk can be made while the link sends the one before it.
+        self.sock.sendall(command.encode("ascii") + encodeBlockHeader(numBytes))
+        numSent = 0
+        for chunk in chunks:
+            chunk = memoryview(chunk).cast("B")
+            if numSent + chunk.nbytes > numBytes:
+                raise ValueError("The chunks have more bytes then the block length.")
+            self.sock.sendall(chunk)
+            numSent += chunk.nbytes
+        if numSent != numBytes:
+            raise ValueError("The chunks have %d bytes, not the block length %d." %
+                             (numSent, numBytes))
+        self.sock.sendall(b"\n")
+        self.bytesSent += numBytes + len(command) + 12
+
+    def _receiveMore(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError("The SCPI connection was closed.")
+        self._pending += data
+        self.bytesReceived += len(data)
+
+    def readLine(self):
+        while True:
+            index = self._pending.find(b"\n")
+            if index >= 0:
+                line = bytes(self._pending[:index])
+                del self._pending[:index + 1]
+                return line.decode("ascii").strip()
+            self._receiveMore()
+
+    def query(self, command):
+        self.write(command)
+        return self.readLine()
+
+    def readBlock(self, out = None):
+        # Reads one definite length block, into "out" (a writable buffer that
+        # is big enough) when given. Returns a memoryview of the payload.
+        while True:
+            header = parseBlockHeader(self._pending)
+            if header is not None:
+                break
+            self._receiveMore()
+        headerSize, numBytes = header
+        del self._pending[:headerSize]
+        if out is None:
+            out = bytearray(numBytes)
+        view = memoryview(out).cast("B")
+        if view.nbytes < numBytes:
+            raise ValueError("The output buffer is smaller then the block.")
+        view = view[:numBytes]
+        # First the bytes already received, then directly into the buffer.
+        numPending = min(len(self._pending), numBytes)
+        view[:numPending] = self._pending[:numPending]
+        del self._pending[:numPending]
+        position = numPending
+        while position < numBytes:
+            received = self.sock.recv_into(view[position:], numBytes - position)
+            if received == 0:
+                raise ConnectionError("The SCPI connection was closed.")
+            position += received
+        self.bytesReceived += numBytes - numPending
+        # The terminator after the block.
+        while not self._pending:
+            self._receiveMore()
+        if self._pending[:1] == b"\n":
+            del self._pending[:1]
+        return view
+
+    def queryBlock(self, command, out = None):
+        self.write(command)
+        return self.readBlock(out)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
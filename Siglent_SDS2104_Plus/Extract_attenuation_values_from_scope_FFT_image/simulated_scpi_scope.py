@@ -0,0 +1,513 @@
+# Name: simulated_scpi_scope.py
+# Description: Local simulated SDS2000X Plus scope, a TCP server that speaks
+#              the waveform subset of the SCPI commands, so that the
+#              acquire -> equalize -> upload loop can be tested and benchmarked
+#              in a PC without a physical scope.
+#              The captures are synthetic signals (sine, square, pulse,
+#              multitone or noise) already filtered by the frequency response
+#              of a stored attenuation profile, so that the equalizer has
+#              something real to correct.
+#              The link bandwidth (bytes/s) and latency (s) can be configured,
+#              to simulate the USB or the LAN link of the scope.
+#
+# Supported commands (short or long forms):
+#   *IDN?  *OPC?  *RST  :SYSTem:ERRor?
+#   :ACQuire:SRATe?  :ACQuire:POINts <n>|?
+#   :TRIGger:MODE SINGle|AUTO|NORMal|STOP|?  :SINGle  :ARM
+#   :WAVeform:SOURce C1..C4|?  :WAVeform:WIDTh BYTE|WORD|?
+#   :WAVeform:STARt <n>|?  :WAVeform:POINt <n>|?  (0 is all the points)
+#   :WAVeform:PREamble?    returns a block with the WAVEDESC
+#   :WAVeform:DATA?        returns a block with the codes
+#   :REFerence:DATA REFA..REFD,<block>  and  :REFerence:DATA? REFA..REFD
+#   :REFerence:SCALe REFA..REFD,<V/div>|?  :REFerence:OFFSet REFA..REFD,<V>|?
+#   :SIMulation:SIGNal SINE|SQUARE|PULSE|MULTITONE|NOISE|AWG|?  (simulator only)
+#   :SIMulation:FREQuency <Hz>|?                                (simulator only)
+#   :SIMulation:AWG:DATA <block>  float32 little endian Volts   (simulator only)
+#       of one period of the arbitrary waveform of the signal "AWG", that is
+#       repeated over all the record, ex: a characterization excitation.
+#
+# Note 1: In the AUTO and NORMal trigger modes each ":WAV:DATA?" with the
+#         start point 0 is a new capture. In the SINGle mode there is one new
+#         capture for each ":SINGle" (or ":ARM").
+#
+# Note 2: The filtered record of each (signal, frequency, points) is computed
+#         only once, each capture only adds a random slice of a noise bank, so
+#         that the server can keep up with the link.
+#
+# Note 3: The server runs an asyncio event loop in a background thread, so
+#         that it can be started from a test or from a benchmark in the same
+#         process of the client.
+#
+# License:        MIT Open Source License
+#
+
+import asyncio
+import threading
+import time
+import numpy as np
+
+from attenuation_profile import AttenuationProfile
+from equalizer_response import applyProfileResponse, defaultSampleRate, frontEndLimitMHz
+from scpi_link import encodeBlockHeader, parseBlockHeader, SCPISocketClient
+from waveform_io import makeRawMetadata, buildWaveDescriptor, voltsToCodes, codesToVolts
+
+################
+# Configurations
+################
+
+pathTables = ".//output_out//"
+CSVFile_defaultTable = "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv"
+
+defaultNumPoints    = 1_000_000
+defaultSignalFreqHz = 10.0e6
+defaultAmplitude    = 1.0
+
+# Size of each write to the link, the bandwidth is enforced between writes.
+linkChunkSize = 64 * 1024
+linkIdleTime  = 0.005
+
+identification = "Siglent Technologies,SDS2104X Plus,SIMULATED,4.0"
+
+###########
+# Constants
+###########
+
+SIGNAL_SINE      = "SINE"
+SIGNAL_SQUARE    = "SQUARE"
+SIGNAL_PULSE     = "PULSE"
+SIGNAL_MULTITONE = "MULTITONE"
+SIGNAL_NOISE     = "NOISE"
+SIGNAL_AWG       = "AWG"
+
+signalTypeLst = [SIGNAL_SINE, SIGNAL_SQUARE, SIGNAL_PULSE, SIGNAL_MULTITONE, SIGNAL_NOISE,
+                 SIGNAL_AWG]
+
+# Long form to short form of each SCPI node.
+scpiShortForms = {"ACQUIRE": "ACQ", "SRATE": "SRAT", "POINTS": "POIN", "POINT": "POIN",
+                  "TRIGGER": "TRIG", "SINGLE": "SING", "WAVEFORM": "WAV", "SOURCE": "SOUR",
+                  "WIDTH": "WIDT", "START": "STAR", "PREAMBLE": "PRE", "REFERENCE": "REF",
+                  "SYSTEM": "SYST", "ERROR": "ERR", "SIMULATION": "SIM", "SIGNAL": "SIGN",
+                  "FREQUENCY": "FREQ", "SCALE": "SCAL", "OFFSET": "OFFS"}
+
+ERROR_NONE             = '0,"No error"'
+ERROR_UNDEFINED_HEADER = '-113,"Undefined header"'
+ERROR_ILLEGAL_VALUE    = '-224,"Illegal parameter value"'
+
+###########
+# Functions
+###########
+
+def normalizeHeader(header):
+    # ":wav:DATA?" and ":WAVeform:DATA?" both return ":WAV:DATA?".
+    isQuery = header.endswith("?")
+    nodes = header.rstrip("?").upper().split(":")
+    nodes = [scpiShortForms.get(node, node) for node in nodes]
+    return ":".join(nodes) + ("?" if isQuery else "")
+
+def generateSyntheticSignal(signalType, numPoints, sampleRate = defaultSampleRate,
+                            freqHz = defaultSignalFreqHz, amplitude = defaultAmplitude,
+                            seed = 0):
+    # The ideal input signal, before the scope front end, in Volts.
+    timeAxis = np.arange(numPoints) / sampleRate
+    phase = 2.0 * np.pi * freqHz * timeAxis
+    if signalType == SIGNAL_SINE:
+        return amplitude * np.sin(phase)
+    if signalType == SIGNAL_SQUARE:
+        return amplitude * np.where(np.sin(phase + 0.1) >= 0.0, 1.0, -1.0)
+    if signalType == SIGNAL_PULSE:
+        # 10 % duty cycle.
+        return amplitude * np.where(np.mod(freqHz * timeAxis, 1.0) < 0.1, 1.0, -1.0)
+    if signalType == SIGNAL_MULTITONE:
+        # Tones at the odd multiples of the frequency, up to the front end limit.
+        toneFreqs = freqHz * np.arange(1, int(frontEndLimitMHz * 1.0e6 / freqHz) + 1, 2)
+        tonePhases = np.random.default_rng(seed).uniform(0.0, 2.0 * np.pi, toneFreqs.size)
+        signal = np.zeros(numPoints)
+        for toneFreq, tonePhase in zip(toneFreqs, tonePhases):
+            signal += np.sin(2.0 * np.pi * toneFreq * timeAxis + tonePhase)
+        return amplitude * signal / max(1.0, np.sqrt(toneFreqs.size / 2.0))
+    if signalType == SIGNAL_NOISE:
+        return amplitude * np.random.default_rng(seed).standard_normal(numPoints) / 3.0
+    raise ValueError("Unknown signal type: " + str(signalType))
+
+#########
+# Classes
+#########
+
+class SimulatedScope:
+    # The state of the simulated scope and the SCPI command handlers, without
+    # any networking.
+
+    def __init__(self, profile, sampleRate = defaultSampleRate, numPoints = defaultNumPoints,
+                 signalType = SIGNAL_SQUARE, signalFreqHz = defaultSignalFreqHz,
+                 amplitude = defaultAmplitude, noiseVolts = 0.0, adcBits = 8, seed = 0):
+        self.profile      = profile
+        self.sampleRate   = sampleRate
+        self.numPoints    = numPoints
+        self.signalType   = signalType
+        self.signalFreqHz = signalFreqHz
+        self.amplitude    = amplitude
+        self.noiseVolts   = noiseVolts
+        self.adcBits      = adcBits
+        self.rng = np.random.default_rng(seed)
+        self.reset()
+        self._recordCache = {}
+        self._noiseBank = None
+        self.awgWaveform = np.zeros(1)
+        self._awgVersion = 0
+
+    def reset(self):
+        self.source      = "C1"
+        self.width       = "BYTE"
+        self.start       = 0
+        self.points      = 0
+        self.triggerMode = "AUTO"
+        self.lastError   = ERROR_NONE
+        self.references  = {}
+        # (Volts per division, Volts offset) of each reference.
+        self.referenceScales = {}
+        self.acquisitionCount = 0
+        self._codes = None
+
+    def metadata(self, numSamples = None):
+        sampleWidth = 1 if self.width == "BYTE" else 2
+        # The 8 bit codes have 25 codes per division, the 16 bit words of the
+        # 10 bit mode have 4 times more. The signal peak is at 4 divisions.
+        codePerDiv = 25.0 if sampleWidth == 1 else 25.0 * (1 << (self.adcBits - 8))
+        return makeRawMetadata(self.numPoints if numSamples is None else numSamples,
+                               sampleWidth=sampleWidth, verticalGain=self.amplitude / 4.0,
+                               codePerDiv=codePerDiv,
+                               adcBits=8 if sampleWidth == 1 else self.adcBits,
+                               sampleInterval=1.0 / self.sampleRate)
+
+    def capturedRecord(self):
+        # The signal filtered by the profile response, see Note 2.
+        key = (self.signalType, self.signalFreqHz, self.numPoints, self.amplitude,
+               self._awgVersion)
+        record = self._recordCache.get(key)
+        if record is None:
+            if self.signalType == SIGNAL_AWG:
+                signal = np.resize(self.awgWaveform, self.numPoints)
+            else:
+                signal = generateSyntheticSignal(self.signalType, self.numPoints,
+                                                 self.sampleRate, self.signalFreqHz,
+                                                 self.amplitude)
+            record = applyProfileResponse(signal, self.sampleRate, self.profile)
+            self._recordCache = {key: record}
+        return record
+
+    def setArbitraryWaveform(self, samples):
+        # One period of the waveform of the signal "AWG", in Volts.
+        self.awgWaveform = np.array(samples, dtype=np.float64).ravel()
+        self._awgVersion += 1
+        self._codes = None
+
+    def noiseSlice(self, numSamples):
+        # A random slice of a noise bank that is generated only once, see Note 2.
+        if self._noiseBank is None or self._noiseBank.size < 2 * numSamples:
+            self._noiseBank = self.rng.normal(0.0, self.noiseVolts, 2 * numSamples)
+        start = int(self.rng.integers(0, self._noiseBank.size - numSamples + 1))
+        return self._noiseBank[start:start + numSamples]
+
+    def acquire(self):
+        record = self.capturedRecord()
+        if self.noiseVolts > 0.0:
+            record = record + self.noiseSlice(record.size)
+        # The codes of each width are only made when they are asked.
+        self._codes = {"BYTE": None, "WORD": None}
+        self._record = record
+        self.acquisitionCount += 1
+
+    def codes(self):
+        if self._codes is None:
+            self.acquire()
+        if self._codes[self.width] is None:
+            self._codes[self.width] = voltsToCodes(self._record, self.metadata())
+        return self._codes[self.width]
+
+    def waveformData(self):
+        if self.triggerMode in ("AUTO", "NORM") and self.start == 0:
+            self.acquire()
+        codes = self.codes()
+        stop = codes.size if self.points == 0 else min(codes.size, self.start + self.points)
+        return memoryview(codes[self.start:stop]).cast("B")
+
+    def preamble(self):
+        codes = self.codes()
+        stop = codes.size if self.points == 0 else min(codes.size, self.start + self.points)
+        return buildWaveDescriptor(self.metadata(max(0, stop - self.start)))
+
+    def handleCommand(self, header, argument, block = None):
+        # Returns the response, a str, a buffer for a binary block, or None.
+        header = normalizeHeader(header)
+        argument = argument.strip().upper()
+        if header == "*IDN?":
+            return identification
+        if header == "*OPC?":
+            return "1"
+        if header == "*RST":
+            self.reset()
+        elif header == ":SYST:ERR?":
+            error, self.lastError = self.lastError, ERROR_NONE
+            return error
+        elif header == ":ACQ:SRAT?":
+            return "%.2E" % self.sampleRate
+        elif header == ":ACQ:POIN?":
+            return "%.2E" % self.numPoints
+        elif header == ":ACQ:POIN":
+            self.numPoints = int(float(argument))
+            self._codes = None
+        elif header == ":TRIG:MODE?":
+            return self.triggerMode
+        elif header == ":TRIG:MODE":
+            self.triggerMode = argument[:4]
+            if self.triggerMode == "SING":
+                self.acquire()
+        elif header in (":SING", ":ARM"):
+            self.triggerMode = "SING"
+            self.acquire()
+        elif header == ":WAV:SOUR?":
+            return self.source
+        elif header == ":WAV:SOUR":
+            self.source = argument
+        elif header == ":WAV:WIDT?":
+            return self.width
+        elif header == ":WAV:WIDT":
+            if argument not in ("BYTE", "WORD"):
+                self.lastError = ERROR_ILLEGAL_VALUE
+            else:
+                self.width = argument
+        elif header == ":WAV:STAR?":
+            return str(self.start)
+        elif header == ":WAV:STAR":
+            self.start = int(float(argument))
+        elif header == ":WAV:POIN?":
+            return str(self.points)
+        elif header == ":WAV:POIN":
+            self.points = int(float(argument))
+        elif header == ":WAV:PRE?":
+            return self.preamble()
+        elif header == ":WAV:DATA?":
+            return self.waveformData()
+        elif header == ":REF:DATA":
+            self.references[argument.rstrip(",")] = bytes(block if block is not None else b"")
+        elif header == ":REF:DATA?":
+            return self.references.get(argument, b"")
+        elif header in (":REF:SCAL", ":REF:OFFS"):
+            reference, _, value = argument.partition(",")
+            scale, offset = self.referenceScales.get(reference, (self.amplitude / 4.0, 0.0))
+            if header == ":REF:SCAL":
+                scale = float(value)
+            else:
+                offset = float(value)
+            self.referenceScales[reference] = (scale, offset)
+        elif header in (":REF:SCAL?", ":REF:OFFS?"):
+            scale, offset = self.referenceScales.get(argument, (self.amplitude / 4.0, 0.0))
+            return "%.6E" % (scale if header == ":REF:SCAL?" else offset)
+        elif header == ":SIM:SIGN?":
+            return self.signalType
+        elif header == ":SIM:SIGN":
+            if argument not in signalTypeLst:
+                self.lastError = ERROR_ILLEGAL_VALUE
+            else:
+                self.signalType = argument
+                self._codes = None
+        elif header == ":SIM:FREQ?":
+            return "%.6E" % self.signalFreqHz
+        elif header == ":SIM:FREQ":
+            self.signalFreqHz = float(argument)
+            self._codes = None
+        elif header == ":SIM:AWG:DATA":
+            if block is None or len(block) < 4:
+                self.lastError = ERROR_ILLEGAL_VALUE
+            else:
+                self.setArbitraryWaveform(np.frombuffer(block, dtype="<f4"))
+        else:
+            self.lastError = ERROR_UNDEFINED_HEADER
+        return None
+
+class SimulatedScopeServer:
+
+    def __init__(self, scope, host = "127.0.0.1", port = 0, linkBandwidth = None,
+                 linkLatency = 0.0):
+        # Param: linkBandwidth in bytes/s, None for no limit.
+        #        linkLatency in seconds, added before each response.
+        self.scope = scope
+        self.host  = host
+        self.port  = port
+        self.linkBandwidth = linkBandwidth
+        self.linkLatency   = linkLatency
+        self.bytesSent     = 0
+        self.bytesReceived = 0
+        self._loop   = None
+        self._server = None
+        self._thread = None
+        # The link is full duplex, each direction has its own busy time.
+        self._linkFreeTime = {"send": 0.0, "receive": 0.0}
+        self._scopeLock = threading.Lock()
+
+    async def _throttle(self, direction, numBytes):
+        # The link direction is busy for numBytes / bandwidth seconds.
+        if self.linkBandwidth is None:
+            return
+        now = time.perf_counter()
+        # The oversleeps of the event loop are given back while the link is
+        # busy, only an idle link restarts the clock.
+        freeTime = self._linkFreeTime[direction]
+        if freeTime < now - linkIdleTime:
+            freeTime = now
+        freeTime += numBytes / self.linkBandwidth
+        self._linkFreeTime[direction] = freeTime
+        delay = freeTime - now
+        if delay > 0.0:
+            await asyncio.sleep(delay)
+
+    async def _send(self, writer, response):
+        if self.linkLatency > 0.0:
+            await asyncio.sleep(self.linkLatency)
+        if isinstance(response, str):
+            data = memoryview(response.encode("ascii") + b"\n")
+        else:
+            payload = memoryview(response).cast("B")
+            writer.write(encodeBlockHeader(payload.nbytes))
+            data = payload
+        for start in range(0, data.nbytes, linkChunkSize):
+            chunk = data[start:start + linkChunkSize]
+            writer.write(chunk)
+            await writer.drain()
+            await self._throttle("send", chunk.nbytes)
+        if not isinstance(response, str):
+            writer.write(b"\n")
+            await writer.drain()
+        self.bytesSent += data.nbytes
+
+    async def _readCommand(self, reader):
+        # Returns (header, argument, block), or None at the end of the
+        # connection. The commands end with a "\n", or with a binary block.
+        text = bytearray()
+        block = None
+        while True:
+            char = await reader.read(1)
+            if not char:
+                return None
+            if char == b"\n":
+                break
+            if char == b"#":
+                blockHeader = bytearray(b"#")
+                while True:
+                    header = parseBlockHeader(blockHeader)
+                    if header is not None:
+                        break
+                    blockHeader += await reader.readexactly(1)
+                numBytes = header[1]
+                block = bytearray(numBytes)
+                position = 0
+                while position < numBytes:
+                    chunk = await reader.read(min(linkChunkSize, numBytes - position))
+                    if not chunk:
+                        return None
+                    block[position:position + len(chunk)] = chunk
+                    position += len(chunk)
+                    await self._throttle("receive", len(chunk))
+                self.bytesReceived += numBytes
+                await reader.readuntil(b"\n")
+                break
+            text += char
+        self.bytesReceived += len(text) + 1
+        header, _, argument = text.decode("ascii").strip().partition(" ")
+        return (header, argument, block)
+
+    async def _handleClient(self, reader, writer):
+        try:
+            while True:
+                command = await self._readCommand(reader)
+                if command is None:
+                    break
+                header, argument, block = command
+                if block is None and ";" in header + argument:
+                    subCommands = [part.strip().partition(" ")
+                                   for part in (header + " " + argument).split(";")]
+                else:
+                    subCommands = [(header, None, argument)]
+                for subHeader, _, subArgument in subCommands:
+                    if not subHeader:
+                        continue
+                    with self._scopeLock:
+                        response = self.scope.handleCommand(subHeader, subArgument, block)
+                    if response is not None:
+                        await self._send(writer, response)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def start(self):
+        # Starts the server in a background thread, see Note 3. Returns the port.
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handleClient, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="SimulatedScopeServer", daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.port
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stop()
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    # Acquire -> equalize -> upload to REFA, over a simulated 20 MB/s LAN link.
+    from equalizer_plan_cache import EqualizerPlanCache, equalizeWithPlan
+    from waveform_io import parseWaveDescriptor, skipBlockPrefix
+    print("\nStarting...")
+    profile = AttenuationProfile.fromCSVFile(pathTables, CSVFile_defaultTable)
+    scope = SimulatedScope(profile, numPoints=1_000_000, noiseVolts=0.002)
+    planCache = EqualizerPlanCache()
+    numCaptures = 5
+    with SimulatedScopeServer(scope, linkBandwidth=20e6, linkLatency=0.001) as server:
+        with SCPISocketClient(server.host, server.port) as client:
+            print("...", client.query("*IDN?"))
+            client.write(":WAV:SOUR C1")
+            preambleBytes = bytes(client.queryBlock(":WAV:PRE?"))
+            metadata = parseWaveDescriptor(preambleBytes[skipBlockPrefix(preambleBytes):])
+            buffer = np.empty(metadata.numSamples, dtype=np.int8)
+            startTime = time.perf_counter()
+            transferTime = 0.0
+            for _ in range(numCaptures):
+                transferStart = time.perf_counter()
+                client.queryBlock(":WAV:DATA?", buffer)
+                transferTime += time.perf_counter() - transferStart
+                volts = codesToVolts(buffer, metadata)
+                plan = planCache.getPlan(profile, scope.sampleRate, volts.size)
+                corrected = equalizeWithPlan(volts, plan)
+                client.writeBlock(":REF:DATA REFA,", voltsToCodes(corrected, metadata))
+            client.query("*OPC?")
+            elapsedTime = time.perf_counter() - startTime
+            print("...captures:", numCaptures, " samples each:", metadata.numSamples)
+            print("...\":WAV:DATA?\" MB/s: %.2f" % (numCaptures * buffer.nbytes / transferTime / 1e6),
+                  " loop captures/s: %.2f" % (numCaptures / elapsedTime))
+            print("...REFA bytes in the scope:", len(scope.references["REFA"]))
+    print("...end\n")
@@ -0,0 +1,241 @@
+# Name: single_precision_equalizer.py
+# Description: Single precision equalization path, float32 samples and
+#              complex64 spectrum, for the very long records.
+#              The float64 path of "equalizeWithPlan()" allocates for a record
+#              of N samples the complex128 rfft output and the float64 irfft
+#              output, 16 * N bytes on top of the float64 input, 3.2 GB for a
+#              200 Mpts record. Here the spectrum is multiplied in place by a
+#              complex64 plan, and the transforms are float32.
+#              There are two FFT backends:
+#                -BACKEND_SCIPY, "scipy.fft" with "workers=" for multi-threaded
+#                 transforms, the transforms return new arrays, the complex64
+#                 spectrum and the float32 output, 8 * N bytes per call.
+#                -BACKEND_NUMPY, NumPy 2 transforms with "out=" into the work
+#                 buffers, one thread. But the NumPy rfft of a float32 record
+#                 allocates a work buffer of 16 * N bytes in each call, even
+#                 with "out=", so it saves no memory over the float64 path, it's
+#                 only used without scipy, see Note 2.
+#              "compareWithFloat64()" reports the error against the float64
+#              path in ADC LSBs, and a bound of the float32 rounding error, to
+#              tell when the 8 bit (or 10 bit) resolution makes the cheaper path
+#              lossless in practice.
+#
+# Note 1: The rounding error of a float32 FFT grows with the relative error
+#         eps32 * log2(N) (eps32 = 2^-24), the bound used is
+#         2 * eps32 * log2(N) * RMS of the output, for the rfft and the irfft,
+#         times the largest gain of the plan, the error of each transform is
+#         amplified by the equalization.
+#         The path is taken as lossless when the measured maximum error is
+#         below 1/2 LSB, that is, the output codes would be the same except
+#         for the samples at the rounding limit.
+#
+# Note 2: scipy is optional, it's imported only if it's installed, and
+#         BACKEND_AUTO always prefers it. Without NumPy 2 and without scipy
+#         there is no single precision backend.
+#
+# Note 3: "workingMemoryBytes()" is the size of the arrays of one equalization,
+#         without the work buffers of the FFT library, "measurePeakMemory()"
+#         measures the real peak with tracemalloc (NumPy and scipy report
+#         their allocations to it).
+#
+# License:        MIT Open Source License
+#
+
+import os
+import time
+import tracemalloc
+import numpy as np
+
+from attenuation_profile import AttenuationProfile
+from equalizer_plan_cache import EqualizerPlanCache, equalizeWithPlan
+from equalizer_response import defaultSampleRate, defaultMaxGain_dB
+from pipeline_instrumentation import timedStage
+
+try:
+    import scipy.fft as scipyFFT
+except ImportError:
+    scipyFFT = None
+
+################
+# Configurations
+################
+
+pathTables = ".//output_out//"
+CSVFile_defaultTable = "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv"
+
+###########
+# Constants
+###########
+
+BACKEND_AUTO  = "BACKEND_AUTO"
+BACKEND_NUMPY = "BACKEND_NUMPY"
+BACKEND_SCIPY = "BACKEND_SCIPY"
+
+FLOAT32_EPSILON = float(np.finfo(np.float32).eps) / 2.0
+
+# NumPy 2 has float32 transforms and the "out=" parameter.
+flag_numpy_float32_fft = np.lib.NumpyVersion(np.__version__) >= "2.0.0"
+
+#########
+# Classes
+#########
+
+class SinglePrecisionEqualizer:
+
+    def __init__(self, profile, sampleRate = defaultSampleRate, maxGain_dB = defaultMaxGain_dB,
+                 passbandEdgeMHz = None, backend = BACKEND_AUTO, workers = None,
+                 planCache = None):
+        # Param: workers number of threads of BACKEND_SCIPY, None for all the CPUs.
+        self.profile    = profile
+        self.sampleRate = sampleRate
+        self.maxGain_dB = maxGain_dB
+        self.passbandEdgeMHz = passbandEdgeMHz
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.backend = chooseBackend(backend)
+        self.planCache = EqualizerPlanCache() if planCache is None else planCache
+        self._input    = None
+        self._spectrum = None
+
+    def _workBuffers(self, numSamples):
+        # The buffers of the last record length, reused while it's the same.
+        # The scipy transforms return new arrays, the spectrum buffer is only
+        # for BACKEND_NUMPY.
+        if self._input is None or self._input.size != numSamples:
+            self._input = np.empty(numSamples, dtype=np.float32)
+            if self.backend == BACKEND_NUMPY:
+                self._spectrum = np.empty(numSamples // 2 + 1, dtype=np.complex64)
+        return (self._input, self._spectrum)
+
+    def getPlan(self, numSamples):
+        return self.planCache.getPlan(self.profile, self.sampleRate, numSamples, self.maxGain_dB,
+                                      self.passbandEdgeMHz, dtype=np.complex64)
+
+    @timedStage("single_precision_equalize")
+    def equalize(self, samples, out = None):
+        # Equalizes the record, returns float32 Volts in "out" (or a new array).
+        samples = np.asarray(samples)
+        numSamples = samples.size
+        plan = self.getPlan(numSamples)
+        inputBuffer, spectrum = self._workBuffers(numSamples)
+        if samples.dtype != np.float32:
+            # Converted into the work buffer, without a float64 temporary.
+            np.copyto(inputBuffer, samples, casting='unsafe')
+            samples = inputBuffer
+        if out is None:
+            out = np.empty(numSamples, dtype=np.float32)
+        if self.backend == BACKEND_NUMPY:
+            np.fft.rfft(samples, out=spectrum)
+            spectrum *= plan
+            np.fft.irfft(spectrum, numSamples, out=out)
+        else:
+            spectrum = scipyFFT.rfft(samples, workers=self.workers)
+            spectrum *= plan
+            out[...] = scipyFFT.irfft(spectrum, numSamples, workers=self.workers,
+                                      overwrite_x=True)
+        return out
+
+###########
+# Functions
+###########
+
+def chooseBackend(backend):
+    # BACKEND_AUTO is scipy when it's installed, see Note 2.
+    if backend == BACKEND_AUTO:
+        backend = BACKEND_SCIPY if scipyFFT is not None else BACKEND_NUMPY
+    if backend == BACKEND_NUMPY and not flag_numpy_float32_fft:
+        raise RuntimeError("The NumPy backend needs NumPy 2, installed: " + np.__version__)
+    if backend == BACKEND_SCIPY and scipyFFT is None:
+        raise RuntimeError("scipy is needed for the scipy FFT backend.")
+    if backend not in (BACKEND_NUMPY, BACKEND_SCIPY):
+        raise ValueError("Unknown FFT backend: " + str(backend))
+    return backend
+
+def workingMemoryBytes(numSamples, flag_single_precision):
+    # The spectrum and output bytes of one equalization, see Note 3.
+    itemSize = 4 if flag_single_precision else 8
+    return itemSize * (numSamples + 2 * (numSamples // 2 + 1))
+
+def measurePeakMemory(function, *args):
+    # Returns (result, peak bytes allocated by the call), see Note 3.
+    flag_started = not tracemalloc.is_tracing()
+    if flag_started:
+        tracemalloc.start()
+    else:
+        tracemalloc.reset_peak()
+    try:
+        currentMemory, _ = tracemalloc.get_traced_memory()
+        result = function(*args)
+        _, peakMemory = tracemalloc.get_traced_memory()
+    finally:
+        if flag_started:
+            tracemalloc.stop()
+    return (result, peakMemory - currentMemory)
+
+def calcErrorBound(numSamples, rmsOutput, plan):
+    # Bound of the RMS error of the float32 path, see Note 1.
+    maxGain = float(np.max(np.abs(plan)))
+    return 2.0 * 2.0 * FLOAT32_EPSILON * np.log2(max(numSamples, 2)) * rmsOutput * maxGain
+
+def compareWithFloat64(equalizer, samples, lsbVolts):
+    # Error of the single precision path against the float64 path, in Volts
+    # and in LSBs of the ADC, see Note 1.
+    samples = np.asarray(samples, dtype=np.float32)
+    reference = equalizeWithPlan(samples.astype(np.float64),
+                                 equalizer.planCache.getPlan(equalizer.profile,
+                                                             equalizer.sampleRate, samples.size,
+                                                             equalizer.maxGain_dB,
+                                                             equalizer.passbandEdgeMHz))
+    error = equalizer.equalize(samples).astype(np.float64) - reference
+    maxError = float(np.max(np.abs(error)))
+    rmsError = float(np.sqrt(np.mean(error ** 2)))
+    bound = calcErrorBound(samples.size, float(np.sqrt(np.mean(reference ** 2))),
+                           equalizer.getPlan(samples.size))
+    return {"numSamples": samples.size, "maxErrorVolts": maxError, "rmsErrorVolts": rmsError,
+            "rmsErrorBoundVolts": bound, "maxErrorLSB": maxError / lsbVolts,
+            "rmsErrorLSB": rmsError / lsbVolts, "rmsErrorBoundLSB": bound / lsbVolts,
+            "lossless": maxError < 0.5 * lsbVolts}
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    from simulated_scpi_scope import generateSyntheticSignal, SIGNAL_SQUARE
+    from equalizer_response import applyProfileResponse
+    print("\nStarting...")
+    profile = AttenuationProfile.fromCSVFile(pathTables, CSVFile_defaultTable)
+    # The LSB of the 8 bit and 10 bit modes with 1 Volt at 4 divisions.
+    lsbVolts = {"8 bit": 0.25 / 25.0, "10 bit": 0.25 / 100.0}
+    planCache = EqualizerPlanCache()
+    backends = [BACKEND_NUMPY] if flag_numpy_float32_fft else []
+    backends += [BACKEND_SCIPY] if scipyFFT is not None else []
+    for numSamples in (1_000_000, 1 << 24):
+        samples = applyProfileResponse(generateSyntheticSignal(SIGNAL_SQUARE, numSamples),
+                                       defaultSampleRate, profile)
+        samples32 = samples.astype(np.float32)
+        plan64 = planCache.getPlan(profile, defaultSampleRate, numSamples)
+        startTime = time.perf_counter()
+        equalizeWithPlan(samples, plan64)
+        time64 = time.perf_counter() - startTime
+        _, peak64 = measurePeakMemory(equalizeWithPlan, samples, plan64)
+        print("...samples: %d  float64 ms: %.1f  peak MB: %.1f (arrays %.1f)" %
+              (numSamples, time64 * 1e3, peak64 / 1e6,
+               workingMemoryBytes(numSamples, False) / 1e6))
+        for backend in backends:
+            equalizer = SinglePrecisionEqualizer(profile, backend=backend, planCache=planCache)
+            out = np.empty(numSamples, dtype=np.float32)
+            equalizer.equalize(samples32, out)
+            startTime = time.perf_counter()
+            equalizer.equalize(samples32, out)
+            time32 = time.perf_counter() - startTime
+            _, peak32 = measurePeakMemory(equalizer.equalize, samples32, out)
+            print("...   %-13s workers: %d  float32 ms: %.1f  speedup: %.2f  "
+                  "peak MB: %.1f (arrays %.1f)" %
+                  (backend, equalizer.workers, time32 * 1e3, time64 / time32, peak32 / 1e6,
+                   workingMemoryBytes(numSamples, True) / 1e6))
+        for name, lsb in lsbVolts.items():
+            report = compareWithFloat64(equalizer, samples32, lsb)
+            print("...   %-6s max error LSB: %.4f  RMS: %.5f  RMS bound: %.5f  lossless: %s" %
+                  (name, report["maxErrorLSB"], report["rmsErrorLSB"],
+                   report["rmsErrorBoundLSB"], report["lossless"]))
+    print("...end\n")
@@ -0,0 +1,178 @@
+# Name: streaming_equalizer.py
+# Description: Streaming overlap-save frequency domain equalizer for long
+#              captures (ex: 200 Mpts of the SDS2000X Plus).
+#              Instead of one FFT over all the buffer, the record is processed
+#              in fixed size blocks with the overlap-save method, using a FIR
+#              kernel with the inverse response derived from the attenuation
+#              tables. The peak memory is bounded by the block size and the
+#              corrected chunks are yielded by a generator, so that plotting and
+#              saving can start before all the record is processed.
+#
+# Note 1: The kernel is linear phase, designed by frequency sampling of the
+#         inverse complex response in a dense grid, centered and windowed.
+#         Its delay of (numTaps - 1) / 2 samples is removed from the output, so
+#         the output sample n corresponds to the input sample n and the output
+#         has the same length as the input.
+#
+# Note 2: Each block has "blockSize" samples (the FFT size), of them
+#         "numTaps - 1" are the overlap with the previous block and the other
+#         "blockSize - numTaps + 1" are new corrected samples.
+#
+# License:        MIT Open Source License
+#
+
+import numpy as np
+
+from attenuation_profile import AttenuationProfile
+from pipeline_instrumentation import timedStage, incrementCounter
+from equalizer_response import (calcInverseComplexResponse, rfftFreqsMHz,
+                                applyProfileResponse, defaultSampleRate,
+                                defaultMaxGain_dB)
+
+################
+# Configurations
+################
+
+pathTables = ".//output_out//"
+CSVFile_defaultTable = "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv"
+
+defaultNumTaps   = 255
+defaultBlockSize = 1 << 16
+
+# The dense frequency grid of the kernel design has this times the number of taps.
+kernelDesignOversampling = 16
+
+###########
+# Functions
+###########
+
+def nextPowerOf2(value):
+    return 1 << max(int(value) - 1, 0).bit_length()
+
+@timedStage()
+def designOverlapSaveKernel(profile, sampleRate = defaultSampleRate,
+                            numTaps = defaultNumTaps, maxGain_dB = defaultMaxGain_dB,
+                            passbandEdgeMHz = None):
+    # Linear phase FIR kernel with the inverse response, see Note 1.
+    # The number of taps is made odd, so that the delay is an integer.
+    numTaps = numTaps | 1
+    gridSize = nextPowerOf2(numTaps * kernelDesignOversampling)
+    response = calcInverseComplexResponse(profile, rfftFreqsMHz(gridSize, sampleRate),
+                                          maxGain_dB, passbandEdgeMHz)
+    impulse = np.fft.irfft(response, gridSize)
+    half = numTaps // 2
+    kernel = np.concatenate((impulse[-half:], impulse[:half + 1]))
+    return kernel * np.blackman(numTaps + 2)[1:-1]
+
+#########
+# Classes
+#########
+
+class StreamingEqualizer:
+
+    def __init__(self, kernel, blockSize = defaultBlockSize, dtype = np.float64):
+        self.kernel    = np.ascontiguousarray(kernel, dtype=np.float64)
+        self.numTaps   = self.kernel.size
+        self.overlap   = self.numTaps - 1
+        self.blockSize = nextPowerOf2(blockSize)
+        if self.blockSize < 2 * self.numTaps:
+            raise ValueError("The block size must be at least twice the number of taps.")
+        self.hopSize  = self.blockSize - self.overlap
+        self.delay    = self.overlap // 2
+        self.dtype    = np.dtype(dtype)
+        self.kernelSpectrum = np.fft.rfft(self.kernel, self.blockSize)
+
+    @classmethod
+    def fromProfile(cls, profile, sampleRate = defaultSampleRate, numTaps = defaultNumTaps,
+                    blockSize = defaultBlockSize, maxGain_dB = defaultMaxGain_dB,
+                    passbandEdgeMHz = None, dtype = np.float64):
+        kernel = designOverlapSaveKernel(profile, sampleRate, numTaps, maxGain_dB,
+                                         passbandEdgeMHz)
+        return cls(kernel, blockSize, dtype)
+
+    def peakMemoryBytes(self):
+        # Approximate working memory, independent of the record length.
+        return (self.blockSize * 8 * 2 + (self.blockSize // 2 + 1) * 16 * 2
+                + self.hopSize * self.dtype.itemsize)
+
+    @timedStage("overlap_save_block")
+    def _processBlock(self, block):
+        spectrum = np.fft.rfft(block)
+        spectrum *= self.kernelSpectrum
+        return np.fft.irfft(spectrum, self.blockSize)[self.overlap:]
+
+    def equalizeStream(self, chunkIter):
+        # Generator, receives an iterable of input chunks of any size and
+        # yields the corrected chunks. The concatenation of the yielded chunks
+        # has the same length as the concatenation of the input chunks.
+        block = np.zeros(self.blockSize, dtype=np.float64)
+        fill = self.overlap
+        toSkip = self.delay
+
+        def emit(out):
+            nonlocal toSkip
+            if toSkip > 0:
+                skipNow = min(toSkip, out.size)
+                out = out[skipNow:]
+                toSkip -= skipNow
+            return out.astype(self.dtype, copy=False)
+
+        # The delay zeros at the end flush the last samples out of the filter.
+        flushZeros = np.zeros(self.delay, dtype=np.float64)
+        for chunk in _chainChunks(chunkIter, flushZeros):
+            pos = 0
+            while pos < chunk.size:
+                numNew = min(self.blockSize - fill, chunk.size - pos)
+                block[fill:fill + numNew] = chunk[pos:pos + numNew]
+                fill += numNew
+                pos  += numNew
+                if fill == self.blockSize:
+                    out = emit(self._processBlock(block))
+                    incrementCounter("overlap_save_blocks")
+                    block[:self.overlap] = block[self.hopSize:].copy()
+                    fill = self.overlap
+                    if out.size > 0:
+                        yield out
+        numPending = fill - self.overlap
+        if numPending > 0:
+            block[fill:] = 0.0
+            out = emit(self._processBlock(block)[:numPending])
+            if out.size > 0:
+                yield out
+
+    def equalizeArray(self, samples, chunkSize = None):
+        # Generator over a record in memory or memory-mapped, it's read in chunks.
+        if chunkSize is None:
+            chunkSize = self.hopSize
+        chunkIter = (samples[start:start + chunkSize]
+                     for start in range(0, len(samples), chunkSize))
+        return self.equalizeStream(chunkIter)
+
+def _chainChunks(chunkIter, lastChunk):
+    for chunk in chunkIter:
+        yield np.asarray(chunk, dtype=np.float64).ravel()
+    yield lastChunk
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    # Simulates a capture of a 100 MHz square wave, through the scope response,
+    # and equalizes it in streaming mode.
+    print("\nStarting...")
+    profile = AttenuationProfile.fromCSVFile(pathTables, CSVFile_defaultTable)
+    sampleRate = defaultSampleRate
+    numSamples = 1 << 20
+    time = np.arange(numSamples) / sampleRate
+    original = np.sign(np.sin(2.0 * np.pi * 100.0e6 * time + 0.1))
+    captured = applyProfileResponse(original, sampleRate, profile)
+    equalizer = StreamingEqualizer.fromProfile(profile, sampleRate)
+    print("...block size:", equalizer.blockSize, " taps:", equalizer.numTaps,
+          " working memory bytes:", equalizer.peakMemoryBytes())
+    corrected = np.concatenate(list(equalizer.equalizeArray(captured)))
+    middle = slice(equalizer.numTaps, numSamples - equalizer.numTaps)
+    print("...RMS error captured :", np.sqrt(np.mean((captured[middle] - original[middle]) ** 2)))
+    print("...RMS error corrected:", np.sqrt(np.mean((corrected[middle] - original[middle]) ** 2)))
+    print("...end\n")
+
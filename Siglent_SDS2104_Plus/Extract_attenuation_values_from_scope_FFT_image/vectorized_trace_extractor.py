@@ -0,0 +1,99 @@
+# Name: vectorized_trace_extractor.py
+# Description: Vectorized NumPy engine that extracts the plotted trace pixel
+#              positions of a scope FFT screenshot.
+#              The image is loaded only once as a NumPy array, one boolean
+#              color mask is built for the bounding box of all the search
+#              zones and for all the trace colors at the same time, and the
+#              per column position of each trace is calculated with array
+#              reductions, instead of the per pixel Python loops.
+#              Several trace colors (ex: one per channel) can be extracted
+#              in one single pass over the image.
+#
+# Note 1: The position rule is the same of the original "processZone()".
+#         For each column of a zone, the Y position is the first pixel with
+#         the trace color plus half of the number of trace pixels minus one,
+#         that is, the vertical average of the connected pixels.
+#
+# Note 2: The zones are (upperLeftX, upperLeftY, downRightX, downRightY) and
+#         the down right limits are exclusive, like in the original
+#         "range(upperLeftX, downRightX)" loops.
+#
+# Note 3: The color tolerance is the max absolute difference allowed in each
+#         of the R, G and B components. A tolerance of 0 is an exact match.
+#
+# License:        MIT Open Source License
+#
+
+import numpy as np
+
+from pipeline_instrumentation import timedStage
+
+###########
+# Functions
+###########
+
+@timedStage()
+def loadImageArray(img):
+    # Returns the image pixels as a (sizeY, sizeX, 3) uint8 NumPy array.
+    # The alpha channel, if it exists, is dropped.
+    return np.asarray(img.convert("RGB"))
+
+def hexColorToRGB(hexColor):
+    # Converts a "B014E8" or "#B014E8" color string into a (r, g, b) tuple.
+    hexColor = hexColor.lstrip("#")
+    return (int(hexColor[0:2], 16), int(hexColor[2:4], 16), int(hexColor[4:6], 16))
+
+def getZonesBoundingBox(zoneLst):
+    # Returns the (minX, minY, maxX, maxY) box that contains all the zones.
+    zones = np.array(zoneLst, dtype=np.int64)
+    return (int(zones[:, 0].min()), int(zones[:, 1].min()),
+            int(zones[:, 2].max()), int(zones[:, 3].max()))
+
+def buildColorMask(imgArray, colorLst, tolerance, box):
+    # Builds the boolean mask of shape (numColors, boxSizeY, boxSizeX) with
+    # True for each pixel inside the box that matches each of the colors.
+    minX, minY, maxX, maxY = box
+    crop = imgArray[minY:maxY, minX:maxX, :3].astype(np.int16)
+    colors = np.array(colorLst, dtype=np.int16).reshape(-1, 1, 1, 3)
+    if tolerance == 0:
+        return np.all(crop[np.newaxis] == colors, axis=-1)
+    return np.all(np.abs(crop[np.newaxis] - colors) <= tolerance, axis=-1)
+
+def calcColumnsCentroid(zoneMask, upperLeftX, upperLeftY):
+    # Calculates the first hit and count centroid of each column of a zone mask,
+    # with shape (numColors, zoneSizeY, zoneSizeX).
+    # Returns, for each color, the arrays of the X positions that have trace
+    # pixels and of the calculated Y positions.
+    counter = zoneMask.sum(axis=1)
+    firstPointY = zoneMask.argmax(axis=1)
+    resultLst = []
+    for colorIndex in range(zoneMask.shape[0]):
+        validColumns = np.flatnonzero(counter[colorIndex] > 0)
+        calcY = ((firstPointY[colorIndex, validColumns] + upperLeftY).astype(np.float64)
+                 + (counter[colorIndex, validColumns] - 1) / 2.0)
+        resultLst.append((validColumns + upperLeftX, calcY))
+    return resultLst
+
+@timedStage()
+def extractTracesPixelPos(imgArray, zoneLst, colorLst, tolerance = 0):
+    # Extract the FFT line plot pixel positions of each trace color.
+    # Returns one list of [x, calcY] point pairs for each color in "colorLst",
+    # with the zones points concatenated in the order of "zoneLst".
+    box = getZonesBoundingBox(zoneLst)
+    minX, minY, _, _ = box
+    colorMask = buildColorMask(imgArray, colorLst, tolerance, box)
+    tracesPointPairLst = [[] for _ in colorLst]
+    for zone in zoneLst:
+        upperLeftX, upperLeftY, downRightX, downRightY = zone
+        zoneMask = colorMask[:, upperLeftY - minY : downRightY - minY,
+                                upperLeftX - minX : downRightX - minX]
+        zoneResult = calcColumnsCentroid(zoneMask, upperLeftX, upperLeftY)
+        for colorIndex, (posX, calcY) in enumerate(zoneResult):
+            tracesPointPairLst[colorIndex] += [list(pair) for pair in
+                                               zip(posX.tolist(), calcY.tolist())]
+    return tracesPointPairLst
+
+def extractTracePixelPos(imgArray, zoneLst, color, tolerance = 0):
+    # Extract the FFT line plot pixel positions of a single trace color.
+    return extractTracesPixelPos(imgArray, zoneLst, [color], tolerance)[0]
+
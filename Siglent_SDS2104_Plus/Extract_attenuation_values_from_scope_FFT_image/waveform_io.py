@@ -0,0 +1,261 @@
+# Name: waveform_io.py
+# Description: Waveform I/O layer for the raw sample dumps of the Siglent
+#              SDS2000X Plus, 8 bit samples or 16 bit words in 10 bit mode,
+#              that can be gigabytes long.
+#              The files are memory-mapped, the WAVEDESC block (the same block
+#              that the scope returns to the ":WAV:PREamble?" query) is decoded
+#              to get the vertical scale and offset, and the samples are
+#              yielded in chunks of float32 Volts, without loading all the file.
+#              This allows the equalizer to process captures larger then the RAM.
+#
+# File layout:
+#   [optional IEEE 488.2 "#N<length>" block prefix]
+#   WAVEDESC block, "WAVE_DESCRIPTOR" bytes (346 in the SDS2000X Plus)
+#   user text, trigger time and RIS time arrays (normally with 0 bytes)
+#   samples, "WAVE_ARRAY_1" bytes, int8 or int16 codes
+#
+# Note 1: Volts = code * (verticalGain / codePerDiv) - verticalOffset.
+#         The verticalGain is the Volts per division and the codePerDiv is in
+#         the same units of the stored codes, so the same formula works for
+#         the 8 bit bytes and for the 16 bit words of the 10 bit mode.
+#
+# Note 2: Files without a WAVEDESC block (plain dumps) can be read by giving a
+#         "WaveformMetadata" made with "makeRawMetadata()".
+#
+# License:        MIT Open Source License
+#
+
+import collections
+import os
+import struct
+import numpy as np
+
+from pipeline_instrumentation import timedStage
+
+################
+# Configurations
+################
+
+defaultChunkSize = 1 << 20
+
+###########
+# Constants
+###########
+
+WAVEDESC_NAME = b"WAVEDESC"
+WAVEDESC_SIZE = 346
+
+# Offsets of the WAVEDESC fields.
+OFFSET_COMM_TYPE         = 32    # int16, 0 is byte, 1 is word
+OFFSET_COMM_ORDER        = 34    # int16, 0 is big endian, 1 is little endian
+OFFSET_WAVE_DESCRIPTOR   = 36    # int32, length of the WAVEDESC block
+OFFSET_USER_TEXT         = 40    # int32
+OFFSET_TRIGTIME_ARRAY    = 48    # int32
+OFFSET_RIS_TIME_ARRAY    = 52    # int32
+OFFSET_WAVE_ARRAY_1      = 60    # int32, length in bytes of the samples
+OFFSET_WAVE_ARRAY_COUNT  = 116   # int32, number of samples
+OFFSET_VERTICAL_GAIN     = 156   # float32, Volts per division
+OFFSET_VERTICAL_OFFSET   = 160   # float32, Volts
+OFFSET_CODE_PER_DIV      = 164   # float32
+OFFSET_ADC_BIT           = 172   # int16
+OFFSET_HORIZ_INTERVAL    = 176   # float32, seconds between samples
+OFFSET_HORIZ_OFFSET      = 180   # float64, seconds
+
+COMM_TYPE_BYTE = 0
+COMM_TYPE_WORD = 1
+
+COMM_ORDER_BIG_ENDIAN    = 0
+COMM_ORDER_LITTLE_ENDIAN = 1
+
+#########
+# Classes
+#########
+
+WaveformMetadata = collections.namedtuple("WaveformMetadata",
+        ["sampleWidth", "littleEndian", "numSamples", "dataOffset", "verticalGain",
+         "verticalOffset", "codePerDiv", "adcBits", "sampleInterval", "horizontalOffset"])
+
+class RawWaveformFile:
+
+    def __init__(self, fileName, metadata = None):
+        self.fileName = fileName
+        if metadata is None:
+            metadata = readWaveformMetadata(fileName)
+        # A truncated capture is read up to the last complete sample.
+        availableSamples = (os.path.getsize(fileName) - metadata.dataOffset) // metadata.sampleWidth
+        self.metadata = metadata._replace(numSamples=max(0, min(metadata.numSamples,
+                                                                availableSamples)))
+        self.codes = np.memmap(fileName, dtype=codesDtype(self.metadata), mode='r',
+                               offset=self.metadata.dataOffset,
+                               shape=(self.metadata.numSamples,))
+        self.sampleRate = (1.0 / metadata.sampleInterval) if metadata.sampleInterval > 0 else 0.0
+
+    def __len__(self):
+        return self.metadata.numSamples
+
+    def volts(self, start = 0, stop = None, out = None):
+        # Volts of the samples [start, stop) as a float32 array.
+        return codesToVolts(self.codes[start:stop], self.metadata, out)
+
+    def iterVoltsChunks(self, chunkSize = defaultChunkSize, flag_reuse_buffer = False):
+        # Generator of float32 Volts chunks. With "flag_reuse_buffer" the same
+        # buffer is reused for all the chunks, the consumer must use each chunk
+        # before asking for the next one.
+        buffer = np.empty(chunkSize, dtype=np.float32) if flag_reuse_buffer else None
+        for start in range(0, len(self), chunkSize):
+            stop = min(start + chunkSize, len(self))
+            out = buffer[:stop - start] if buffer is not None else None
+            yield codesToVolts(self.codes[start:stop], self.metadata, out)
+
+    def timeAxis(self, start = 0, stop = None):
+        if stop is None:
+            stop = len(self)
+        return (self.metadata.horizontalOffset
+                + np.arange(start, stop, dtype=np.float64) * self.metadata.sampleInterval)
+
+    def close(self):
+        # Releases the memory map.
+        mmap = getattr(self.codes, "_mmap", None)
+        self.codes = None
+        if mmap is not None:
+            mmap.close()
+
+###########
+# Functions
+###########
+
+def codesDtype(metadata):
+    byteOrder = "<" if metadata.littleEndian else ">"
+    return np.dtype(byteOrder + ("i1" if metadata.sampleWidth == 1 else "i2"))
+
+@timedStage("waveform_codes_to_volts")
+def codesToVolts(codes, metadata, out = None):
+    # Vectorized conversion of the codes into float32 Volts, see Note 1.
+    if out is None:
+        out = np.empty(len(codes), dtype=np.float32)
+    np.multiply(codes, np.float32(metadata.verticalGain / metadata.codePerDiv), out=out,
+                dtype=np.float32)
+    out -= np.float32(metadata.verticalOffset)
+    return out
+
+def adcCodeLimits(metadata):
+    # (min code, max code) of the ADC, the words of the 10 bit mode only use
+    # the 10 bit range.
+    bits = 8 if metadata.sampleWidth == 1 else max(8, min(16, metadata.adcBits))
+    return (-(1 << (bits - 1)), (1 << (bits - 1)) - 1)
+
+def voltsToCodes(volts, metadata, out = None):
+    # Inverse of "codesToVolts()", rounds and clips the Volts to the codes
+    # of the ADC, in the integer type of the metadata sample width.
+    dtype = np.dtype(np.int8 if metadata.sampleWidth == 1 else np.int16)
+    minCode, maxCode = adcCodeLimits(metadata)
+    scaled = (np.asarray(volts, dtype=np.float64) + metadata.verticalOffset) * (
+              metadata.codePerDiv / metadata.verticalGain)
+    np.clip(np.rint(scaled, out=scaled), minCode, maxCode, out=scaled)
+    if out is None:
+        out = np.empty(scaled.size, dtype=dtype)
+    out[...] = scaled
+    return out
+
+def skipBlockPrefix(headerBytes):
+    # Returns the number of bytes of an IEEE 488.2 "#N<length>" definite
+    # length block prefix, or 0 if there isn't one.
+    if headerBytes[:1] != b"#" or len(headerBytes) < 2 or not headerBytes[1:2].isdigit():
+        return 0
+    return 2 + int(headerBytes[1:2])
+
+def parseWaveDescriptor(headerBytes, baseOffset = 0):
+    # Decodes the WAVEDESC block. The "baseOffset" is the position of the
+    # block in the file.
+    if headerBytes[:len(WAVEDESC_NAME)] != WAVEDESC_NAME:
+        raise ValueError("There is no WAVEDESC block.")
+    if len(headerBytes) < WAVEDESC_SIZE:
+        raise ValueError("Truncated WAVEDESC block.")
+    commOrder = struct.unpack_from("<h", headerBytes, OFFSET_COMM_ORDER)[0]
+    endian = "<" if commOrder == COMM_ORDER_LITTLE_ENDIAN else ">"
+    def field(fmt, offset):
+        return struct.unpack_from(endian + fmt, headerBytes, offset)[0]
+    commType = field("h", OFFSET_COMM_TYPE)
+    sampleWidth = 2 if commType == COMM_TYPE_WORD else 1
+    dataOffset = (baseOffset + field("i", OFFSET_WAVE_DESCRIPTOR) + field("i", OFFSET_USER_TEXT)
+                  + field("i", OFFSET_TRIGTIME_ARRAY) + field("i", OFFSET_RIS_TIME_ARRAY))
+    numSamples = field("i", OFFSET_WAVE_ARRAY_1) // sampleWidth
+    arrayCount = field("i", OFFSET_WAVE_ARRAY_COUNT)
+    if arrayCount > 0:
+        numSamples = min(numSamples, arrayCount)
+    return WaveformMetadata(sampleWidth, endian == "<", numSamples, dataOffset,
+                            field("f", OFFSET_VERTICAL_GAIN), field("f", OFFSET_VERTICAL_OFFSET),
+                            field("f", OFFSET_CODE_PER_DIV), field("h", OFFSET_ADC_BIT),
+                            field("f", OFFSET_HORIZ_INTERVAL), field("d", OFFSET_HORIZ_OFFSET))
+
+def readWaveformMetadata(fileName):
+    with open(fileName, mode='rb') as waveFile:
+        headerBytes = waveFile.read(16 + WAVEDESC_SIZE)
+    prefixSize = skipBlockPrefix(headerBytes)
+    return parseWaveDescriptor(headerBytes[prefixSize:], prefixSize)
+
+def makeRawMetadata(numSamples, sampleWidth = 1, verticalGain = 1.0, verticalOffset = 0.0,
+                    codePerDiv = 25.0, adcBits = 8, sampleInterval = 0.5e-9,
+                    horizontalOffset = 0.0, dataOffset = 0, littleEndian = True):
+    # Metadata for plain sample dumps without the WAVEDESC block, see Note 2.
+    return WaveformMetadata(sampleWidth, littleEndian, numSamples, dataOffset, verticalGain,
+                            verticalOffset, codePerDiv, adcBits, sampleInterval,
+                            horizontalOffset)
+
+def buildWaveDescriptor(metadata):
+    # Builds a little endian WAVEDESC block for the metadata.
+    headerBytes = bytearray(WAVEDESC_SIZE)
+    headerBytes[0:16]  = WAVEDESC_NAME.ljust(16, b"\x00")
+    headerBytes[16:32] = b"WAVEACE".ljust(16, b"\x00")
+    struct.pack_into("<h", headerBytes, OFFSET_COMM_TYPE,
+                     COMM_TYPE_WORD if metadata.sampleWidth == 2 else COMM_TYPE_BYTE)
+    struct.pack_into("<h", headerBytes, OFFSET_COMM_ORDER, COMM_ORDER_LITTLE_ENDIAN)
+    struct.pack_into("<i", headerBytes, OFFSET_WAVE_DESCRIPTOR, WAVEDESC_SIZE)
+    struct.pack_into("<i", headerBytes, OFFSET_WAVE_ARRAY_1,
+                     metadata.numSamples * metadata.sampleWidth)
+    struct.pack_into("<i", headerBytes, OFFSET_WAVE_ARRAY_COUNT, metadata.numSamples)
+    struct.pack_into("<f", headerBytes, OFFSET_VERTICAL_GAIN, metadata.verticalGain)
+    struct.pack_into("<f", headerBytes, OFFSET_VERTICAL_OFFSET, metadata.verticalOffset)
+    struct.pack_into("<f", headerBytes, OFFSET_CODE_PER_DIV, metadata.codePerDiv)
+    struct.pack_into("<h", headerBytes, OFFSET_ADC_BIT, metadata.adcBits)
+    struct.pack_into("<f", headerBytes, OFFSET_HORIZ_INTERVAL, metadata.sampleInterval)
+    struct.pack_into("<d", headerBytes, OFFSET_HORIZ_OFFSET, metadata.horizontalOffset)
+    return bytes(headerBytes)
+
+def writeRawWaveformFile(fileName, codes, metadata, chunkSize = defaultChunkSize):
+    # Writes the WAVEDESC block and the codes, in chunks, so that the codes
+    # can also be a memory-mapped array.
+    dtype = np.dtype("<i1" if metadata.sampleWidth == 1 else "<i2")
+    metadata = metadata._replace(numSamples=len(codes), dataOffset=WAVEDESC_SIZE,
+                                 littleEndian=True)
+    with open(fileName, mode='wb') as waveFile:
+        waveFile.write(buildWaveDescriptor(metadata))
+        for start in range(0, len(codes), chunkSize):
+            waveFile.write(np.asarray(codes[start:start + chunkSize], dtype=dtype).tobytes())
+    return metadata
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    # Writes a synthetic 10 bit mode capture and reads it back in chunks.
+    import tempfile
+    print("\nStarting...")
+    numSamples = 10_000_000
+    metadata = makeRawMetadata(numSamples, sampleWidth=2, verticalGain=0.2, codePerDiv=30.0 * 4,
+                               adcBits=10)
+    time = np.arange(numSamples) * metadata.sampleInterval
+    codes = np.round(np.sin(2.0 * np.pi * 10.0e6 * time) * 400.0).astype(np.int16)
+    fileName = os.path.join(tempfile.mkdtemp(), "capture_10bit.bin")
+    writeRawWaveformFile(fileName, codes, metadata)
+    waveform = RawWaveformFile(fileName)
+    maxVolts = 0.0
+    for chunk in waveform.iterVoltsChunks(flag_reuse_buffer=True):
+        maxVolts = max(maxVolts, float(np.max(np.abs(chunk))))
+    print("...samples:", len(waveform), " sample rate:", waveform.sampleRate,
+          " max Volts: %.4f" % maxVolts)
+    waveform.close()
+    os.remove(fileName)
+    print("...end\n")
+
@@ -0,0 +1,347 @@
+# Name: waveform_lod_pyramid.py
+# Description: Min/max decimation level of detail (LOD) pyramid, to plot the
+#              corrected captures with many millions of points (step 5 of the
+#              README, "show it on the PC in a graph plot") without giving all
+#              the samples to the plotting library.
+#              The level 0 has the min and the max of each bucket of
+#              "baseBucketSize" samples, made in one vectorized pass over the
+#              samples (in chunks, so the samples can be a memory-mapped
+#              capture), and each next level reduces "factor" buckets of the
+#              level before it into one.
+#              Any zoom window is served at the screen resolution from the
+#              coarsest level that still has at least one bucket per pixel, so
+#              the time of a query is O(pixels) and not O(samples).
+#              The pyramid can be saved in a file alongside the capture and
+#              memory-mapped back, and "SyncedLODTraces" keeps the original and
+#              the corrected traces with the same pixel columns, to overlay
+#              them like the REF_A comparison image of the README.
+#
+# File layout (little endian):
+#
+#   Header with 64 bytes:
+#     offset  0: 8 bytes   magic "OFRCLODP"
+#     offset  8: uint16    format version
+#     offset 10: uint16    factor between levels
+#     offset 12: uint32    number of levels
+#     offset 16: uint64    number of samples
+#     offset 24: uint64    base bucket size in samples
+#     offset 32: 32 bytes  reserved, zeros
+#
+#   Levels, from the finest, each one with the float32 mins and then the
+#   float32 maxs of its buckets.
+#
+# Note 1: The pixel columns are aligned to the buckets of the chosen level, so
+#         a column can include up to one bucket more of samples at each side.
+#         The envelope is never smaller then the real one, no peak is lost.
+#
+# Note 2: When the window has less then "baseBucketSize" samples per pixel, the
+#         samples are read directly, and with one or less samples per pixel
+#         the samples themselves are returned (mins = maxs = samples).
+#         This needs the samples, a pyramid loaded from a file without them
+#         serves these zooms from the level 0.
+#
+# License:        MIT Open Source License
+#
+
+import collections
+import os
+import struct
+import time
+import numpy as np
+
+from pipeline_instrumentation import timedStage
+
+################
+# Configurations
+################
+
+defaultBaseBucketSize = 16
+defaultFactor         = 4
+defaultMinLevelSize   = 1024
+
+defaultChunkSize = 1 << 22
+
+lodFileExtension = ".lod"
+
+###########
+# Constants
+###########
+
+LOD_MAGIC   = b"OFRCLODP"
+LOD_VERSION = 1
+HEADER_SIZE   = 64
+HEADER_STRUCT = struct.Struct("<8sHHIQQ32x")
+
+# Level of the views with the samples read directly, see Note 2.
+LEVEL_RAW = -1
+
+#########
+# Classes
+#########
+
+LODView = collections.namedtuple("LODView", ["sampleIndexes", "mins", "maxs", "level"])
+
+class MinMaxPyramid:
+
+    def __init__(self, numSamples, levels, baseBucketSize = defaultBaseBucketSize,
+                 factor = defaultFactor, readSamples = None):
+        # Param: levels list of (mins, maxs), from the finest.
+        #        readSamples(start, stop) returns the samples, or None, see Note 2.
+        self.numSamples     = numSamples
+        self.levels         = levels
+        self.baseBucketSize = baseBucketSize
+        self.factor         = factor
+        self.readSamples    = readSamples
+
+    def __len__(self):
+        return self.numSamples
+
+    def bucketSize(self, level):
+        return self.baseBucketSize * self.factor ** level
+
+    @classmethod
+    @timedStage("lod_pyramid_build")
+    def fromSamples(cls, samples, baseBucketSize = defaultBaseBucketSize, factor = defaultFactor,
+                    minLevelSize = defaultMinLevelSize, chunkSize = defaultChunkSize):
+        # Param: samples a NumPy array or a memory-mapped array of Volts.
+        chunkSize = max(baseBucketSize, chunkSize // baseBucketSize * baseBucketSize)
+        chunks = (samples[start:start + chunkSize] for start in range(0, len(samples), chunkSize))
+        return cls.fromChunks(chunks, len(samples), baseBucketSize, factor, minLevelSize,
+                              readSamples=lambda start, stop: samples[start:stop])
+
+    @classmethod
+    def fromWaveformFile(cls, waveform, baseBucketSize = defaultBaseBucketSize,
+                         factor = defaultFactor, minLevelSize = defaultMinLevelSize,
+                         chunkSize = defaultChunkSize):
+        # Pyramid of the Volts of a "waveform_io.RawWaveformFile".
+        chunkSize = max(baseBucketSize, chunkSize // baseBucketSize * baseBucketSize)
+        return cls.fromChunks(waveform.iterVoltsChunks(chunkSize, flag_reuse_buffer=True),
+                              len(waveform), baseBucketSize, factor, minLevelSize,
+                              readSamples=waveform.volts)
+
+    @classmethod
+    def fromChunks(cls, chunks, numSamples, baseBucketSize = defaultBaseBucketSize,
+                   factor = defaultFactor, minLevelSize = defaultMinLevelSize,
+                   readSamples = None):
+        # Param: chunks iterable of sample chunks, all the chunks but the last
+        #        must have a multiple of "baseBucketSize" samples.
+        if baseBucketSize < 1 or factor < 2:
+            raise ValueError("The base bucket size must be positive and the factor at least 2.")
+        numBuckets = -(-numSamples // baseBucketSize)
+        mins = np.empty(numBuckets, dtype=np.float32)
+        maxs = np.empty(numBuckets, dtype=np.float32)
+        position = 0
+        for chunk in chunks:
+            if position % baseBucketSize != 0:
+                raise ValueError("Only the last chunk can end in the middle of a bucket.")
+            bucket = position // baseBucketSize
+            chunkBuckets = -(-len(chunk) // baseBucketSize)
+            reduceBuckets(chunk, baseBucketSize, np.minimum, mins[bucket:bucket + chunkBuckets])
+            reduceBuckets(chunk, baseBucketSize, np.maximum, maxs[bucket:bucket + chunkBuckets])
+            position += len(chunk)
+        if position != numSamples:
+            raise ValueError("The chunks have %d samples, not %d." % (position, numSamples))
+        levels = [(mins, maxs)]
+        while levels[-1][0].size > minLevelSize:
+            mins, maxs = levels[-1]
+            levels.append((reduceBuckets(mins, factor, np.minimum),
+                           reduceBuckets(maxs, factor, np.maximum)))
+        return cls(numSamples, levels, baseBucketSize, factor, readSamples)
+
+    def chooseLevel(self, samplesPerPixel):
+        # The coarsest level with at least one bucket per pixel, or LEVEL_RAW.
+        if samplesPerPixel < self.baseBucketSize and self.readSamples is not None:
+            return LEVEL_RAW
+        level = 0
+        while level + 1 < len(self.levels) and self.bucketSize(level + 1) <= samplesPerPixel:
+            level += 1
+        return level
+
+    def query(self, start, stop, numPixels, level = None):
+        # Returns the "LODView" of the samples [start, stop) with at most
+        # "numPixels" columns, see Note 1.
+        # Param: level None chooses the level for the samples per pixel.
+        start, stop = max(0, int(start)), min(self.numSamples, int(stop))
+        if stop <= start or numPixels < 1:
+            empty = np.empty(0, dtype=np.float32)
+            return LODView(np.empty(0, dtype=np.int64), empty, empty, LEVEL_RAW)
+        samplesPerPixel = (stop - start) / numPixels
+        if level is None:
+            level = self.chooseLevel(samplesPerPixel)
+        if level == LEVEL_RAW:
+            samples = np.asarray(self.readSamples(start, stop), dtype=np.float32)
+            if samplesPerPixel <= 1.0:
+                return LODView(np.arange(start, stop), samples, samples, LEVEL_RAW)
+            edges = pixelEdges(0, stop - start, numPixels)
+            return LODView(start + edges, np.minimum.reduceat(samples, edges),
+                           np.maximum.reduceat(samples, edges), LEVEL_RAW)
+        bucketSize = self.bucketSize(level)
+        mins, maxs = self.levels[level]
+        firstBucket, endBucket = start // bucketSize, -(-stop // bucketSize)
+        # The buckets of the window only, the last column ends at "endBucket".
+        edges = pixelEdges(0, endBucket - firstBucket, numPixels)
+        return LODView(np.maximum((firstBucket + edges) * bucketSize, start),
+                       np.minimum.reduceat(mins[firstBucket:endBucket], edges),
+                       np.maximum.reduceat(maxs[firstBucket:endBucket], edges), level)
+
+    def save(self, fileName):
+        # Writes the pyramid, see the file layout.
+        header = HEADER_STRUCT.pack(LOD_MAGIC, LOD_VERSION, self.factor, len(self.levels),
+                                    self.numSamples, self.baseBucketSize)
+        with open(fileName, mode='wb') as lodFile:
+            lodFile.write(header)
+            for mins, maxs in self.levels:
+                lodFile.write(np.ascontiguousarray(mins, dtype="<f4").tobytes())
+                lodFile.write(np.ascontiguousarray(maxs, dtype="<f4").tobytes())
+
+    @classmethod
+    def load(cls, fileName, readSamples = None):
+        # Memory-maps a saved pyramid, the levels are read only views.
+        with open(fileName, mode='rb') as lodFile:
+            headerBytes = lodFile.read(HEADER_SIZE)
+        if len(headerBytes) != HEADER_SIZE:
+            raise ValueError("File too small to be a LOD pyramid: " + fileName)
+        magic, version, factor, numLevels, numSamples, baseBucketSize = \
+            HEADER_STRUCT.unpack(headerBytes)
+        if magic != LOD_MAGIC:
+            raise ValueError("Not a LOD pyramid file: " + fileName)
+        if version != LOD_VERSION:
+            raise ValueError("Unsupported LOD pyramid version %d: %s" % (version, fileName))
+        levelSizes = [-(-numSamples // baseBucketSize)]
+        for _ in range(numLevels - 1):
+            levelSizes.append(-(-levelSizes[-1] // factor))
+        totalSize = 2 * sum(levelSizes)
+        if os.path.getsize(fileName) < HEADER_SIZE + 4 * totalSize:
+            raise ValueError("Truncated LOD pyramid file: " + fileName)
+        block = np.memmap(fileName, dtype="<f4", mode='r', offset=HEADER_SIZE,
+                          shape=(totalSize,))
+        levels = []
+        position = 0
+        for size in levelSizes:
+            levels.append((block[position:position + size],
+                           block[position + size:position + 2 * size]))
+            position += 2 * size
+        return cls(numSamples, levels, baseBucketSize, factor, readSamples)
+
+class SyncedLODTraces:
+    # Traces of the same capture (ex: the original and the corrected one) that
+    # are always served with the same pixel columns, so they can be overlaid.
+
+    def __init__(self, sampleInterval = 0.5e-9, horizontalOffset = 0.0):
+        self.sampleInterval   = sampleInterval
+        self.horizontalOffset = horizontalOffset
+        self.traces = collections.OrderedDict()
+
+    def addTrace(self, name, pyramid):
+        for other in self.traces.values():
+            if (len(other), other.baseBucketSize, other.factor) != \
+               (len(pyramid), pyramid.baseBucketSize, pyramid.factor):
+                raise ValueError("The traces must have the same length and the same buckets.")
+        self.traces[name] = pyramid
+
+    def query(self, start, stop, numPixels):
+        # Returns a dict with the "LODView" of each trace. The level is chosen
+        # once for all the traces, so a trace without samples (loaded from a
+        # file) makes all of them use the level 0 in the deep zooms.
+        start, stop = max(0, int(start)), min(len(self), int(stop))
+        samplesPerPixel = (stop - start) / max(numPixels, 1)
+        level = max((pyramid.chooseLevel(samplesPerPixel) for pyramid in self.traces.values()),
+                    default=LEVEL_RAW)
+        return collections.OrderedDict((name, pyramid.query(start, stop, numPixels, level))
+                                       for name, pyramid in self.traces.items())
+
+    def queryTime(self, startTime, stopTime, numPixels):
+        # The same of "query()" with the window in seconds.
+        start = int(np.floor((startTime - self.horizontalOffset) / self.sampleInterval))
+        stop  = int(np.ceil((stopTime - self.horizontalOffset) / self.sampleInterval))
+        return self.query(start, stop, numPixels)
+
+    def timeAxis(self, view):
+        return self.horizontalOffset + view.sampleIndexes * self.sampleInterval
+
+    def __len__(self):
+        return len(next(iter(self.traces.values()))) if self.traces else 0
+
+###########
+# Functions
+###########
+
+def reduceBuckets(values, bucketSize, reduceFn, out = None):
+    # The "reduceFn" (np.minimum or np.maximum) of each bucket of "bucketSize"
+    # values, the last bucket can be partial.
+    values = np.asarray(values)
+    numFull = values.size // bucketSize
+    numBuckets = -(-values.size // bucketSize)
+    if out is None:
+        out = np.empty(numBuckets, dtype=np.float32)
+    if numFull > 0:
+        reduceFn.reduce(values[:numFull * bucketSize].reshape(numFull, bucketSize), axis=1,
+                        out=out[:numFull])
+    if numBuckets > numFull:
+        out[numFull] = reduceFn.reduce(values[numFull * bucketSize:])
+    return out
+
+def pixelEdges(start, stop, numPixels):
+    # The first index of each pixel column, strictly increasing.
+    numColumns = min(numPixels, stop - start)
+    return start + (np.arange(numColumns, dtype=np.int64) * (stop - start)) // numColumns
+
+def lodFileName(waveformFileName):
+    # The pyramid file saved alongside a capture file.
+    return os.path.splitext(waveformFileName)[0] + lodFileExtension
+
+######
+# Main
+######
+
+if __name__ == "__main__":
+    import tempfile
+    from attenuation_profile import AttenuationProfile
+    from equalizer_response import applyProfileResponse, equalizeFullRecord, defaultSampleRate
+    from simulated_scpi_scope import generateSyntheticSignal, SIGNAL_SQUARE
+    print("\nStarting...")
+    profile = AttenuationProfile.fromCSVFile(".//output_out//",
+                                             "dbVAttenuationTable_interpol_1M_step_0_to_1_GHz.csv")
+    numSamples = 1 << 24
+    original = applyProfileResponse(generateSyntheticSignal(SIGNAL_SQUARE, numSamples),
+                                    defaultSampleRate, profile).astype(np.float32)
+    corrected = equalizeFullRecord(original, defaultSampleRate, profile).astype(np.float32)
+
+    startTime = time.perf_counter()
+    pyramid = MinMaxPyramid.fromSamples(corrected)
+    elapsedTime = time.perf_counter() - startTime
+    print("...pyramid of %d samples, %d levels, build ms: %.1f" %
+          (numSamples, len(pyramid.levels), elapsedTime * 1e3))
+
+    traces = SyncedLODTraces(1.0 / defaultSampleRate)
+    traces.addTrace("original", MinMaxPyramid.fromSamples(original))
+    traces.addTrace("corrected", pyramid)
+    numPixels = 1920
+    for span in (numSamples, numSamples // 100, 100_000, 5_000, 1_000):
+        start = (numSamples - span) // 3
+        startTime = time.perf_counter()
+        views = traces.query(start, start + span, numPixels)
+        elapsedTime = time.perf_counter() - startTime
+        view = views["corrected"]
+        exact = (np.max(view.maxs) >= np.max(corrected[start:start + span]) and
+                 np.min(view.mins) <= np.min(corrected[start:start + span]))
+        print("...span: %9d  level: %2d  columns: %5d  query ms: %.3f  envelope ok: %s" %
+              (span, view.level, view.mins.size, elapsedTime * 1e3, exact))
+
+    # Outliers after the end of the window must not be in the last column.
+    outliers = np.zeros(1_000_000, dtype=np.float32)
+    outliers[-1], outliers[-5000] = 100.0, -50.0
+    view = MinMaxPyramid.fromSamples(outliers).query(0, 1 << 19, 100)
+    print("...outliers after the window excluded:",
+          view.level >= 0 and np.max(view.maxs) == 0.0 and np.min(view.mins) == 0.0)
+
+    fileName = os.path.join(tempfile.mkdtemp(), "corrected" + lodFileExtension)
+    pyramid.save(fileName)
+    loaded = MinMaxPyramid.load(fileName)
+    view = loaded.query(0, numSamples, numPixels)
+    print("...saved and mapped back, same view:",
+          np.array_equal(view.maxs, pyramid.query(0, numSamples, numPixels).maxs),
+          " file MB: %.1f" % (os.path.getsize(fileName) / 1e6))
+    del loaded, view
+    os.remove(fileName)
+    print("...end\n")